@@ -20,7 +20,12 @@ SavingThrow
 Identify or remove files known to be involved with undesired apps,
 based on curated lists of associated files.
 
-usage: SavingThrow.py [-h] [-v] [-s | -r | -q]
+usage: SavingThrow.py [-h] [-v]
+                      [--log-level {alert,debug,error,info,notice,warning}]
+                      [--log-file FILE] [-j JOBS] [--stats FILE] [--full]
+                      [--format {text,json,ndjson}] [--output FILE]
+                      [--daemon] [--root PATH] [--time-budget SECONDS]
+                      [--dry-run] [-s | -r | -q]
                       [jamf-arguments [jamf-arguments ...]]
 
 Modular Undesired file Extension Attribute and Removal Script. Call with
@@ -33,7 +38,36 @@ positional arguments:
 
 optional arguments:
   -h, --help        show this help message and exit
-  -v, --verbose     Print to stdout as well as syslog.
+  -v, --verbose     Print to stdout as well as syslog, and log
+                    everything.
+  --log-level {alert,debug,error,info,notice,warning}
+                    Log only messages at least this severe.
+  --log-file FILE   Append log messages to FILE as well.
+  -j JOBS, --jobs JOBS
+                    Number of Apps to search for at once.
+  --stats FILE      Write timings and I/O counts for each App and rule
+                    to FILE as JSON, and log the slowest rules.
+  --full            Search everything, rather than reusing results for
+                    unchanged directories and files from the last run.
+  --format {text,json,ndjson}
+                    Report findings in this format, rather than as an
+                    extension attribute. 'text' is the same as --stdout.
+  --output FILE     Write the report to FILE rather than stdout.
+  --daemon          Keep running, searching again whenever watched files
+                    change, and answer report requests from other
+                    SavingThrow runs instantly.
+  --root PATH       Search the filesystem in folder PATH (e.g. a mounted
+                    disk image or backup) instead of the running
+                    system's. May be given more than once; each root is
+                    searched by its own process. Report only.
+  --time-budget SECONDS
+                    Finish within SECONDS, searching the cheapest rules
+                    first, and report whatever has been found by then,
+                    marked as partial, with the rules that were
+                    skipped.
+  --dry-run         With --remove or --quarantine, print what would be
+                    removed, and its size in bytes, instead of changing
+                    anything.
   -s, --stdout      Print standard report.
   -r, --remove      Remove offending files.
   -q, --quarantine  Move files to quarantine location.
@@ -66,513 +100,4989 @@ and ultimately, digests you.
 # of this software.
 
 
-# Import ALL the modules!
+# Import ALL the modules! (Well, the ones every run needs. See
+# LazyModule for the rest.)
 import argparse
-from distutils.version import StrictVersion
+import atexit
+import contextlib
+import errno
+import fnmatch
+import functools
 import glob
+import hashlib
+import importlib
+import json
 import os
 import re
-import shutil
+import Queue
+import select
+import signal
+import socket
+import stat
+import StringIO
+import struct
 import subprocess
 import sys
 import syslog
+import tempfile
+import threading
 import time
-import urllib2
-from xml.etree import ElementTree
-import zipfile
+
+# scandir is builtin from python 3.5, and available as a backport
+# package before that. Fall back to listdir if neither is around.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+class LazyModule(object):
+    """Stands in for a module, importing it when first used.
+
+    Downloading ADFs, parsing them, quarantining, searching other
+    roots and watching for changes each need modules the others
+    don't. An extension attribute run with a warm cache needs none of
+    them, so they're only imported once an attribute is looked up.
+    """
+
+    def __init__(self, name):
+        """Stand in for the module called name."""
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        """Return the module's attribute, importing it if need be."""
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+ctypes = LazyModule("ctypes")
+ctypes_util = LazyModule("ctypes.util")
+distutils_version = LazyModule("distutils.version")
+ElementTree = LazyModule("xml.etree.ElementTree")
+httplib = LazyModule("httplib")
+multiprocessing = LazyModule("multiprocessing")
+shutil = LazyModule("shutil")
+urllib = LazyModule("urllib")
+urllib2 = LazyModule("urllib2")
+urlparse = LazyModule("urlparse")
+zipfile = LazyModule("zipfile")
 # zipfile needs zlib available to compress archives.
-import zlib  # pylint: disable=unused-import
+zlib = LazyModule("zlib")
+
+
+__version__ = "1.1.0"
+
+
+# Add any URLs to nefarious file lists
+# format like this
+# NEFARIOUS_FILE_SOURCES = ["https://blah.com/tacos.adf",
+#                           "https://blah.com/more-tacos.adf"]
+# URLs ending in ".json" are bundles of ADFs (see make_bundle.py).
+
+# Included for historical reasons: see note at top.
+NEFARIOUS_FILE_SOURCES = []
+ADF_FILE_SOURCES = []
+
+# Include Apple's identified Adware files by default.
+# https://support.apple.com/en-us/ht203987
+HT203987_URL = "https://raw.githubusercontent.com/SavingThrows/AdwareDefinitionFiles/master/Apple-HT203987.adf"  # pylint: disable=line-too-long
+NEFARIOUS_FILE_SOURCES.append(HT203987_URL)
+
+ADF_FILE_SOURCES.extend(NEFARIOUS_FILE_SOURCES)
+
+CACHE = "/Library/Application Support/SavingThrow"
+
+# A source whose URL ends in ".json" is the index manifest of a bundle
+# of ADFs (see FileController.fetch_bundle), which is cached in a
+# folder holding the manifest, as BUNDLE_INDEX, and its ADFs. When more
+# than BUNDLE_DELTA_LIMIT of the ADFs have changed, the bundle's
+# archive is downloaded instead of each changed ADF.
+BUNDLE_FORMAT = 1
+BUNDLE_INDEX = "index.json"
+BUNDLE_DELTA_LIMIT = 8
+
+# Number of seconds a cached ADF is considered fresh. Within this
+# window, SavingThrow won't even ask the server whether the ADF has
+# changed, and when every ADF is fresh, Apps are built straight from
+# the stored rules (see FileController.add_apps_from_store), so
+# frequent runs (e.g. as an extension attribute at every inventory)
+# don't touch the network at all. 0 always revalidates with the
+# server.
+CACHE_MAX_AGE = 3600
+
+# ADFs are downloaded concurrently by this many threads. Each request
+# times out after FETCH_TIMEOUT seconds, and any ADF not downloaded
+# within FETCH_DEADLINE seconds of starting falls back to its cached
+# copy.
+FETCH_THREADS = 8
+FETCH_TIMEOUT = 30
+FETCH_DEADLINE = 60
+
+# Files smaller than QUARANTINE_CHUNK bytes are compressed for the
+# quarantine archive by QUARANTINE_THREADS worker threads. Larger files
+# are streamed straight into the archive.
+QUARANTINE_THREADS = 2
+QUARANTINE_CHUNK = 8 * 1024 * 1024
+
+# Locations of system-level launchd config files. Per-user
+# LaunchAgents folders are recognized too.
+LAUNCHD_CONFIG_LOCATIONS = {"/Library/LaunchAgents",
+                            "/Library/LaunchDaemons",
+                            "/System/Library/LaunchAgents",
+                            "/System/Library/LaunchDaemons"}
+
+# launchctl command, and the number of seconds to let each call run.
+LAUNCHCTL = "launchctl"
+LAUNCHCTL_TIMEOUT = 30
+
+# Number of seconds processes are given to exit after SIGTERM before
+# they are sent SIGKILL.
+KILL_WAIT = 5
+
+# Found files and directories are deleted by REMOVE_THREADS worker
+# threads, taking turns between the filesystems they are on.
+REMOVE_THREADS = 4
+
+# Log messages less severe than this syslog level are dropped (-v
+# logs everything). Messages are buffered, and written out every
+# LOG_FLUSH_INTERVAL seconds, or once LOG_BUFFER_SIZE are waiting.
+LOG_LEVEL = syslog.LOG_INFO
+LOG_FLUSH_INTERVAL = 1
+LOG_BUFFER_SIZE = 200
+LOG_LEVEL_NAMES = {syslog.LOG_DEBUG: "debug", syslog.LOG_INFO: "info",
+                   syslog.LOG_NOTICE: "notice",
+                   syslog.LOG_WARNING: "warning", syslog.LOG_ERR: "error",
+                   syslog.LOG_ALERT: "alert"}
+
+# TestedFile contents are read SCAN_CHUNK bytes at a time, searching
+# each chunk together with the last SCAN_OVERLAP bytes of the previous
+# one, so longer matches may be missed at chunk boundaries. At most
+# SCAN_MAX_BYTES of each file are searched. Files with a NUL byte in
+# their first SCAN_SNIFF_BYTES are treated as binary, and skipped.
+SCAN_MAX_BYTES = 16 * 1024 * 1024
+SCAN_CHUNK = 1024 * 1024
+SCAN_OVERLAP = 64 * 1024
+SCAN_SNIFF_BYTES = 8192
+
+# Files checked against TestedFile Hashes are hashed HASH_CHUNK bytes
+# at a time, HASH_THREADS files at once. Digests are kept in the
+# CACHE, so unchanged files aren't hashed again.
+HASH_THREADS = 4
+HASH_CHUNK = 1024 * 1024
+
+# Deepest a TestedFile Path's depth attribute may reach.
+PATH_MAX_DEPTH = 10
+
+# Version of the compiled rule format (see parse_app_element). Stored
+# rules in another format are recompiled.
+RULES_FORMAT = 5
+
+# Resident mode (--daemon) serves findings on DAEMON_SOCKET, in the
+# CACHE. Where inotify isn't available, watched folders and files are
+# checked for changes every DAEMON_POLL_INTERVAL seconds. The process
+# table is refreshed every DAEMON_PROCESS_INTERVAL seconds, and ADFs
+# are updated every DAEMON_RELOAD_INTERVAL seconds. Queries give up
+# after DAEMON_QUERY_TIMEOUT seconds.
+DAEMON_SOCKET = "daemon.sock"
+DAEMON_POLL_INTERVAL = 5
+DAEMON_PROCESS_INTERVAL = 10
+DAEMON_RELOAD_INTERVAL = 3600
+DAEMON_QUERY_TIMEOUT = 5
+
+# With --time-budget, downloading ADFs may use up to this fraction of
+# the budget before cached copies are used instead, and searching
+# stops this fraction of the budget before it ends, leaving time to
+# write the report.
+TIME_BUDGET_FETCH_SHARE = 0.25
+TIME_BUDGET_RESERVE = 0.1
+
+# Names under which non-App work is measured by Stats.
+PHASES = ("load", "plan", "remove", "quarantine", "kill")
+
+# Number of slowest rules to log when collecting stats.
+STATS_TOP_RULES = 10
+
+# Placeholder result for work which missed its deadline.
+UNFINISHED = object()
+
+# Regexes compiled so far this run (see compile_regex).
+_COMPILED_REGEXEN = {}
+
+# Rules and options for worker processes searching roots (see
+# init_root_worker).
+_ROOT_WORKER = {}
+
+# Folders resolved inside roots so far, keyed by (root, path) (see
+# rebase). Symlinks are followed at most ROOT_MAX_LINKS times per
+# lookup, as the kernel would.
+_ROOT_FOLDERS = {}
+ROOT_MAX_LINKS = 40
+
+
+class SyslogSink(object):
+    """Sends log messages to the syslog."""
+
+    console = False
+
+    def write(self, records):
+        """Log each (level, message) record."""
+        for level, message in records:
+            syslog.syslog(level, to_str(message))
+
+    def close(self):
+        """Nothing to close."""
+        pass
+
+
+class StreamSink(object):
+    """Writes log messages to a stream, one per line.
+
+    Attributes:
+        stream: File-like object to write to.
+        console: Whether this sink is the console (see Logger.log).
+    """
+
+    def __init__(self, stream, console=True):
+        """Initialize a sink writing to stream."""
+        self.stream = stream
+        self.console = console
+
+    def write(self, records):
+        """Write each (level, message) record."""
+        self.stream.write("".join(self.format(level, to_str(message)) for
+                                  level, message in records))
+        self.stream.flush()
+
+    def format(self, _, message):
+        """Return the line to write for a message."""
+        return "%s\n" % message.rstrip("\n")
+
+    def close(self):
+        """Nothing to close; the stream belongs to someone else."""
+        pass
+
+
+class FileSink(StreamSink):
+    """Appends timestamped log messages to a file."""
+
+    def __init__(self, path):
+        """Open path for appending."""
+        super(FileSink, self).__init__(open(path, "a"), console=False)
+
+    def format(self, level, message):
+        """Prefix the message with the time and level."""
+        return "%s %s: %s\n" % (time.strftime("%Y-%m-%d %H:%M:%S"),
+                                 LOG_LEVEL_NAMES.get(level, level),
+                                 message.rstrip("\n"))
+
+    def close(self):
+        """Close the file."""
+        self.stream.close()
+
+
+class Logger(object):
+    """Buffered, leveled logging with shared state.
+
+    Messages below the threshold level are dropped. The rest are
+    buffered, and written to every sink in batches by a background
+    thread: every LOG_FLUSH_INTERVAL seconds, or sooner once
+    LOG_BUFFER_SIZE messages are waiting. The buffer is also flushed
+    at exit, so nothing is lost.
+
+    Attributes:
+        verbose: Whether messages are printed to stdout.
+        threshold: Least severe syslog level which is logged.
+        sinks: List of sinks (see SyslogSink) messages are sent to.
+    """
+
+    verbose = False
+    threshold = LOG_LEVEL
+    sinks = [SyslogSink()]
+    _buffer = []
+    _lock = threading.Lock()
+    _flush_lock = threading.Lock()
+    _wakeup = threading.Event()
+    _flusher = None
+    _closing = False
+
+    @classmethod
+    def enable_verbose(cls):
+        """Print to stdout too, and log everything."""
+        if not cls.verbose:
+            cls.verbose = True
+            cls.threshold = syslog.LOG_DEBUG
+            cls.add_sink(StreamSink(sys.stdout))
+
+    @classmethod
+    def set_threshold(cls, level):
+        """Set the least severe level which is logged."""
+        cls.threshold = level
+
+    @classmethod
+    def add_sink(cls, sink):
+        """Send messages to sink as well."""
+        cls.flush()
+        cls.sinks.append(sink)
+
+    @classmethod
+    def log(cls, message, log_level=syslog.LOG_ALERT, console=True):
+        """Log a message, if it is at least as severe as the threshold.
+
+        Args:
+            message: String to log.
+            log_level: syslog level of the message.
+            console: Whether verbose output should include the message.
+                Pass False for messages that are also being printed
+                some other way.
+        """
+        if log_level > cls.threshold:
+            return
+        with cls._lock:
+            cls._buffer.append((log_level, message, console))
+            if cls._flusher is None:
+                cls._flusher = threading.Thread(target=cls._flush_forever)
+                cls._flusher.daemon = True
+                cls._flusher.start()
+                atexit.register(cls.close)
+            if len(cls._buffer) >= LOG_BUFFER_SIZE:
+                cls._wakeup.set()
+
+    @classmethod
+    def flush(cls):
+        """Write all buffered messages to the sinks now."""
+        with cls._flush_lock:
+            with cls._lock:
+                records, cls._buffer = cls._buffer, []
+            if not records:
+                return
+            for sink in cls.sinks:
+                try:
+                    sink.write([(level, message) for level, message, console
+                                in records if console or not sink.console])
+                except (IOError, OSError):
+                    # Logging must never stop a scan.
+                    pass
+
+    @classmethod
+    def close(cls):
+        """Stop the flushing thread, flush, and close all sinks."""
+        if cls._flusher is not None:
+            cls._closing = True
+            cls._wakeup.set()
+            cls._flusher.join()
+        cls.flush()
+        for sink in cls.sinks:
+            sink.close()
+
+    @classmethod
+    def after_fork(cls):
+        """Start afresh in a forked child process.
+
+        The parent's flushing thread doesn't exist in the child, and
+        its locks may have been held at the time of the fork.
+        """
+        cls._buffer = []
+        cls._lock = threading.Lock()
+        cls._flush_lock = threading.Lock()
+        cls._wakeup = threading.Event()
+        cls._flusher = None
+        cls._closing = False
+
+    @classmethod
+    def _flush_forever(cls):
+        """Flush the buffer periodically, or whenever it fills up."""
+        while not cls._closing:
+            cls._wakeup.wait(LOG_FLUSH_INTERVAL)
+            cls._wakeup.clear()
+            cls.flush()
+
+
+class Stats(object):
+    """Timing and I/O counters, per App and per rule.
+
+    Like Logger, all Stats share their state. Work is attributed to
+    whatever is being measured in the current thread (see measure);
+    counting while nothing is being measured, or while Stats are not
+    enabled, does nothing.
+
+    Attributes:
+        counters: Names of everything counted.
+        enabled: Whether stats are being collected.
+    """
+
+    counters = ("seconds", "dirs_listed", "files_stated", "bytes_read",
+                "regex_evaluations", "subprocesses")
+    enabled = False
+    _records = {}
+    _order = []
+    _lock = threading.Lock()
+    _local = threading.local()
+
+    @classmethod
+    def enable(cls):
+        """Start collecting stats."""
+        cls.enabled = True
+
+    @classmethod
+    def reset(cls):
+        """Throw away all collected stats."""
+        with cls._lock:
+            cls._records = {}
+            cls._order = []
+
+    @classmethod
+    @contextlib.contextmanager
+    def measure(cls, name, rule=None):
+        """Context manager attributing the work done within it.
+
+        Measurements nest: work done while measuring a rule is also
+        counted against its App (or phase).
+
+        Args:
+            name: Name of the App, or of a phase like "remove".
+            rule: Optional description of one of the App's rules.
+        """
+        if not cls.enabled:
+            yield
+            return
+        key = (name, rule)
+        with cls._lock:
+            record = cls._record(key)
+        stack = cls._stack()
+        stack.append([(record, 1)])
+        start = time.time()
+        try:
+            yield
+        finally:
+            stack.pop()
+            record["seconds"] += time.time() - start
+
+    @classmethod
+    @contextlib.contextmanager
+    def share(cls, keys):
+        """Context manager splitting the work done within it by rule.
+
+        For work done on behalf of several rules at once, e.g.
+        listing a directory which globs of several Apps point into.
+        Its counts go to each rule (and its App) in equal shares,
+        instead of to whatever is being measured. Its time doesn't.
+
+        Args:
+            keys: Iterable of (App name, rule description) tuples.
+        """
+        if not cls.enabled:
+            yield
+            return
+        keys = sorted(set(keys))
+        if not keys:
+            yield
+            return
+        weight = 1.0 / len(keys)
+        records = []
+        with cls._lock:
+            for name, rule in keys:
+                records.append((cls._record((name, None)), weight))
+                records.append((cls._record((name, rule)), weight))
+        stack = cls._stack()
+        saved = stack[:]
+        stack[:] = [records]
+        try:
+            yield
+        finally:
+            stack[:] = saved
+
+    @classmethod
+    def prepare(cls, keys):
+        """Create records for keys, so they are reported in that order.
+
+        Args:
+            keys: Iterable of (name, rule description) tuples.
+        """
+        if not cls.enabled:
+            return
+        with cls._lock:
+            for name, rule in keys:
+                cls._record((name, None))
+                cls._record((name, rule))
+
+    @classmethod
+    def _record(cls, key):
+        """Return the record for key, creating it if need be.
+
+        Call with _lock held.
+        """
+        if key not in cls._records:
+            cls._records[key] = {counter: 0 for counter in cls.counters}
+            cls._order.append(key)
+        return cls._records[key]
+
+    @classmethod
+    def count(cls, counter, amount=1):
+        """Add amount to counter for everything being measured."""
+        if not cls.enabled:
+            return
+        for records in cls._stack():
+            for record, weight in records:
+                record[counter] += amount * weight
+
+    @classmethod
+    def _stack(cls):
+        """Return this thread's stack of records being measured."""
+        if not hasattr(cls._local, "stack"):
+            cls._local.stack = []
+        return cls._local.stack
+
+    @classmethod
+    def report(cls):
+        """Return all collected stats as a dict, for json.
+
+        Returns:
+            Dict with "phases" (dict of phase names to counters) and
+            "apps" (list of dicts with "name", counters, and "rules": a
+            list of dicts with "rule" and counters), in the order
+            they were first measured. Counts shared between rules
+            (see share) may be fractional.
+        """
+        apps = []
+        by_name = {}
+        phases = {}
+        for name, rule in cls._order:
+            record = cls._copy((name, rule))
+            if rule is None:
+                by_name[name] = record
+                record["name"] = name
+                record["rules"] = []
+        for name, rule in cls._order:
+            if rule is not None:
+                record = cls._copy((name, rule))
+                record["rule"] = rule
+                by_name.setdefault(name, {"name": name, "rules": []})
+                by_name[name]["rules"].append(record)
+        for name, rule in cls._order:
+            if rule is None:
+                if by_name[name]["rules"] or name not in PHASES:
+                    apps.append(by_name[name])
+                else:
+                    phases[name] = by_name[name]
+                    del phases[name]["rules"]
+                    del phases[name]["name"]
+        return {"phases": phases, "apps": apps}
+
+    @classmethod
+    def _copy(cls, key):
+        """Return a copy of key's record, with shared counts rounded."""
+        return {counter: round(value, 3) if isinstance(value, float) and
+                counter != "seconds" else value for counter, value in
+                cls._records[key].items()}
+
+    @classmethod
+    def slowest_rules(cls, count=10):
+        """Return the count slowest (name, rule, record) triples."""
+        rules = [(name, rule, cls._records[(name, rule)]) for name, rule in
+                 cls._order if rule is not None]
+        rules.sort(key=lambda item: item[2]["seconds"], reverse=True)
+        return rules[:count]
+
+    @classmethod
+    def log_slowest_rules(cls, count=10):
+        """Log a summary of the count slowest rules."""
+        logger = Logger()
+        for rank, (name, rule, record) in enumerate(
+                cls.slowest_rules(count), 1):
+            logger.log("Slow rule %s: %s: %s (%.3fs, %s dirs listed, %s "
+                       "files stat'ed, %s bytes read, %s regex "
+                       "evaluations, %s subprocesses)" % (
+                           rank, name, rule, record["seconds"],
+                           record["dirs_listed"], record["files_stated"],
+                           record["bytes_read"], record["regex_evaluations"],
+                           record["subprocesses"]))
+
+
+class DirectoryIndex(object):
+    """Per-run cache of directory listings, used to answer globs.
+
+    Each directory is listed at most once per run, no matter how many
+    Apps have rules pointing into it. Globs and Path lookups are then
+    answered from memory, following the same rules as glob.glob.
+    Recursive Path lookups share one walk of each root, planned ahead
+    (see plan_walk) to go as deep as the deepest rule needs, and
+    globs can be answered in bulk ahead of time (see plan_globs).
+
+    Attributes:
+        root: Folder which paths are looked up relative to, or None
+            for "/". Paths given to, and returned by, the index are
+            always as they would be on the system being searched.
+        hits: Count of lookups answered from memory.
+        misses: Count of lookups which had to go to the filesystem.
+    """
+
+    def __init__(self, root=None):
+        """Initialize an empty index.
+
+        Args:
+            root: Optional folder holding the filesystem to search,
+                e.g. a mounted disk image or a backup snapshot.
+        """
+        self.root = root
+        self._listings = {}
+        self._isdir = {}
+        self._islink = {}
+        self._exists = {}
+        self._plans = {}
+        self._walks = {}
+        self._globs = {}
+        self._heads = {}
+        self._matchers = {}
+        self._walk_lock = threading.Lock()
+        self._count_lock = threading.Lock()
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+
+    def _count(self, counter):
+        """Add one to the hits or misses counter.
+
+        Lookups come from the --jobs worker threads, so the counters
+        are updated under a lock of their own (_walk_lock is held
+        while listing directories, and isn't reentrant).
+        """
+        with self._count_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def start_tracking(self):
+        """Start recording the directories looked at by this thread."""
+        self._local.dependencies = set()
+
+    def stop_tracking(self):
+        """Stop recording, and return the set of directories seen.
+
+        Those are the directories whose modification would change
+        the answers given since start_tracking was called.
+        """
+        dependencies = getattr(self._local, "dependencies", None)
+        self._local.dependencies = None
+        return dependencies or set()
+
+    def _depend(self, directory):
+        """Record directory as looked at, if tracking."""
+        dependencies = getattr(self._local, "dependencies", None)
+        if dependencies is not None:
+            dependencies.add(directory)
+
+    def listdir(self, path):
+        """Return a list of the names in directory path.
+
+        Unreadable or missing directories are cached as empty.
+        """
+        self._depend(path)
+        if path in self._listings:
+            self._count("hits")
+            return self._listings[path]
+
+        self._count("misses")
+        Stats.count("dirs_listed")
+        names = []
+        try:
+            if scandir is not None:
+                for entry in scandir(rebase(self.root, path)):
+                    names.append(entry.name)
+                    child = os.path.join(path, entry.name)
+                    try:
+                        self._islink[child] = entry.is_symlink()
+                        # Under a root, symlinks have to be resolved
+                        # within it (see rebase) to tell.
+                        if self.root is None or not self._islink[child]:
+                            self._isdir[child] = entry.is_dir()
+                    except OSError:
+                        pass
+            else:
+                names = os.listdir(rebase(self.root, path))
+        except OSError:
+            names = []
+        self._listings[path] = names
+        return names
+
+    def isdir(self, path):
+        """Return whether path is a directory, following symlinks."""
+        self._depend(os.path.dirname(path))
+        if path in self._isdir:
+            self._count("hits")
+        else:
+            self._count("misses")
+            Stats.count("files_stated")
+            try:
+                self._isdir[path] = os.path.isdir(rebase(self.root, path))
+            except OSError:
+                self._isdir[path] = False
+        return self._isdir[path]
+
+    def islink(self, path):
+        """Return whether path is a symlink."""
+        self._depend(os.path.dirname(path))
+        if path in self._islink:
+            self._count("hits")
+        else:
+            self._count("misses")
+            Stats.count("files_stated")
+            try:
+                self._islink[path] = os.path.islink(rebase(self.root, path,
+                                                           False))
+            except OSError:
+                self._islink[path] = False
+        return self._islink[path]
+
+    def lexists(self, path):
+        """Return whether path exists, without following symlinks."""
+        self._depend(os.path.dirname(path))
+        if path in self._exists:
+            self._count("hits")
+            return self._exists[path]
+
+        parent, name = os.path.split(path)
+        if parent in self._listings and name in self._listings[parent]:
+            self._count("hits")
+            result = True
+        else:
+            # Not found verbatim; the filesystem may still be case
+            # insensitive, so ask it.
+            self._count("misses")
+            Stats.count("files_stated")
+            try:
+                result = os.path.lexists(rebase(self.root, path, False))
+            except OSError:
+                result = False
+        self._exists[path] = result
+        return result
+
+    def glob(self, pattern):
+        """Return a list of paths matching pattern, like glob.glob."""
+        planned = self._globs.get(pattern)
+        if planned is not None:
+            self._count("hits")
+            for directory in planned[1]:
+                self._depend(directory)
+            return list(planned[0])
+        return list(self.iglob(pattern))
+
+    def plan_globs(self, patterns, requesters=None):
+        """Answer many glob patterns at once, ahead of glob calls.
+
+        The patterns' path components form a trie, which is walked
+        once from "/": each directory is listed at most once, and its
+        names are matched against all of the wildcard components
+        pointing into it with one combined regex. The answers, and the
+        directories they depend on, are kept for glob to return.
+
+        Relative patterns, patterns with empty components (e.g. a
+        trailing slash), and patterns already answered are left to be
+        globbed as usual.
+
+        Args:
+            patterns: Iterable of glob patterns.
+            requesters: Optional dict of patterns to lists of the
+                (App name, rule description) tuples of the rules they
+                are for. Each lookup is credited to the rules whose
+                patterns needed it in Stats (see Stats.share).
+        """
+        answers = {}
+        items = []
+        for pattern in patterns:
+            components = pattern.split(os.sep)[1:]
+            if (pattern in self._globs or pattern in answers or not
+                    os.path.isabs(pattern) or "" in components):
+                continue
+            answers[pattern] = ([], set())
+            items.append((pattern, components))
+        if items:
+            self._plan(os.sep, items, answers, requesters or {})
+        with self._walk_lock:
+            self._globs.update(answers)
+
+    def _plan(self, directory, items, answers, requesters):
+        """Answer the rest of items' patterns, from directory.
+
+        Args:
+            directory: Directory the remaining components are in.
+            items: List of (pattern, list of remaining components).
+            answers: Dict of pattern: (list of matches, set of
+                directories depended on) to add to.
+            requesters: Dict of patterns to the rules they are for,
+                as for plan_globs.
+        """
+        def credit(patterns):
+            """Return a context crediting lookups for patterns."""
+            return Stats.share(key for pattern in patterns for key in
+                               requesters.get(pattern, ()))
+
+        literal = {}
+        wild = []
+        for pattern, components in items:
+            answers[pattern][1].add(directory)
+            head, rest = components[0], components[1:]
+            if glob.has_magic(head):
+                wild.append((pattern, head, rest))
+            else:
+                literal.setdefault(head, []).append((pattern, rest))
+
+        for name, entries in literal.items():
+            path = os.path.join(directory, name)
+            ending = [pattern for pattern, rest in entries if not rest]
+            deeper = [(pattern, rest) for pattern, rest in entries if rest]
+            if ending:
+                with credit(ending):
+                    exists = self.lexists(path)
+                if exists:
+                    for pattern in ending:
+                        answers[pattern][0].append(path)
+            if deeper:
+                with credit(pattern for pattern, _ in deeper):
+                    is_dir = self.isdir(path)
+                if is_dir:
+                    self._plan(path, deeper, answers, requesters)
+
+        if not wild:
+            return
+        # As with glob, only patterns starting with "." match hidden
+        # names.
+        hidden = [entry for entry in wild if entry[1][0] == "."]
+        visible = [entry for entry in wild if entry[1][0] != "."]
+        matchers = {True: self._matcher(hidden),
+                    False: self._matcher(visible)}
+        with credit(pattern for pattern, _, _ in wild):
+            names = self.listdir(directory)
+        for name in names:
+            is_hidden = name[0] == "."
+            combined, entries = matchers[is_hidden]
+            if combined is None or not combined.match(name):
+                continue
+            path = os.path.join(directory, name)
+            deeper = []
+            for pattern, head, rest in entries:
+                if not self._head_regex(head).match(name):
+                    continue
+                if rest:
+                    deeper.append((pattern, rest))
+                else:
+                    answers[pattern][0].append(path)
+            if not deeper:
+                continue
+            with credit(pattern for pattern, _ in deeper):
+                is_dir = self.isdir(path)
+            if is_dir:
+                self._plan(path, deeper, answers, requesters)
+
+    def _head_regex(self, head):
+        """Return a compiled regex for the wildcard component head."""
+        regex = self._heads.get(head)
+        if regex is None:
+            regex = self._heads[head] = re.compile(fnmatch.translate(head))
+        return regex
+
+    def _matcher(self, entries):
+        """Return a combined regex for entries' components, and entries.
+
+        The regex matches any name matched by one of the wildcard
+        components; None if there are none.
+        """
+        heads = tuple(sorted({head for _, head, _ in entries}))
+        if heads not in self._matchers:
+            # Strip the global flags fnmatch appends, so the
+            # translations can be joined.
+            self._matchers[heads] = re.compile("(?ms)(?:%s)" % "|".join(
+                fnmatch.translate(head).replace("(?ms)", "") for head in
+                heads)) if heads else None
+        return self._matchers[heads], entries
+
+    def iglob(self, pattern):
+        """Yield paths matching pattern, like glob.iglob."""
+        dirname, basename = os.path.split(pattern)
+        if not glob.has_magic(pattern):
+            if basename:
+                if self.lexists(pattern):
+                    yield pattern
+            elif self.isdir(dirname):
+                yield pattern
+            return
+
+        if not dirname:
+            dirs = [""]
+        elif dirname != pattern and glob.has_magic(dirname):
+            dirs = self.iglob(dirname)
+        else:
+            dirs = [dirname]
+
+        for directory in dirs:
+            if glob.has_magic(basename):
+                names = self.listdir(directory or os.curdir)
+                if basename[0] != ".":
+                    names = [name for name in names if name[0] != "."]
+                names = fnmatch.filter(names, basename)
+            elif basename:
+                names = ([basename] if
+                         self.lexists(os.path.join(directory, basename))
+                         else [])
+            else:
+                names = [basename] if self.isdir(directory) else []
+            for name in names:
+                yield os.path.join(directory, name)
+
+    def children(self, path):
+        """Return the set of paths directly contained in path.
+
+        path may use globbing characters. Hidden files are included.
+        """
+        results = set()
+        for pattern in ("*", ".*"):
+            results.update(self.glob(os.path.join(path, pattern)))
+        return results
+
+    def clear(self):
+        """Forget everything but the planned walks."""
+        with self._walk_lock:
+            for cache in (self._listings, self._isdir, self._islink,
+                          self._exists, self._walks, self._globs):
+                cache.clear()
+
+    def invalidate(self, path):
+        """Forget everything known about path, and what's in it."""
+        with self._walk_lock:
+            self._listings.pop(path, None)
+            for cache in (self._isdir, self._islink, self._exists):
+                cache.pop(path, None)
+                for cached in [cached for cached in cache if
+                               os.path.dirname(cached) == path]:
+                    del cache[cached]
+            # Walks are rebuilt cheaply from the remaining listings.
+            self._walks.clear()
+            parent = os.path.dirname(path)
+            for pattern, (_, directories) in self._globs.items():
+                if path in directories or parent in directories:
+                    del self._globs[pattern]
+
+    def plan_walk(self, path, depth, excludes=()):
+        """Declare that descendants(path, depth, excludes) will be used.
+
+        Call for every recursive Path before any are looked up, so
+        that path is walked once, as deep as the deepest rule needs,
+        and subtrees every rule excludes aren't walked at all.
+        """
+        planned_depth, common = self._plans.get(path, (0, None))
+        excludes = frozenset(excludes)
+        self._plans[path] = (max(planned_depth, depth), excludes if
+                             common is None else common & excludes)
+
+    def descendants(self, path, depth=1, excludes=()):
+        """Return the set of paths up to depth levels below path.
+
+        A depth of 1 is the same as children. Deeper levels don't
+        descend into symlinks, nor into subtrees whose paths match
+        one of excludes.
+
+        Args:
+            path: Directory to look in. May use globbing characters.
+            depth: Number of levels to include.
+            excludes: Iterable of glob patterns of paths to leave out,
+                along with everything below them.
+
+        Returns:
+            Set of paths. Hidden files are included.
+        """
+        if depth <= 1 and not excludes:
+            return self.children(path)
+        walk_depth, prune = self._plans.get(path, (depth, excludes))
+        walk_depth = max(walk_depth, depth)
+        prune = frozenset(prune) & frozenset(excludes)
+        results = set()
+        for root in self.glob(path):
+            if not self.isdir(root):
+                continue
+            entries, directories = self._walk(root, walk_depth, prune)
+            for directory, level in directories:
+                if level < depth:
+                    self._depend(directory)
+            for entry, level in entries:
+                if level <= depth and not (excludes and self._excluded(
+                        root, entry, excludes)):
+                    results.add(entry)
+        return results
+
+    def _walk(self, root, depth, prune):
+        """Walk root breadth first, down to depth levels.
+
+        Returns:
+            Tuple of lists of (path, level) for the entries found,
+            and the directories listed (root is level 0).
+        """
+        key = (root, prune)
+        with self._walk_lock:
+            if key in self._walks and self._walks[key][0] >= depth:
+                return self._walks[key][1:]
+            entries = []
+            directories = []
+            level = [root]
+            for current in xrange(1, depth + 1):
+                deeper = []
+                for directory in level:
+                    directories.append((directory, current - 1))
+                    for name in self.listdir(directory):
+                        child = os.path.join(directory, name)
+                        entries.append((child, current))
+                        if (current < depth and self.isdir(child) and not
+                                self.islink(child) and not (prune and any(
+                                    fnmatch.fnmatch(child, pattern) for
+                                    pattern in prune))):
+                            deeper.append(child)
+                level = deeper
+            self._walks[key] = (depth, entries, directories)
+        return entries, directories
+
+    @staticmethod
+    def _excluded(root, path, excludes):
+        """Return whether path, or a folder above it, is excluded."""
+        while len(path) > len(root):
+            if any(fnmatch.fnmatch(path, pattern) for pattern in excludes):
+                return True
+            path = os.path.dirname(path)
+        return False
+
+    def stats(self):
+        """Return a dict of the index's counters."""
+        return {"hits": self.hits, "misses": self.misses,
+                "directories": len(self._listings)}
+
+
+class ProcessTable(object):
+    """Snapshot of the running processes, indexed by name.
+
+    The table is captured once, on first use, and shared by all Apps,
+    rather than running pgrep for every Process element.
+
+    Attributes:
+        snapshots: Count of times the process table was read.
+    """
+
+    def __init__(self, table=None):
+        """Initialize a table; it is filled on first lookup.
+
+        Args:
+            table: Optional dict of process names to lists of PIDs, to
+                use instead of the running processes (e.g. an empty
+                one, when searching a root other than "/").
+        """
+        self._table = table
+        self._lock = threading.Lock()
+        self.snapshots = 0
+
+    def refresh(self):
+        """(Re)capture the process table.
+
+        On Linux, /proc is read directly. Otherwise, a single ps call
+        is made. Names are the bare executable names, as matched by
+        pgrep.
+        """
+        table = {}
+        if os.path.isdir("/proc/self"):
+            for pid in os.listdir("/proc"):
+                if not pid.isdigit():
+                    continue
+                try:
+                    with open("/proc/%s/comm" % pid, "r") as comm:
+                        name = comm.read().rstrip("\n")
+                except IOError:
+                    # Process exited while we were looking.
+                    continue
+                table.setdefault(name, []).append(pid)
+        else:
+            Stats.count("subprocesses")
+            try:
+                output = subprocess.check_output(
+                    ["ps", "-axco", "pid=,command="])
+            except (OSError, subprocess.CalledProcessError) as error:
+                Logger().log("Unable to list processes: %s" % error)
+                output = ""
+            for line in output.splitlines():
+                try:
+                    pid, name = line.strip().split(None, 1)
+                except ValueError:
+                    continue
+                table.setdefault(name, []).append(pid)
+
+        # Exclude ourselves, as pgrep does.
+        own_pid = str(os.getpid())
+        for pids in table.values():
+            if own_pid in pids:
+                pids.remove(own_pid)
+
+        self._table = table
+        self.snapshots += 1
+
+    def pids(self, name):
+        """Return a list of PIDs (as strings) for processes named name.
+
+        Names must match exactly.
+        """
+        if self._table is None:
+            with self._lock:
+                # Another thread may have beaten us to it.
+                if self._table is None:
+                    self.refresh()
+        return list(self._table.get(name, []))
+
+
+class ContentScanner(object):
+    """Searches file contents for TestedFile Regexes.
+
+    Search results (not contents) are cached under a (path, inode,
+    mtime, size) key, and all patterns registered against a file (see
+    register, and FileController.plan_contents) are searched for in
+    the same pass, so a file referenced by many rules, of any number
+    of Apps, is read once. Patterns are merged into one regex of named
+    lookahead groups and searched together, and ReplacementKey groups
+    are captured from that same pass.
+
+    Files are read SCAN_CHUNK bytes at a time, and each chunk is
+    searched along with the last SCAN_OVERLAP bytes of the one before,
+    so matches shorter than that are found even across chunk
+    boundaries. Anchors only match at the real start and end of the
+    file, not of a chunk. No more than SCAN_MAX_BYTES of a file are
+    searched. Directories, other non-regular files and binaries are
+    skipped.
+
+    Attributes:
+        reads: Count of files read from disk.
+        bytes_read: Total bytes read from disk.
+        hits: Count of searches answered from the cache.
+        skipped: Dict of paths which weren't (fully) searched, with
+            the reason why.
+        root: Folder which paths are relative to, or None for "/"
+            (see DirectoryIndex).
+        digest_cache: DigestCache for the SHA-256 digests of files.
+    """
+
+    # Backreferences and global inline flags change meaning when a
+    # pattern is embedded in a larger one. Such patterns are searched
+    # on their own.
+    _UNMERGEABLE = re.compile(r"\\[1-9]|\(\?P=|\(\?[iLmsux]+\)")
+
+    # Patterns which may only match at the end of the text.
+    _END_ANCHORED = re.compile(r"\$|\\Z")
+
+    def __init__(self, root=None, digest_cache=None):
+        """Initialize an empty scanner for files under root.
+
+        Args:
+            root: Optional folder which paths are relative to.
+            digest_cache: Optional DigestCache. If omitted, the
+                scanner gets one of its own.
+        """
+        self.root = root
+        self.digest_cache = (digest_cache if digest_cache is not None else
+                             DigestCache())
+        self._results = {}
+        self._pending = {}
+        self._combined = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._file_locks = {}
+        self.reads = 0
+        self.bytes_read = 0
+        self.hits = 0
+        self.skipped = {}
+
+    @staticmethod
+    def file_key(path, root=None):
+        """Return a cache key for path's current contents, or None."""
+        Stats.count("files_stated")
+        try:
+            stat = os.stat(rebase(root, path))
+        except OSError:
+            return None
+        return (path, stat.st_ino, stat.st_mtime, stat.st_size)
+
+    def start_tracking(self):
+        """Start recording the files searched by this thread."""
+        self._local.files = {}
+
+    def stop_tracking(self):
+        """Stop recording, and return a dict of files searched.
+
+        Maps each path to its cache key (see file_key) at the time
+        it was searched.
+        """
+        files = getattr(self._local, "files", None)
+        self._local.files = None
+        return files or {}
+
+    def export_results(self, before):
+        """Return search verdicts in a form suitable for json.
+
+        Only the latest verdicts for each file are included, and
+        files modified at or after before (give or take a second of
+        mtime resolution) are left out, since they may have changed
+        again without their key changing.
+
+        Returns:
+            Dict mapping paths to dicts with keys "key" (the inode,
+            mtime and size of the file searched), and "results"
+            (dict mapping patterns to lists of groups, or None).
+        """
+        verdicts = {}
+        for (key, pattern), groups in self._results.items():
+            path, file_key = key[0], list(key[1:])
+            if file_key[1] >= before - 1:
+                continue
+            verdict = verdicts.get(path)
+            if verdict is None or verdict["key"][1] < file_key[1]:
+                verdict = verdicts[path] = {"key": file_key, "results": {}}
+            elif verdict["key"] != file_key:
+                continue
+            verdict["results"][pattern] = (list(groups) if groups is not
+                                           None else None)
+        return verdicts
+
+    def import_results(self, verdicts):
+        """Seed the scanner with verdicts from export_results."""
+        for path, verdict in verdicts.items():
+            key = (path,) + tuple(verdict["key"])
+            for pattern, groups in verdict["results"].items():
+                self._results[(key, pattern)] = (tuple(groups) if groups is
+                                                 not None else None)
+
+    def register(self, path, patterns):
+        """Note that patterns will be searched for in path.
+
+        Registered patterns are folded into the first search of path,
+        so one pass over the file answers all of them.
+        """
+        self._pending.setdefault(path, set()).update(patterns)
+
+    def digests(self, paths):
+        """Return the SHA-256 digests of the files at paths.
+
+        Digests come from the digest cache where possible. The rest
+        are computed HASH_THREADS files at a time, reading HASH_CHUNK
+        bytes at a time.
+
+        Args:
+            paths: Iterable of paths.
+
+        Returns:
+            Dict mapping paths to hex digests. Anything but readable
+            regular files is left out.
+        """
+        files = getattr(self._local, "files", None)
+        digests = {}
+        todo = []
+        for path in paths:
+            Stats.count("files_stated")
+            try:
+                location = rebase(self.root, path)
+                status = os.stat(location)
+            except OSError:
+                continue
+            if files is not None:
+                files[path] = (path, status.st_ino, status.st_mtime,
+                               status.st_size)
+            if not stat.S_ISREG(status.st_mode):
+                continue
+            digest = self.digest_cache.get(status)
+            if digest is not None:
+                digests[path] = digest
+            else:
+                todo.append((path, location, status))
+
+        results = map_concurrently(self._hash, [
+            location for _, location, _ in todo], HASH_THREADS)
+        for (path, location, status), digest in zip(todo, results):
+            if digest is not None:
+                digests[path] = digest
+                self.digest_cache.put(status, digest, location)
+                Stats.count("bytes_read", status.st_size)
+        return digests
+
+    @staticmethod
+    def _hash(path):
+        """Return the SHA-256 hex digest of the file at path, or None."""
+        digest = hashlib.sha256()
+        try:
+            with open(path, "rb") as afile:
+                for chunk in iter(lambda: afile.read(HASH_CHUNK), ""):
+                    digest.update(chunk)
+        except IOError as error:
+            Logger().log("Unable to hash %s: %s" % (path, error))
+            return None
+        return digest.hexdigest()
+
+    def _search_file(self, path, patterns):
+        """Read path a chunk at a time, searching for patterns.
+
+        Returns:
+            Dict mapping each matching pattern to its groups.
+        """
+        try:
+            # Don't block opening a FIFO.
+            descriptor = os.open(rebase(self.root, path),
+                                 os.O_RDONLY | os.O_NONBLOCK)
+        except OSError as error:
+            self._skip(path, "unreadable (%s)" % error.strerror,
+                       syslog.LOG_ALERT)
+            return {}
+        mode = os.fstat(descriptor).st_mode
+        if not stat.S_ISREG(mode):
+            os.close(descriptor)
+            self._skip(path, "directory" if stat.S_ISDIR(mode) else
+                       "not a regular file")
+            return {}
+
+        with os.fdopen(descriptor, "rb") as afile:
+            with self._lock:
+                self.reads += 1
+            found = {}
+            remaining = list(patterns)
+            # The tail carries one byte more than the overlap, which
+            # is only there as context: searching from just after it
+            # keeps "^" and "\A" from matching at the start of a
+            # window which isn't the start of the file.
+            tail = ""
+            total = 0
+            deferred = False
+            while remaining and total < SCAN_MAX_BYTES:
+                size = min(SCAN_CHUNK, SCAN_MAX_BYTES - total)
+                try:
+                    chunk = afile.read(size)
+                except IOError as error:
+                    self._skip(path, "unreadable (%s)" % error.strerror,
+                               syslog.LOG_ALERT)
+                    break
+                start = 0 if total == len(tail) else 1
+                if not chunk:
+                    if deferred:
+                        # The file ended right after the last window,
+                        # so end anchors held after all.
+                        found.update(self._scan(tail, remaining, start)[0])
+                    break
+                if not total and self.is_binary(chunk):
+                    self._skip(path, "binary")
+                    break
+                total += len(chunk)
+                with self._lock:
+                    self.bytes_read += len(chunk)
+                Stats.count("bytes_read", len(chunk))
+                window = tail + chunk
+                matches, deferred = self._scan(window, remaining, start,
+                                               len(chunk) < size)
+                found.update(matches)
+                remaining = [pattern for pattern in remaining if pattern
+                             not in matches]
+                tail = window[-(SCAN_OVERLAP + 1):]
+            if remaining and total >= SCAN_MAX_BYTES and afile.read(1):
+                self._skip(path, "only the first %s bytes searched" % total)
+        return found
+
+    @staticmethod
+    def is_binary(chunk):
+        """Return whether chunk looks like the start of a binary file.
+
+        Binary property lists are searched anyway, as their strings
+        are stored as plain text.
+        """
+        return "\0" in chunk[:SCAN_SNIFF_BYTES] and not chunk.startswith(
+            "bplist")
+
+    def _skip(self, path, reason, log_level=syslog.LOG_INFO):
+        """Record, and log, that path wasn't (fully) searched."""
+        self.skipped[path] = reason
+        Logger().log("Not searching contents of %s: %s" % (path, reason),
+                     log_level)
+
+    def search(self, path, patterns):
+        """Search the contents of path for each of patterns.
+
+        Args:
+            path: Path to a file.
+            patterns: Iterable of valid regular expression strings.
+
+        Returns:
+            Dict mapping each matching pattern to the tuple of groups
+            from its first match. Patterns which don't match are
+            omitted.
+        """
+        patterns = list(patterns)
+        key = self.file_key(path, self.root)
+        files = getattr(self._local, "files", None)
+        if files is not None:
+            files[path] = key
+        if key is None:
+            return {}
+
+        # Threads searching the same file wait for the first one's
+        # verdicts, rather than reading it again.
+        with self._lock:
+            file_lock = self._file_locks.setdefault(path, threading.Lock())
+        with file_lock:
+            todo = set(patterns) | self._pending.pop(path, set())
+            todo = [pattern for pattern in todo if (key, pattern) not in
+                    self._results]
+            if todo:
+                Stats.count("regex_evaluations", len(todo))
+                found = self._search_file(path, sorted(todo))
+                for pattern in todo:
+                    self._results[(key, pattern)] = found.get(pattern)
+            else:
+                with self._lock:
+                    self.hits += 1
+
+        results = {}
+        for pattern in patterns:
+            groups = self._results[(key, pattern)]
+            if groups is not None:
+                results[pattern] = groups
+        return results
+
+    def _scan(self, text, patterns, start=0, final=True):
+        """Find the first match of each of patterns in text.
+
+        Args:
+            text: Text to search.
+            patterns: List of regular expression strings.
+            start: Position to search from. Anchors don't match at
+                start unless it is 0, as with re's search.
+            final: Whether text runs to the end of the file. If not,
+                matches of end-anchored patterns which reach the end
+                of text are put off, as they may not hold once the
+                rest of the file is read.
+
+        Returns:
+            Tuple of (dict mapping each matching pattern to its
+            groups, whether any matches were put off).
+        """
+        found = {}
+        deferred = [False]
+
+        def accept(pattern, match):
+            """Record match for pattern, unless it has to wait."""
+            if not match:
+                return False
+            if not final and self._END_ANCHORED.search(pattern) and (
+                    match.end() == len(text) or match.end() ==
+                    len(text) - 1 and text.endswith("\n")):
+                deferred[0] = True
+                return False
+            found[pattern] = match.groups()
+            return True
+
+        merge = [pattern for pattern in patterns if not
+                 self._UNMERGEABLE.search(pattern)]
+        for pattern in patterns:
+            if pattern not in merge:
+                accept(pattern, compile_regex(pattern).search(text, start))
+
+        position = start
+        while merge:
+            if len(merge) == 1:
+                # Nothing to merge with; don't pay for compiling a
+                # combined pattern.
+                accept(merge[0], compile_regex(merge[0]).search(text,
+                                                                position))
+                break
+            combined = self._get_combined(tuple(merge))
+            if combined is None:
+                # Couldn't merge (e.g. duplicate group names), so
+                # search individually.
+                for pattern in merge:
+                    accept(pattern, compile_regex(pattern).search(text,
+                                                                  start))
+                break
+            match = combined.search(text, position)
+            if not match:
+                break
+            # The combined search tells us where the leftmost match
+            # of any remaining pattern starts; collect every pattern
+            # matching there, then keep looking for the rest.
+            position = match.start()
+            matched = [pattern for pattern in merge if accept(
+                pattern, compile_regex(pattern).match(text, position))]
+            for pattern in matched:
+                merge.remove(pattern)
+            if not matched:
+                position += 1
+
+        return found, deferred[0]
+
+    def _get_combined(self, patterns):
+        """Return a compiled alternation of patterns, or None."""
+        if patterns not in self._combined:
+            combined = "|".join("(?=(?P<_st%d>%s))" % (num, pattern) for
+                                num, pattern in enumerate(patterns))
+            try:
+                self._combined[patterns] = re.compile(combined)
+            except (re.error, AssertionError, OverflowError):
+                self._combined[patterns] = None
+        return self._combined[patterns]
+
+    def stats(self):
+        """Return a dict of the scanner's counters."""
+        return {"reads": self.reads, "bytes_read": self.bytes_read,
+                "hits": self.hits, "skipped": len(self.skipped)}
+
+
+class RuleStore(object):
+    """Compiled ADF rules, cached between runs.
+
+    Parsing an ADF and checking its regexes gives the same answer
+    every run until the ADF changes. The results are stored in one
+    JSON file in the CACHE, keyed by the SHA-256 of each ADF's text,
+    and thrown away whenever the SavingThrow version or RULES_FORMAT
+    changes.
+
+    Attributes:
+        path: Path to the store file.
+        hits: Count of ADFs whose rules came from the store.
+        misses: Count of ADFs which had to be parsed.
+    """
+
+    def __init__(self, path=None):
+        """Initialize a store; it is loaded from disk on first use.
+
+        Args:
+            path: Optional path to the store file. Defaults to
+                rules.json in the CACHE.
+        """
+        self.path = path or os.path.join(CACHE, "rules.json")
+        self._adfs = None
+        self._used = set()
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        """Read the store from disk, discarding it if outdated."""
+        self._adfs = {}
+        try:
+            with open(self.path, "r") as store_file:
+                data = json.load(store_file)
+        except (IOError, ValueError):
+            return
+        if (isinstance(data, dict) and data.get("version") == __version__
+                and data.get("format") == RULES_FORMAT):
+            self._adfs = to_str(data.get("adfs", {}))
+
+    def get(self, app_text, source):
+        """Return the compiled rules for an ADF (see compile_adf).
+
+        Args:
+            app_text: String contents of an ADF.
+            source: String URL the ADF came from, for logging.
+
+        Returns:
+            Dict of compiled rules, or None if the ADF is invalid.
+        """
+        digest = hashlib.sha256(app_text).hexdigest()
+        record = self.get_stored(digest)
+        if record is not None:
+            return record
+
+        self.misses += 1
+        record = compile_adf(app_text, source)
+        if record is not None:
+            self._adfs[digest] = record
+            self._dirty = True
+        return record
+
+    def get_stored(self, digest):
+        """Return the stored rules for an ADF, without compiling it.
+
+        Args:
+            digest: SHA-256 hex digest of the ADF's text.
+
+        Returns:
+            Dict of compiled rules, or None if they aren't stored.
+        """
+        if self._adfs is None:
+            self.load()
+        self._used.add(digest)
+        record = self._adfs.get(digest)
+        if record is not None:
+            self.hits += 1
+        return record
+
+    def save(self, prune=False):
+        """Write the store to disk if it has changed.
+
+        Args:
+            prune: Drop any ADFs not used since the store was loaded.
+        """
+        if self._adfs is None:
+            return
+        if prune:
+            unused = set(self._adfs) - self._used
+            for digest in unused:
+                del self._adfs[digest]
+            self._dirty = self._dirty or bool(unused)
+        if not self._dirty:
+            return
+        try:
+            handle, temp_path = tempfile.mkstemp(
+                dir=os.path.dirname(self.path))
+            with os.fdopen(handle, "w") as store_file:
+                json.dump({"version": __version__, "format": RULES_FORMAT,
+                           "adfs": self._adfs},
+                          store_file)
+            os.rename(temp_path, self.path)
+            self._dirty = False
+        except (IOError, OSError) as error:
+            Logger().log("Unable to save compiled rules to %s: %s" %
+                         (self.path, error))
+
+    def release(self):
+        """Forget the loaded rules, once they have been built into Apps.
+
+        The store is read from disk again if it is used again.
+        """
+        self._adfs = None
+        self._used = set()
+
+    def stats(self):
+        """Return a dict of the store's counters."""
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class DigestCache(object):
+    """SHA-256 digests of files, cached between runs.
+
+    Digests are stored in one JSON file in the CACHE, keyed by each
+    file's device and inode, and reused for as long as its mtime and
+    size are unchanged, so an unchanged file is only hashed once.
+    Each entry also records where the file was hashed, and when the
+    cache is saved, entries which weren't used this run and no longer
+    match the file at that location are dropped.
+
+    Attributes:
+        path: Path to the cache file.
+        hits: Count of digests taken from the cache.
+        misses: Count of digests which had to be computed.
+    """
+
+    def __init__(self, path=None):
+        """Initialize a cache; it is loaded from disk on first use.
+
+        Args:
+            path: Optional path to the cache file. Defaults to
+                digests.json in the CACHE.
+        """
+        self.path = path or os.path.join(CACHE, "digests.json")
+        self._digests = None
+        self._new = {}
+        self._used = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(status):
+        """Return the cache key, and the values to check, for a stat."""
+        return ("%s:%s" % (status.st_dev, status.st_ino),
+                [status.st_mtime, status.st_size])
+
+    @classmethod
+    def _current(cls, key, entry):
+        """Return whether entry still matches the file it was made for.
+
+        Entries saved without a location can't be checked, and so
+        never match.
+        """
+        if len(entry) < 4:
+            return False
+        try:
+            status = os.stat(entry[3])
+        except (OSError, TypeError):
+            return False
+        return cls._key(status) == (key, entry[:2])
+
+    def load(self):
+        """Read the cache from disk."""
+        try:
+            with open(self.path, "r") as cache_file:
+                data = json.load(cache_file)
+        except (IOError, ValueError):
+            data = {}
+        self._digests = to_str(data.get("digests", {})) if isinstance(
+            data, dict) else {}
+
+    def get(self, status):
+        """Return the digest of the file with os.stat result status.
+
+        Returns:
+            Hex digest string, or None if it isn't cached.
+        """
+        with self._lock:
+            if self._digests is None:
+                self.load()
+            key, check = self._key(status)
+            entry = self._new.get(key) or self._digests.get(key)
+            if entry is not None and entry[:2] == check:
+                self.hits += 1
+                self._used.add(key)
+                return entry[2]
+            self.misses += 1
+        return None
+
+    def put(self, status, digest, location):
+        """Cache digest for the file with os.stat result status.
+
+        Args:
+            status: os.stat result for the file.
+            digest: Hex digest of the file's contents.
+            location: Path the file was read from (on this system,
+                i.e. rebased under any --root).
+        """
+        key, check = self._key(status)
+        with self._lock:
+            self._new[key] = check + [digest, location]
+
+    def save(self):
+        """Add this run's new digests to the file on disk, and prune.
+
+        The file is read again first, so that digests saved in the
+        meantime (e.g. by another process) aren't lost. Entries which
+        weren't looked up or added this run are kept only while the
+        file at their location is unchanged (see _current); the rest
+        are dropped, so that the cache doesn't grow without bound.
+        """
+        with self._lock:
+            self.load()
+            count = len(self._digests)
+            self._digests = dict(
+                (key, entry) for key, entry in self._digests.items() if
+                key in self._used or self._current(key, entry))
+            self._used = set()
+            if not self._new and len(self._digests) == count:
+                return
+            self._digests.update(self._new)
+            try:
+                handle, temp_path = tempfile.mkstemp(
+                    dir=os.path.dirname(self.path))
+                with os.fdopen(handle, "w") as cache_file:
+                    json.dump({"digests": self._digests}, cache_file)
+                os.rename(temp_path, self.path)
+                self._new = {}
+            except (IOError, OSError) as error:
+                Logger().log("Unable to save file digests to %s: %s" %
+                             (self.path, error))
+
+    def stats(self):
+        """Return a dict of the cache's counters."""
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class ScanState(object):
+    """Results of the previous run, used to skip unchanged work.
+
+    For each App, the state records the directories its search
+    depended on and their mtimes, the files whose contents it
+    searched (by inode, mtime and size), and the files it found. An
+    App whose inputs are all unchanged reuses its previous findings
+    rather than searching again. Content search verdicts are kept
+    too, so an App which does get searched again only reads files
+    which have changed.
+
+    Attributes:
+        path: Path to the state file.
+        reuse: Whether previous results may be reused. When False,
+            everything is searched, but the state is still saved for
+            the next run.
+        started: Time the state was created, i.e. the scan began.
+        reused: Count of Apps whose previous results were reused.
+        rescanned: Count of Apps which were searched.
+    """
+
+    def __init__(self, path=None, reuse=True):
+        """Initialize a new, empty state.
+
+        Args:
+            path: Optional path to the state file. Defaults to
+                scan_state.json in the CACHE.
+            reuse: Whether to reuse previous results.
+        """
+        self.path = path or os.path.join(CACHE, "scan_state.json")
+        self.reuse = reuse
+        self.started = time.time()
+        self.ruleset = None
+        self._apps = {}
+        self._verdicts = {}
+        self._results = {}
+        self._mtimes = {}
+        self.reused = 0
+        self.rescanned = 0
+
+    @staticmethod
+    def app_key(app):
+        """Return a digest identifying an App's rules."""
+        return app.rules.digest
+
+    def load(self, apps):
+        """Read the previous state and check it against apps.
+
+        State from another SavingThrow version is discarded. If the
+        set of Apps has changed, only Apps whose own rules are
+        unchanged can reuse their results.
+
+        Args:
+            apps: List of the Apps to be searched this run.
+        """
+        self.ruleset = hashlib.sha256(
+            "".join(self.app_key(app) for app in apps)).hexdigest()
+        try:
+            with open(self.path, "r") as state_file:
+                data = to_str(json.load(state_file))
+        except (IOError, ValueError):
+            return
+        if not isinstance(data, dict) or data.get("version") != __version__:
+            return
+        if data.get("ruleset") != self.ruleset:
+            Logger().log("Ruleset has changed since the last scan.",
+                         syslog.LOG_INFO)
+        self._apps = data.get("apps", {})
+        self._verdicts = data.get("verdicts", {})
+
+    def verdicts(self):
+        """Return the content search verdicts of the previous run."""
+        return self._verdicts
+
+    def _mtime(self, directory):
+        """Return the mtime of directory, or None if it's missing."""
+        if directory not in self._mtimes:
+            try:
+                self._mtimes[directory] = os.stat(directory).st_mtime
+            except OSError:
+                self._mtimes[directory] = None
+        return self._mtimes[directory]
+
+    def previous_results(self, app):
+        """Return the files app found last run, if still valid.
+
+        Returns:
+            Dict of found paths to the rule which found them (as in
+            App.matched_rules), or None if the App has to be searched.
+        """
+        entry = self._apps.get(self.app_key(app))
+        if not self.reuse or entry is None:
+            return None
+        # A change within the mtime resolution of the scan itself
+        # might not show up as a different mtime, so anything that
+        # close is treated as changed.
+        for directory, mtime in entry["directories"].items():
+            if (self._mtime(directory) != mtime or
+                    mtime is not None and mtime >= entry["scanned"] - 1):
+                return None
+        for path, key in entry["files"].items():
+            current = ContentScanner.file_key(path)
+            if (list(current) if current else None) != key or (
+                    key is not None and key[2] >= entry["scanned"] - 1):
+                return None
+        self._results[self.app_key(app)] = entry
+        self.reused += 1
+        if isinstance(entry["found"], list):
+            # Saved before rules were recorded.
+            return dict.fromkeys(entry["found"])
+        return dict(entry["found"])
+
+    def record(self, app, directories, files):
+        """Record the inputs and results of searching for app.
+
+        Args:
+            app: An App which has just been searched.
+            directories: Set of directories the search depended on.
+            files: Dict of files searched to their ContentScanner
+                keys.
+        """
+        self.rescanned += 1
+        self._results[self.app_key(app)] = {
+            "scanned": self.started,
+            "directories": {directory: self._mtime(directory) for
+                            directory in directories},
+            "files": {path: list(key) if key else None for path, key in
+                      files.items()},
+            "found": app.matched_rules}
+
+    def save(self, scanner):
+        """Write this run's state to disk.
+
+        Args:
+            scanner: The ContentScanner used this run, whose verdicts
+                are saved along with the App results.
+        """
+        data = {"version": __version__, "ruleset": self.ruleset,
+                "apps": self._results,
+                "verdicts": scanner.export_results(self.started)}
+        try:
+            handle, temp_path = tempfile.mkstemp(
+                dir=os.path.dirname(self.path))
+            with os.fdopen(handle, "w") as state_file:
+                json.dump(data, state_file)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError) as error:
+            Logger().log("Unable to save scan state to %s: %s" %
+                         (self.path, error))
+
+    def stats(self):
+        """Return a dict of the state's counters."""
+        return {"reused": self.reused, "rescanned": self.rescanned}
+
+
+class QuarantineZipFile(object):
+    """ZipFile which hashes as it writes, and takes compressed data.
+
+    Both methods follow ZipFile.write, which has no hooks for either.
+    This class only holds the methods; open mixes them into
+    zipfile.ZipFile, so that zipfile is only imported when it's used.
+    """
+
+    _class = None
+
+    @classmethod
+    def open(cls, *args, **kwargs):
+        """Return a new QuarantineZipFile; arguments are as ZipFile's."""
+        if cls._class is None:
+            cls._class = type(cls.__name__, (cls, zipfile.ZipFile), {})
+        return cls._class(*args, **kwargs)
+
+    def write_file(self, filename, arcname, file_stat):
+        """Stream filename into the archive, hashing it on the way.
+
+        Args:
+            filename: Path to a regular file.
+            arcname: Name to store it under.
+            file_stat: os.lstat result for filename.
+
+        Returns:
+            Tuple of (bytes written, SHA-256 hex digest).
+        """
+        zinfo = self._make_info(arcname, file_stat)
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        # Must overwrite CRC and sizes with correct data later.
+        zinfo.CRC = zinfo.file_size = zinfo.compress_size = 0
+        zinfo.header_offset = self.fp.tell()
+        self._writecheck(zinfo)
+        self._didModify = True
+        # Always leave room for the zip64 extra field; files can grow
+        # while we read them.
+        self.fp.write(zinfo.FileHeader(True))
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                      zlib.DEFLATED, -15)
+        digest = hashlib.sha256()
+        crc = file_size = compress_size = 0
+        with open(filename, "rb") as afile:
+            while True:
+                buf = afile.read(1024 * 1024)
+                if not buf:
+                    break
+                file_size += len(buf)
+                crc = zlib.crc32(buf, crc) & 0xffffffff
+                digest.update(buf)
+                buf = compressor.compress(buf)
+                compress_size += len(buf)
+                self.fp.write(buf)
+        buf = compressor.flush()
+        compress_size += len(buf)
+        self.fp.write(buf)
+        zinfo.CRC = crc
+        zinfo.file_size = file_size
+        zinfo.compress_size = compress_size
+        # Seek backwards and write the header again, with the real CRC
+        # and sizes.
+        position = self.fp.tell()
+        self.fp.seek(zinfo.header_offset, 0)
+        self.fp.write(zinfo.FileHeader(True))
+        self.fp.seek(position, 0)
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+        return file_size, digest.hexdigest()
+
+    def write_compressed(self, arcname, file_stat, compressed):
+        """Add a file which has already been compressed.
+
+        Args:
+            arcname: Name to store it under.
+            file_stat: os.lstat result for the file.
+            compressed: Dict from compress_file.
+        """
+        zinfo = self._make_info(arcname, file_stat)
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.CRC = compressed["crc"]
+        zinfo.file_size = compressed["size"]
+        zinfo.compress_size = len(compressed["data"])
+        zinfo.header_offset = self.fp.tell()
+        self._writecheck(zinfo)
+        self._didModify = True
+        self.fp.write(zinfo.FileHeader(False))
+        self.fp.write(compressed["data"])
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+
+    @staticmethod
+    def _make_info(arcname, file_stat):
+        """Return a ZipInfo for arcname with file_stat's attributes."""
+        zinfo = zipfile.ZipInfo(arcname,
+                                time.localtime(file_stat.st_mtime)[0:6])
+        zinfo.external_attr = (file_stat.st_mode & 0xFFFF) << 16L
+        return zinfo
+
+
+class QuarantineArchive(object):
+    """Streams quarantined files straight into a ZIP64 archive.
+
+    Files are stored under their full path (minus the leading slash),
+    so names never collide, and a file found more than once is only
+    stored once. Symlinks are stored as links rather than followed. A
+    manifest of every file's path, size, SHA-256 and App name is
+    added to the archive on close.
+
+    An existing archive is never overwritten: if the path is taken
+    (e.g. by another run in the same second), a counter is appended
+    to the name.
+
+    Attributes:
+        path: Path to the archive.
+        threads: Number of threads to compress small files with.
+        manifest: List of dicts describing each archived file.
+    """
+
+    manifest_name = "SavingThrowManifest.json"
+
+    def __init__(self, path, threads=1):
+        """Create a new archive at path, or beside it if path exists."""
+        self.path, self._file = self._create(path)
+        self.threads = threads
+        self.manifest = []
+        self._zipf = QuarantineZipFile.open(self._file, "w",
+                                            zipfile.ZIP_DEFLATED,
+                                            allowZip64=True)
+
+    @staticmethod
+    def _create(path):
+        """Create and open a new file at path, adding a counter if taken.
+
+        Returns:
+            Tuple of (path of the new file, file object open on it).
+
+        Raises:
+            OSError if the file can't be created.
+        """
+        base, extension = os.path.splitext(path)
+        candidate = path
+        counter = 0
+        while True:
+            try:
+                descriptor = os.open(
+                    candidate, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o666)
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+                counter += 1
+                candidate = "%s-%d%s" % (base, counter, extension)
+                continue
+            return candidate, os.fdopen(descriptor, "w+b")
+
+    def add(self, item, app_name):
+        """Add a file, symlink or directory tree to the archive.
+
+        Args:
+            item: Path to add.
+            app_name: Name of the App which found item.
+
+        Raises:
+            OSError or IOError if item can't be read.
+        """
+        small_files = []
+        for path, file_stat in self._walk(item):
+            arcname = path.lstrip("/")
+            if stat.S_ISDIR(file_stat.st_mode):
+                arcname += "/"
+            if arcname in self._zipf.NameToInfo:
+                continue
+            if stat.S_ISDIR(file_stat.st_mode):
+                self._zipf.write(path, arcname)
+            elif stat.S_ISLNK(file_stat.st_mode):
+                target = os.readlink(path)
+                zinfo = QuarantineZipFile._make_info(arcname, file_stat)
+                self._zipf.writestr(zinfo, target)
+                self._record(path, len(target),
+                             hashlib.sha256(target).hexdigest(), app_name)
+            elif stat.S_ISREG(file_stat.st_mode):
+                if (self.threads > 1 and
+                        file_stat.st_size < QUARANTINE_CHUNK):
+                    small_files.append((path, arcname, file_stat))
+                else:
+                    size, digest = self._zipf.write_file(path, arcname,
+                                                         file_stat)
+                    self._record(path, size, digest, app_name)
+
+        # Compress small files on worker threads, a batch at a time to
+        # keep memory use bounded.
+        batch_size = max(1, self.threads * 4)
+        for start in xrange(0, len(small_files), batch_size):
+            batch = small_files[start:start + batch_size]
+            results = map_concurrently(compress_file,
+                                       [path for path, _, _ in batch],
+                                       self.threads)
+            for (path, arcname, file_stat), result in zip(batch, results):
+                self._zipf.write_compressed(arcname, file_stat, result)
+                self._record(path, result["size"], result["sha256"],
+                             app_name)
+
+    def _walk(self, item):
+        """Yield (path, lstat) for item and everything beneath it."""
+        item_stat = os.lstat(item)
+        yield item, item_stat
+        if stat.S_ISDIR(item_stat.st_mode):
+            for dirpath, dirnames, filenames in os.walk(item):
+                for name in dirnames + filenames:
+                    path = os.path.join(dirpath, name)
+                    try:
+                        yield path, os.lstat(path)
+                    except OSError:
+                        # Gone already.
+                        continue
+
+    def _record(self, path, size, digest, app_name):
+        """Add an entry to the manifest."""
+        self.manifest.append({"path": path, "size": size, "sha256": digest,
+                              "app": app_name})
+
+    def close(self):
+        """Write the manifest and close the archive."""
+        self._zipf.writestr(self.manifest_name,
+                            json.dumps(self.manifest, indent=2))
+        self._zipf.close()
+        self._file.close()
+
+    def verify(self):
+        """Return whether every manifest entry is in the closed archive."""
+        try:
+            zipf = zipfile.ZipFile(self.path, "r")
+        except (IOError, zipfile.BadZipfile):
+            return False
+        with zipf:
+            sizes = {info.filename: info.file_size for info in
+                     zipf.infolist()}
+        return all(sizes.get(entry["path"].lstrip("/")) == entry["size"] for
+                   entry in self.manifest)
+
+
+def compress_file(path):
+    """Read and deflate a small file, for QuarantineZipFile.
+
+    Returns:
+        Dict with keys "data" (raw deflated bytes), "crc", "size" and
+        "sha256".
+    """
+    with open(path, "rb") as afile:
+        text = afile.read()
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                  zlib.DEFLATED, -15)
+    return {"data": compressor.compress(text) + compressor.flush(),
+            "crc": zlib.crc32(text) & 0xffffffff, "size": len(text),
+            "sha256": hashlib.sha256(text).hexdigest()}
+
+
+class RemovalPlan(object):
+    """Works out what deleting all of some Apps' findings involves.
+
+    A path found by more than one App is removed once, on behalf of
+    every App which found it. A path inside a directory which is
+    being removed is left to that directory's removal, rather than
+    being removed first (wasting work) or after (and failing). What
+    remains is grouped by the filesystem it is on, and removed by a
+    pool of threads taking turns between filesystems.
+
+    Attributes:
+        entries: List of dicts, sorted by path, one for each path to
+            remove: "path", "apps" (names of the Apps which found it,
+            in ADF order), "kind" ("file", "directory", "link",
+            "missing" or "unknown", if it couldn't be checked),
+            "device" (st_dev, or None if it couldn't be checked),
+            "covered" (list of (path, App names) found beneath a
+            directory, and removed with it) and, once run, "bytes"
+            and "error".
+    """
+
+    def __init__(self, apps):
+        """Plan the removal of everything found by apps."""
+        found = {}
+        for app in apps:
+            for path in app.found:
+                names = found.setdefault(os.path.normpath(path), [])
+                if app.name not in names:
+                    names.append(app.name)
+
+        kinds = {}
+        devices = {}
+        for path in found:
+            try:
+                path_stat = os.lstat(path)
+            except OSError as error:
+                # Anything but a missing path is left for removal to
+                # fail on, and report.
+                kinds[path] = ("missing" if error.errno in
+                               (errno.ENOENT, errno.ENOTDIR) else "unknown")
+                devices[path] = None
+                continue
+            if stat.S_ISDIR(path_stat.st_mode):
+                kinds[path] = "directory"
+            elif stat.S_ISLNK(path_stat.st_mode):
+                kinds[path] = "link"
+            else:
+                kinds[path] = "file"
+            devices[path] = path_stat.st_dev
+
+        directories = {path for path, kind in kinds.items() if
+                       kind == "directory"}
+        entries = {}
+        covered = []
+        for path in sorted(found):
+            outermost = outermost_directory(path, directories)
+            if outermost is None:
+                entries[path] = {"path": path, "apps": found[path],
+                                 "kind": kinds[path],
+                                 "device": devices[path], "covered": []}
+            else:
+                covered.append((outermost, path))
+        for outermost, path in covered:
+            entries[outermost]["covered"].append((path, found[path]))
+        self.entries = [entries[path] for path in sorted(entries)]
+
+    def __len__(self):
+        """Return the number of paths to remove."""
+        return len(self.entries)
+
+    def discard(self, entry):
+        """Leave entry out of the plan."""
+        self.entries.remove(entry)
+
+    def groups(self):
+        """Return a list of (device, entries) for each filesystem."""
+        groups = {}
+        for entry in self.entries:
+            groups.setdefault(entry["device"], []).append(entry)
+        return sorted(groups.items(), key=lambda group: (group[0] is None,
+                                                          group[0]))
+
+    def run(self, threads, dry_run=False):
+        """Remove everything in the plan, counting bytes.
+
+        Each entry gets "bytes" (the size of the file, link or whole
+        directory tree removed) and "error" (None, or the error which
+        stopped it being removed completely).
+
+        Args:
+            threads: Number of threads to remove with.
+            dry_run: Count bytes, but don't remove anything.
+        """
+        # Take turns between filesystems, so that every disk is kept
+        # busy rather than all the threads waiting on the same one.
+        queues = [entries for _, entries in self.groups()]
+        order = []
+        while queues:
+            order.extend(queue[0] for queue in queues)
+            queues = [queue[1:] for queue in queues if len(queue) > 1]
+        function = functools.partial(remove_entry, dry_run=dry_run)
+        for entry, result in zip(order, map_concurrently(function, order,
+                                                         threads)):
+            entry["bytes"], entry["error"] = result
+
+    def write(self, stream):
+        """Write the plan, with its byte counts, to stream."""
+        lines = []
+        total = 0
+        for device, entries in self.groups():
+            size = sum(entry.get("bytes", 0) for entry in entries)
+            total += size
+            lines.append("Filesystem %s: %s items, %s bytes\n" % (
+                "(missing)" if device is None else device, len(entries),
+                size))
+            for entry in entries:
+                lines.append("%s: %s (%s bytes) %s\n" % (
+                    entry["kind"].capitalize(), entry["path"],
+                    entry.get("bytes", 0), ", ".join(entry["apps"])))
+                for path, apps in entry["covered"]:
+                    lines.append("    Covered: %s %s\n" % (
+                        path, ", ".join(apps)))
+        lines.append("Total: %s items, %s bytes\n" % (len(self.entries),
+                                                        total))
+        stream.write("".join(lines))
+        stream.flush()
+
+
+def outermost_directory(path, directories):
+    """Return the outermost of directories above path, or None."""
+    outermost = None
+    parent = os.path.dirname(path)
+    while parent != path:
+        if parent in directories:
+            outermost = parent
+        path, parent = parent, os.path.dirname(parent)
+    return outermost
+
+
+def remove_entry(entry, dry_run=False):
+    """Remove a RemovalPlan entry, for RemovalPlan.run.
+
+    Returns:
+        Tuple of (bytes removed, None or the first OSError).
+    """
+    if entry["kind"] == "missing":
+        return 0, None
+    try:
+        return remove_tree(entry["path"], dry_run), None
+    except OSError as error:
+        return 0, error
+
+
+def remove_tree(path, dry_run=False):
+    """Remove path, and everything beneath it if it's a directory.
+
+    Symlinks are removed, not followed. Anything which disappears
+    while removing is skipped.
+
+    Args:
+        path: Path to remove.
+        dry_run: Only count bytes.
+
+    Returns:
+        Total size, in bytes, of the files and links removed.
+
+    Raises:
+        OSError if path, or anything beneath it, can't be removed.
+    """
+    path_stat = os.lstat(path)
+    if not stat.S_ISDIR(path_stat.st_mode):
+        if not dry_run:
+            os.remove(path)
+        return path_stat.st_size
+    size = 0
+    for name in os.listdir(path):
+        try:
+            size += remove_tree(os.path.join(path, name), dry_run)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+    if not dry_run:
+        os.rmdir(path)
+    return size
+
+
+class ReportWriter(object):
+    """Writes findings to a stream as they become available.
+
+    Output is written, and flushed, an App at a time, so nothing has
+    to be held in memory and a reader sees results as soon as they
+    are ready. This base class writes the plain list of findings that
+    the other text formats wrap.
+
+    If time ran out before some rules were searched (see
+    FileController.find_before), the report is marked as partial,
+    and lists them at the end.
+
+    Attributes:
+        stream: File-like object to write to.
+        found: Whether any App written so far had findings.
+        skipped: List of (App name, root, rule description) tuples
+            for the rules skipped by the Apps written so far.
+    """
+
+    def __init__(self, stream):
+        """Initialize a writer for stream."""
+        self.stream = stream
+        self.found = False
+        self.skipped = []
+
+    def start(self):
+        """Write anything that precedes the findings."""
+        pass
+
+    def write_app(self, app, root=None):
+        """Write the findings of one App, if it has any.
+
+        Args:
+            app: App to report on.
+            root: Folder app was searched for under, if not "/".
+        """
+        self.skip(app, root)
+        if not (app.found or app.processes):
+            return
+        if not self.found:
+            self.found = True
+            self.write_header()
+        lines = ["Name: %s\n" % app.name]
+        if root is not None:
+            lines.insert(0, "Root: %s\n" % root)
+        for num, found in enumerate(sorted(app.found), 1):
+            lines.append("File %s: %s\n" % (num, found))
+        for num, (process, pids) in enumerate(
+                sorted(app.processes.items()), 1):
+            lines.append("Process %s: %s PID: %s\n" % (
+                num, process, ", ".join(str(pid) for pid in pids)))
+        self.stream.write("".join(lines))
+        self.stream.flush()
+        Logger.log("".join(lines), console=False)
+
+    def skip(self, app, root=None):
+        """Note the rules app skipped, for the end of the report."""
+        self.skipped.extend((app.name, root, rule) for rule in
+                            app.skipped_rules)
+
+    def skipped_text(self):
+        """Return the lines listing skipped rules, if there were any."""
+        if not self.skipped:
+            return ""
+        lines = ["Partial report; time ran out before searching:\n"]
+        for num, (name, _, rule) in enumerate(self.skipped, 1):
+            lines.append("Skipped %s: %s (%s)\n" % (num, rule, name))
+        return "".join(lines)
+
+    def write_header(self):
+        """Write anything that precedes the first finding."""
+        pass
+
+    def finish(self):
+        """Write anything that follows the findings."""
+        self.stream.flush()
+
+
+class TextReportWriter(ReportWriter):
+    """Writes the standard report (--stdout)."""
+
+    def write_header(self):
+        """Write the heading for found files."""
+        self.stream.write("Files and processes found:\n")
+
+    def finish(self):
+        """Say so if nothing was found, or if anything was skipped."""
+        if self.found:
+            self.stream.write("\n")
+        else:
+            self.stream.write("No files or processes found.\n")
+            Logger.log("No files or processes found.", console=False)
+        self.stream.write(self.skipped_text())
+        self.stream.flush()
+
+
+class ExtensionAttributeWriter(ReportWriter):
+    """Writes the report as a Casper extension attribute result."""
+
+    def write_header(self):
+        """Open the result, which has findings."""
+        self.stream.write("<result>True\n")
+
+    def finish(self):
+        """Close the result, after any skipped rules."""
+        if not self.found:
+            self.stream.write("<result>False" +
+                              ("\n" if self.skipped else ""))
+        self.stream.write(self.skipped_text() + "</result>\n")
+        self.stream.flush()
+
+
+class JSONReportWriter(ReportWriter):
+    """Writes findings as one JSON document.
+
+    The document is an object with keys "version", "findings" (a list
+    of findings, as described in finding_records), "found",
+    "partial", and "skipped_rules" (a list of objects with keys
+    "app", "root" and "rule").
+    """
+
+    def start(self):
+        """Open the document."""
+        self.stream.write('{"version": %s, "findings": [' %
+                          json.dumps(__version__))
+
+    def write_app(self, app, root=None):
+        """Write the findings of one App (see ReportWriter)."""
+        self.skip(app, root)
+        for record in finding_records(app, root):
+            self.stream.write((",\n" if self.found else "\n") +
+                              json.dumps(record, sort_keys=True))
+            self.found = True
+        self.stream.flush()
+
+    def finish(self):
+        """Close the document."""
+        skipped = [{"app": name, "root": root, "rule": rule} for name,
+                   root, rule in self.skipped]
+        self.stream.write('\n], "found": %s, "partial": %s, '
+                          '"skipped_rules": %s}\n' % (
+                              json.dumps(self.found),
+                              json.dumps(bool(skipped)),
+                              json.dumps(skipped, sort_keys=True)))
+        self.stream.flush()
+
+
+class NDJSONReportWriter(ReportWriter):
+    """Writes findings as newline delimited JSON; one per line.
+
+    See finding_records for the fields. A partial report ends with a
+    record for each skipped rule, with the kind "skipped".
+    """
+
+    def write_app(self, app, root=None):
+        """Write the findings of one App (see ReportWriter)."""
+        self.skip(app, root)
+        for record in finding_records(app, root):
+            self.stream.write(json.dumps(record, sort_keys=True) + "\n")
+            self.found = True
+        self.stream.flush()
+
+    def finish(self):
+        """Write the skipped rules, if any."""
+        for name, root, rule in self.skipped:
+            self.stream.write(json.dumps(
+                {"app": name, "root": root, "path": None,
+                 "kind": "skipped", "rule": rule, "process": None,
+                 "pids": []}, sort_keys=True) + "\n")
+        self.stream.flush()
+
+
+REPORT_WRITERS = {"text": TextReportWriter, "ea": ExtensionAttributeWriter,
+                  "json": JSONReportWriter, "ndjson": NDJSONReportWriter}
+
+
+def finding_records(app, root=None):
+    """Yield a dict describing each of app's findings.
+
+    Each has the keys "app" (App name), "root" (the folder searched
+    under, or None for "/"), "path" (the file as it is on the system
+    searched, or None for processes), "kind" ("file", "directory",
+    "link", "missing" or "process"), "rule" (the rule which found it),
+    "process" (process name, or None), and "pids" (list of PIDs, empty
+    for files).
+    """
+    for path in sorted(app.found):
+        try:
+            mode = os.lstat(rebase(root, path, False)).st_mode
+        except OSError:
+            kind = "missing"
+        else:
+            kind = ("link" if stat.S_ISLNK(mode) else "directory" if
+                    stat.S_ISDIR(mode) else "file")
+        yield {"app": app.name, "root": root, "path": path, "kind": kind,
+               "rule": app.matched_rules.get(path), "process": None,
+               "pids": []}
+    for process, pids in sorted(app.processes.items()):
+        yield {"app": app.name, "root": root, "path": None,
+               "kind": "process", "rule": "Process: %s" % process,
+               "process": process, "pids": [int(pid) for pid in pids]}
+
+
+def measured(phase):
+    """Decorator measuring all of a method's work as phase in Stats."""
+    def decorator(method):
+        """Wrap method."""
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            """Call method within Stats.measure(phase)."""
+            with Stats.measure(phase):
+                return method(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class FileController(object):
+    """Manages a group of App objects.
+
+    Atributes:
+        apps: List of App objects to control.
+        index: DirectoryIndex shared by all Apps for this run.
+        process_table: ProcessTable shared by all Apps for this run.
+        scanner: ContentScanner shared by all Apps for this run.
+        rule_store: RuleStore of compiled ADF rules.
+        runner: CommandRunner for running commands and signalling
+            processes.
+        root: Folder holding the filesystem searched, or None for
+            the running system.
+        logger: Logger for handling output.
+    """
+
+    def __init__(self, runner=None, root=None):
+        """Initialize a new controller with its attributes.
+
+        Args:
+            runner: Optional CommandRunner to use instead of the
+                default.
+            root: Optional folder holding a filesystem to search
+                instead of the running system's, e.g. a mounted disk
+                image or backup snapshot. There are no processes to
+                find there.
+        """
+        self.apps = []
+        self.root = root
+        self.index = DirectoryIndex(root)
+        self.process_table = ProcessTable({} if root else None)
+        self.scanner = ContentScanner(root, DigestCache())
+        self.rule_store = RuleStore()
+        self.runner = runner if runner is not None else CommandRunner()
+        self.logger = Logger()
+
+    @measured("load")
+    def add_app_from_url(self, source):
+        """Add an App object to controller from a URL.
+
+        Given an URL to an app description file, attempt to
+        download, parse, and generate a set of targeted files and
+        processes, and add to internal apps list.
+
+        Args:
+            source: String URL to an ADF file.
+
+        Raises:
+            All expected exceptions are handled.
+        """
+        app_text = self.fetch_adf(source)
+        if app_text:
+            self.add_apps_from_text(app_text, source)
+            self.rule_store.save()
+
+    def fetch_source(self, source):
+        """Get the texts of the ADFs from a source.
+
+        Args:
+            source: String URL to an ADF, or to a bundle's index
+                manifest (see is_bundle).
+
+        Returns:
+            List of ADF texts.
+        """
+        if is_bundle(source):
+            return self.fetch_bundle(source)
+        return [self.fetch_adf(source)]
+
+    def fetch_bundle(self, source):
+        """Get the texts of the ADFs in a bundle, using the cache.
+
+        A bundle is published as an index manifest, listing the name,
+        version and SHA-256 of each of its ADFs, next to a ZIP
+        archive of them all and the ADFs themselves (see
+        make_bundle.py). The manifest is fetched and cached like an
+        ADF (see fetch_adf), so an unchanged bundle costs a single
+        conditional request. Only the cached ADFs whose digests no
+        longer match the manifest are downloaded: one at a time if
+        there are no more than BUNDLE_DELTA_LIMIT of them, otherwise
+        as one download of the archive.
+
+        Args:
+            source: String URL to a bundle's index manifest.
+
+        Returns:
+            List of the bundle's ADF texts, in manifest order. ADFs
+            which couldn't be downloaded fall back to their cached
+            copies, if any.
+        """
+        folder = get_bundle_path(source)
+        try:
+            if not os.path.isdir(folder):
+                os.mkdir(folder)
+        except OSError as error:
+            self.logger.log("Unable to create bundle cache %s: %s" %
+                            (folder, error))
+            return []
+        index = parse_bundle_index(self.fetch_adf(
+            source, os.path.join(folder, BUNDLE_INDEX)), source)
+        if index is None:
+            return []
+
+        texts = {}
+        changed = []
+        for entry in index["adfs"]:
+            text = read_cached_adf(source, os.path.join(folder,
+                                                        entry["name"]))
+            if text and hashlib.sha256(text).hexdigest() == entry["sha256"]:
+                texts[entry["name"]] = text
+            else:
+                changed.append(entry)
+
+        if changed:
+            self.logger.log("%s of %s ADFs in bundle %s have changed" %
+                            (len(changed), len(index["adfs"]), source),
+                            syslog.LOG_INFO)
+            if len(changed) > BUNDLE_DELTA_LIMIT:
+                downloaded = self.fetch_bundle_archive(source, index, changed)
+            else:
+                downloaded = dict(zip(
+                    [entry["name"] for entry in changed],
+                    map_concurrently(functools.partial(
+                        self.fetch_bundle_adf, source), changed,
+                                     FETCH_THREADS)))
+            for entry in changed:
+                path = os.path.join(folder, entry["name"])
+                text = downloaded.get(entry["name"])
+                if text is None:
+                    self.logger.log("Unable to update %s from bundle %s. "
+                                    "Looking for cached copy" %
+                                    (entry["name"], source))
+                    text = read_cached_adf(source, path)
+                else:
+                    self.logger.log("Updated %s to version %s from bundle "
+                                    "%s" % (entry["name"], entry["version"],
+                                            source), syslog.LOG_INFO)
+                    write_cached_adf(path, text)
+                texts[entry["name"]] = text
+
+        # Remove ADFs which have been dropped from the bundle.
+        for name in os.listdir(folder):
+            if name not in texts and not name.startswith(BUNDLE_INDEX):
+                try:
+                    os.remove(os.path.join(folder, name))
+                except OSError:
+                    pass
+        return [texts[entry["name"]] for entry in index["adfs"]]
+
+    def fetch_bundle_adf(self, source, entry):
+        """Download one ADF of a bundle.
+
+        Args:
+            source: String URL to the bundle's index manifest.
+            entry: Dict describing the ADF, from the manifest.
+
+        Returns:
+            The ADF text, or None if it couldn't be downloaded or
+            doesn't match the manifest's SHA-256.
+        """
+        url = urlparse.urljoin(source, urllib.quote(entry["name"]))
+        try:
+            text = urllib2.urlopen(url, timeout=FETCH_TIMEOUT).read()
+        except urllib2.URLError as error:
+            self.logger.log("Update of %s failed: %s" % (url, error))
+            return None
+        except socket.timeout:
+            self.logger.log("Update of %s timed out" % url)
+            return None
+        except (socket.error, httplib.HTTPException) as error:
+            self.logger.log("Update of %s failed: %r" % (url, error))
+            return None
+        if hashlib.sha256(text).hexdigest() != entry["sha256"]:
+            self.logger.log("%s doesn't match its bundle's SHA-256" % url)
+            return None
+        return text
+
+    def fetch_bundle_archive(self, source, index, entries):
+        """Download a bundle's archive, and extract some of its ADFs.
+
+        The archive is spooled to a temporary file, rather than held
+        in memory.
+
+        Args:
+            source: String URL to the bundle's index manifest.
+            index: Dict of the bundle's manifest.
+            entries: List of dicts describing the ADFs to extract.
+
+        Returns:
+            Dict of the names of the ADFs extracted to their texts.
+            ADFs missing from the archive, or not matching the
+            manifest's SHA-256, are left out.
+        """
+        url = urlparse.urljoin(source, urllib.quote(index["archive"]))
+        self.logger.log("Downloading bundle archive %s" % url,
+                        syslog.LOG_INFO)
+        texts = {}
+        try:
+            response = urllib2.urlopen(url, timeout=FETCH_TIMEOUT)
+            with tempfile.TemporaryFile(dir=CACHE) as spool:
+                shutil.copyfileobj(response, spool)
+                archive = zipfile.ZipFile(spool)
+                names = set(archive.namelist())
+                for entry in entries:
+                    if entry["name"] not in names:
+                        continue
+                    text = archive.read(entry["name"])
+                    if hashlib.sha256(text).hexdigest() == entry["sha256"]:
+                        texts[entry["name"]] = text
+                    else:
+                        self.logger.log("%s in %s doesn't match its "
+                                        "bundle's SHA-256" %
+                                        (entry["name"], url))
+        except urllib2.URLError as error:
+            self.logger.log("Download of %s failed: %s" % (url, error))
+        except socket.timeout:
+            self.logger.log("Download of %s timed out" % url)
+        except (socket.error, httplib.HTTPException) as error:
+            self.logger.log("Download of %s failed: %r" % (url, error))
+        except (zipfile.BadZipfile, zipfile.LargeZipFile) as error:
+            self.logger.log("Bundle archive %s is damaged: %s" %
+                            (url, error))
+        return texts
+
+    def fetch_adf(self, source, cache_path=None):
+        """Get the text of an ADF, using the cache where possible.
+
+        A metadata sidecar is kept next to each cached ADF, recording
+        its ETag, Last-Modified, SHA-256 and fetch time. Downloads are
+        made conditional on those, so an unchanged ADF costs a 304
+        rather than a full transfer. If CACHE_MAX_AGE is set and the
+        cached copy is younger than that, no request is made at all.
+
+        Args:
+            source: String URL to an ADF file.
+            cache_path: Optional path to cache the ADF at. Defaults
+                to get_cache_path(source).
+
+        A download only replaces the cached copy if it is complete
+        (as long as the server's Content-Length) and parses (see
+        check_download). Otherwise, as when the server can't be
+        reached, the cached copy is used.
+
+        Returns:
+            The ADF text, or "" if neither the download nor the cache
+            produced anything.
+        """
+        cache_path = cache_path or get_cache_path(source)
+        metadata = read_cache_metadata(cache_path)
+        # Only trust the cached copy for revalidation if it's the one
+        # the metadata describes.
+        cached_text = None
+        if metadata:
+            try:
+                with open(cache_path, "r") as cache_file:
+                    cached_text = cache_file.read()
+            except IOError:
+                pass
+            else:
+                if (hashlib.sha256(cached_text).hexdigest() !=
+                        metadata.get("sha256")):
+                    cached_text = None
+
+        if (cached_text is not None and CACHE_MAX_AGE and
+                time.time() - metadata.get("fetched", 0) < CACHE_MAX_AGE):
+            self.logger.log("Using cached copy of App list: %s" % source,
+                            syslog.LOG_INFO)
+            return cached_text
+
+        self.logger.log("Attempting to update App list: %s" % source,
+                        syslog.LOG_INFO)
+        request = urllib2.Request(source)
+        if cached_text is not None:
+            if metadata.get("etag"):
+                request.add_header("If-None-Match", metadata["etag"])
+            if metadata.get("last_modified"):
+                request.add_header("If-Modified-Since",
+                                   metadata["last_modified"])
+        app_text = ""
+        try:
+            response = urllib2.urlopen(request, timeout=FETCH_TIMEOUT)
+            app_text = response.read()
+            length = response.info().getheader("Content-Length")
+            if length and length.isdigit() and int(length) != len(app_text):
+                self.logger.log("Update of %s was cut short (%s of %s "
+                                "bytes). Looking for cached copy" %
+                                (source, len(app_text), length))
+                app_text = ""
+            digest = hashlib.sha256(app_text).hexdigest()
+            # The cached copy checked out when it was downloaded, so
+            # only a changed ADF needs checking (and parsing) again.
+            unchanged = (cached_text is not None and
+                         digest == metadata.get("sha256"))
+            problem = (check_download(source, app_text) if app_text and
+                       not unchanged else None)
+            if problem:
+                self.logger.log("Update of %s is invalid: %s. Looking for "
+                                "cached copy" % (source, problem))
+                app_text = ""
+        except urllib2.HTTPError as error:
+            if error.code == 304 and cached_text is not None:
+                self.logger.log("App list unchanged: %s" % source,
+                                syslog.LOG_INFO)
+                metadata["fetched"] = time.time()
+                write_cache_metadata(cache_path, metadata)
+                return cached_text
+            self.logger.log("Update failed: %s. Looking for cached copy" %
+                            error)
+        except urllib2.URLError as error:
+            self.logger.log("Update failed: %s. Looking for cached copy" %
+                            error.message)
+        except socket.timeout as error:
+            self.logger.log("Update timed out: %s. Looking for cached copy" %
+                            source)
+        except (socket.error, httplib.HTTPException) as error:
+            # E.g. a connection reset, or a bad status line.
+            self.logger.log("Update of %s failed: %r. Looking for cached "
+                            "copy" % (source, error))
+
+        if app_text:
+            write_cached_adf(cache_path, app_text)
+            headers = response.info()
+            write_cache_metadata(cache_path, {
+                "etag": headers.getheader("ETag"),
+                "last_modified": headers.getheader("Last-Modified"),
+                "sha256": digest, "fetched": time.time()})
+        elif cached_text is not None:
+            app_text = cached_text
+        else:
+            # Fallback to the cached file.
+            app_text = read_cached_adf(source, cache_path)
+        return app_text
+
+    @measured("load")
+    def add_apps_from_urls(self, sources, deadline=None):
+        """Add App objects to controller from a list of URLs.
+
+        ADFs and bundles (see fetch_bundle) are fetched concurrently
+        by up to FETCH_THREADS threads.
+        Any source which hasn't finished by deadline seconds falls
+        back to its cached copy. Apps are added in the order of
+        sources regardless of which finished first.
+
+        Args:
+            sources: List of string URLs to ADF files or bundle
+                index manifests.
+            deadline: Seconds to wait for downloads. Defaults to
+                FETCH_DEADLINE.
+        """
+        if self.add_apps_from_store(sources):
+            return
+        if deadline is None:
+            deadline = FETCH_DEADLINE
+        results = map_concurrently(self.fetch_source, sources,
+                                   FETCH_THREADS, deadline)
+        for source, app_texts in zip(sources, results):
+            if app_texts is UNFINISHED:
+                self.logger.log("Update of %s did not finish in time. "
+                                "Looking for cached copy" % source)
+                app_texts = (read_cached_bundle(source) if
+                             is_bundle(source) else
+                             [read_cached_adf(source)])
+            for app_text in app_texts:
+                if app_text:
+                    self.add_apps_from_text(app_text, source)
+        self.rule_store.save(prune=True)
+        self.rule_store.release()
+
+    def add_apps_from_store(self, sources):
+        """Add Apps straight from the rule store, if it's up to date.
+
+        When CACHE_MAX_AGE is set and every source's cached copy is
+        younger than that, the SHA-256s recorded in the cache
+        metadata say which stored rules to use. Nothing is
+        downloaded, and no ADF is read, hashed or parsed, so none of
+        the modules for doing so are even imported.
+
+        Args:
+            sources: List of string URLs to ADF files or bundle
+                index manifests.
+
+        Returns:
+            True if the Apps were added, or False (having added none)
+            if any source has to be fetched or compiled.
+        """
+        adfs = []
+        for source in sources:
+            digests = fresh_cached_digests(source)
+            if digests is None:
+                return False
+            for digest in digests:
+                adf = self.rule_store.get_stored(digest)
+                if adf is None:
+                    return False
+                adfs.append(adf)
+        self.logger.log("Using stored rules for all %s App lists" %
+                        len(sources), syslog.LOG_INFO)
+        for adf in adfs:
+            self.warn_if_old_version(adf)
+            self.apps.extend([App(AppRules.from_dict(rules), self.index,
+                                  self.process_table, self.scanner) for
+                              rules in adf["apps"]])
+        self.rule_store.save(prune=True)
+        self.rule_store.release()
+        return True
+
+    def add_apps_from_text(self, app_text, source):
+        """Add the Apps defined in ADF text to the controller.
+
+        Compiled rules are taken from the rule store when the ADF is
+        unchanged since they were built, skipping XML parsing.
+
+        Args:
+            app_text: String contents of an ADF.
+            source: String URL the ADF came from, for logging.
+        """
+        adf = self.rule_store.get(app_text, source)
+        if adf is not None:
+            self.warn_if_old_version(adf)
+            self.apps.extend([App(AppRules.from_dict(rules), self.index,
+                                  self.process_table, self.scanner) for
+                              rules in adf["apps"]])
+
+    def find(self, jobs=1, state=None, writer=None):
+        """Search for the files and processes of all Apps.
+
+        Apps are evaluated concurrently by up to jobs threads. They
+        share this controller's directory index, process table and
+        content scanner, so the work they have in common is still
+        done only once. Results stay in their Apps, so reporting
+        order is unaffected by the order evaluation finished in.
+
+        Args:
+            jobs: Number of threads to use.
+            state: Optional ScanState. Apps whose inputs haven't
+                changed since it was saved reuse their previous
+                results (processes are always looked up afresh), and
+                the state is then updated and saved.
+            writer: Optional ReportWriter. Each App is written to it
+                as soon as it, and every App before it, is done.
+        """
+        if state is not None:
+            state.load(self.apps)
+            if state.reuse:
+                self.scanner.import_results(state.verdicts())
+
+        previous = {}
+        if state is not None:
+            for app in self.apps:
+                found = state.previous_results(app)
+                if found is not None:
+                    previous[id(app)] = found
+        searching = [app for app in self.apps if id(app) not in previous]
+        self.plan(searching)
+        self.plan_contents(searching)
+
+        positions = {id(app): num for num, app in enumerate(self.apps)}
+        finished = [False] * len(self.apps)
+        written = [0]
+        lock = threading.Lock()
+
+        def emit(app):
+            """Write out app and any finished Apps waiting on it."""
+            with lock:
+                finished[positions[id(app)]] = True
+                while written[0] < len(self.apps) and finished[written[0]]:
+                    writer.write_app(self.apps[written[0]])
+                    written[0] += 1
+
+        def evaluate(app):
+            """Search for app, reusing previous results if possible."""
+            found = previous.get(id(app))
+            if found is not None:
+                app.matched_rules = found
+                app.found = set(found)
+                app.find_processes()
+            elif state is None:
+                app.find()
+            else:
+                self.index.start_tracking()
+                self.scanner.start_tracking()
+                app.find()
+                state.record(app, self.index.stop_tracking(),
+                             self.scanner.stop_tracking())
+            if writer is not None:
+                emit(app)
+
+        map_concurrently(evaluate, self.apps, jobs)
+        self.scanner.digest_cache.save()
+        if state is not None:
+            state.save(self.scanner)
+
+    def find_before(self, deadline, jobs=1, state=None):
+        """Search for all Apps, cheapest rules first, until deadline.
+
+        Rather than searching App by App, the rules of every App are
+        searched in stages of rising cost: processes and literal File
+        paths (one lookup each), then planning (see plan), then File
+        globs, then planning content searches (see plan_contents),
+        then TestedFiles, whose files may have to be read or
+        hashed, along with any Files using their ReplacementKeys.
+        TestedFiles without Regexes or Hashes go first. Each stage is
+        shared between up to jobs threads.
+
+        Work not started by the deadline is skipped, and work still
+        running then is abandoned, so this returns by the deadline
+        with whatever has been found. The rules which weren't
+        searched are listed in each App's skipped_rules.
+
+        Args:
+            deadline: time.time() value by which to return.
+            jobs: Number of threads to use.
+            state: Optional ScanState, as for find. Only Apps which
+                were searched completely are recorded in it.
+
+        Returns:
+            True if every rule was searched, or False if the results
+            are partial.
+        """
+        if state is not None:
+            state.load(self.apps)
+            if state.reuse:
+                self.scanner.import_results(state.verdicts())
+
+        # Tasks are tuples of (kind, app, descriptions of the rules
+        # searched, function doing the search).
+        checks, globs, tested = [], [], []
+        searched = []
+        unsearched = {}
+        for app in self.apps:
+            app.reset()
+            processes = sorted(set(rule.description for rule in
+                                   app.rules.processes))
+            checks.append(("processes", app, processes,
+                           app.search_processes))
+            unsearched[id(app)] = set(processes)
+            found = (state.previous_results(app) if state is not None else
+                     None)
+            if found is not None:
+                app.add_matches(found)
+                continue
+            searched.append(app)
+            dependents = []
+            for rule in app.rules.files:
+                if "%" in rule.pattern:
+                    dependents.append(rule)
+                    continue
+                stage = globs if glob.has_magic(rule.pattern) else checks
+                stage.append(("files", app, [rule.description],
+                              functools.partial(app.search_file, rule)))
+                unsearched[id(app)].add(rule.description)
+            if app.rules.tested_files or dependents:
+                rules = [rule.description for rule in
+                         app.rules.tested_files + tuple(dependents)]
+                tested.append(("files", app, rules, functools.partial(
+                    self._search_tested_files, app, dependents)))
+                unsearched[id(app)].update(rules)
+        tested.sort(key=lambda task: sum(
+            tested_file.content_tested or tested_file.hash_tested
+            for tested_file in task[1].rules.tested_files))
+
+        lock = threading.Lock()
+        accepting = [True]
+        dependencies = ({id(app): (set(), {}) for app in searched} if
+                        state is not None else {})
+
+        def run(task):
+            """Search for task's rules, and keep the results in time."""
+            kind, app, rules, function = task
+            if time.time() >= deadline:
+                return
+            tracking = state is not None and kind != "processes"
+            if tracking:
+                self.index.start_tracking()
+                self.scanner.start_tracking()
+            with Stats.measure(app.name):
+                result = function()
+            if tracking:
+                directories = self.index.stop_tracking()
+                files = self.scanner.stop_tracking()
+            with lock:
+                if not accepting[0]:
+                    return
+                if kind == "processes":
+                    app.processes = result
+                else:
+                    app.add_matches(result)
+                if tracking:
+                    dependencies[id(app)][0].update(directories)
+                    dependencies[id(app)][1].update(files)
+                unsearched[id(app)].difference_update(rules)
+
+        for stage in (checks, self.plan, globs, self.plan_contents, tested):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            if callable(stage):
+                map_concurrently(stage, [searched], 1, remaining)
+            else:
+                map_concurrently(run, stage, jobs, remaining)
+        with lock:
+            accepting[0] = False
+
+        skipped = 0
+        for app in self.apps:
+            rules = ([rule.description for rule in app.rules.tested_files +
+                      app.rules.files] +
+                     sorted(set(rule.description for rule in
+                                app.rules.processes)))
+            app.skipped_rules = [rule for rule in rules if rule in
+                                 unsearched[id(app)]]
+            skipped += len(app.skipped_rules)
+            if id(app) in dependencies and not app.skipped_rules:
+                state.record(app, *dependencies[id(app)])
+        if skipped:
+            self.logger.log("Time ran out before %s rules were searched. "
+                            "Reporting partial results." % skipped,
+                            syslog.LOG_WARNING)
+
+        self.scanner.digest_cache.save()
+        if state is not None:
+            state.save(self.scanner)
+        return not skipped
+
+    def _search_tested_files(self, app, dependents):
+        """Search for app's TestedFiles, then Files depending on them.
+
+        Args:
+            app: App to search for.
+            dependents: List of the FileRules of app's Files which use
+                %KEY% text replacement.
+
+        Returns:
+            Dict of found paths to the rule which found them.
+        """
+        found, env = app.search_tested_files()
+        for rule in dependents:
+            for path, description in app.search_file(rule, env).items():
+                found.setdefault(path, description)
+        return found
+
+    @measured("plan")
+    def plan(self, apps=None):
+        """Plan the index's lookups for apps, before searching them.
+
+        Recursive Path walks are planned, and every File glob and
+        Path listing is answered in one pass over the filesystem (see
+        DirectoryIndex.plan_globs). Files which use %KEY% text
+        replacement depend on TestedFile results, so they are left
+        until each App is searched.
+
+        The lookups are credited to the rules which needed them in
+        Stats, split evenly between rules sharing a lookup, while
+        their time is counted as planning.
+
+        Args:
+            apps: List of Apps to plan for. Defaults to all of them.
+        """
+        requesters = {}
+        keys = []
+        for app in self.apps if apps is None else apps:
+            for tested_file in app.rules.tested_files:
+                key = (app.name, tested_file.description)
+                keys.append(key)
+                for path, depth in zip(tested_file.paths,
+                                       tested_file.path_depths):
+                    self.index.plan_walk(path, depth, tested_file.excludes)
+                    for pattern in ("*", ".*"):
+                        requesters.setdefault(os.path.join(path, pattern),
+                                              []).append(key)
+                for pattern in tested_file.files:
+                    requesters.setdefault(pattern, []).append(key)
+            for rule in app.rules.files:
+                key = (app.name, rule.description)
+                keys.append(key)
+                requesters.setdefault(rule.pattern, []).append(key)
+        Stats.prepare(keys)
+        self.index.plan_globs([pattern for pattern in requesters if "%" not
+                               in pattern], requesters)
+
+    @measured("plan")
+    def plan_contents(self, apps=None):
+        """Tell the scanner which files apps' Regexes will be tested in.
+
+        Each file is then read once, and searched for the Regexes of
+        every App's TestedFiles pointing at it together, rather than
+        once per App. TestedFiles with Hashes only test the files
+        whose digests match, so they're left to register their own.
+
+        As with plan, lookups are credited to each TestedFile in
+        Stats, and their time is counted as planning.
+
+        Args:
+            apps: List of Apps to plan for. Defaults to all of them.
+        """
+        for app in self.apps if apps is None else apps:
+            for tested_file in app.rules.tested_files:
+                if not tested_file.content_tested or tested_file.hash_tested:
+                    continue
+                with Stats.share([(app.name, tested_file.description)]):
+                    fnames = app.tested_file_candidates(tested_file)
+                for fname in fnames or ():
+                    self.scanner.register(fname, tested_file.regexen)
+
+    def find_in_roots(self, roots, jobs=1, writer=None):
+        """Search for all Apps under each of roots.
+
+        Each root is searched by a separate worker process (see
+        search_root), running up to jobs threads, as if it were the
+        running system's "/". Processes are not looked for.
+
+        Args:
+            roots: List of folders, e.g. mounted disk images or
+                backup snapshots.
+            jobs: Number of Apps to search for at once in each root.
+            writer: Optional ReportWriter. The findings for each root
+                are written to it, tagged with the root, in order.
+
+        Returns:
+            List of the found paths for each root: a list of dicts of
+            found paths to the rule which found them, one per App.
+        """
+        rules = [app.rules for app in self.apps]
+        if len(roots) == 1:
+            # Searched in this process, whose Logger is already set up
+            # (init_root_worker's after_fork is only for pool workers).
+            _ROOT_WORKER["rules"] = rules
+            _ROOT_WORKER["jobs"] = jobs
+            results = [search_root(roots[0])]
+        else:
+            pool = multiprocessing.Pool(
+                min(len(roots), multiprocessing.cpu_count()),
+                init_root_worker, (rules, jobs))
+            results = pool.imap(search_root, roots)
+
+        found = []
+        try:
+            for root, matches in zip(roots, results):
+                found.append(matches)
+                if writer is None:
+                    continue
+                for app, matched_rules in zip(self.apps, matches):
+                    app.matched_rules = matched_rules
+                    app.found = set(matched_rules)
+                    app.processes = {}
+                    writer.write_app(app, root)
+        finally:
+            if len(roots) > 1:
+                pool.close()
+                pool.join()
+        return found
+
+    def warn_if_old_version(self, adf):
+        """Warn the user if the SavingThrow version is older than the ADF.
+
+        An ADF file may optionally specify a minimum "SavingThrowVersion"
+        which is needed for all features to work. The ADF may still work
+        at reduced capacity.
+
+        Args:
+            adf: Dict of compiled ADF rules (see compile_adf).
+        """
+        logger = Logger()
+        if adf["too_old"]:
+            app_names = ", ".join([str(app["name"]) for app in adf["apps"]])
+            logger.log("%s require(s) SavingThrow version %s" %
+                       (app_names, adf["min_version"]))
+
+    def report(self, writer):
+        """Write a report of all Apps' findings with a ReportWriter."""
+        writer.start()
+        for app in self.apps:
+            writer.write_app(app)
+        writer.finish()
+
+    def report_string(self):
+        """Generate a nicely formatted string of findings."""
+        output = StringIO.StringIO()
+        writer = ReportWriter(output)
+        for app in self.apps:
+            writer.write_app(app)
+        return output.getvalue()
+
+    def report_to_stdout(self):
+        """Report back on identified files to STDOUT."""
+        self.report(TextReportWriter(sys.stdout))
+
+    def extension_attribute(self):
+        """Report back on found files in extension attribute format.
+
+        For use with the Casper suite.
+
+        Generates a report as XML and prints to STDOUT. Report is
+        wrapped in <result> tags, with identified files numbered and
+        ordered by App type.
+        """
+        self.report(ExtensionAttributeWriter(sys.stdout))
+
+    @measured("remove")
+    def remove(self, dry_run=False, stream=None):
+        """Delete identified files and directories.
+
+        Unloads launchd jobs, then removes everything found, as
+        planned by a RemovalPlan, REMOVE_THREADS at a time.
+
+        Files removed between App.find() and now are logged as
+        already gone.
+
+        Args:
+            dry_run: Don't change anything; write the plan, with byte
+                counts, to stream instead.
+            stream: File-like object to write a dry run's plan to.
+
+        Raises:
+            Handles expected exceptions by logging.
+        """
+        plan = RemovalPlan(self.apps)
+        if dry_run:
+            plan.run(REMOVE_THREADS, dry_run=True)
+            plan.write(stream)
+            return
+        self.unload_and_disable_launchd_jobs(
+            [afile for app in self.apps for afile in app.found])
+        plan.run(REMOVE_THREADS)
+        self.log_removal(plan, "Removed", "remove")
+
+    def log_removal(self, plan, done, failed):
+        """Log the outcome of each of a RemovalPlan's entries.
+
+        Args:
+            plan: RemovalPlan which has been run.
+            done: Verb for removed files, e.g. "Removed".
+            failed: Verb for files which couldn't be, e.g. "remove".
+        """
+        removed = 0
+        for entry in plan.entries:
+            names = ",".join(entry["apps"])
+            if entry["error"] is not None:
+                self.logger.log("Failed to %s file: %s:%s Error: %s" % (
+                    failed, names, entry["path"], entry["error"]))
+                continue
+            if entry["kind"] == "missing":
+                self.logger.log("Already gone: %s:%s" % (
+                    names, entry["path"]), syslog.LOG_INFO)
+                continue
+            removed += entry["bytes"]
+            self.logger.log("%s file: %s:%s (%s bytes)" % (
+                done, names, entry["path"], entry["bytes"]))
+            for path, apps in entry["covered"]:
+                self.logger.log("%s file: %s:%s (with %s)" % (
+                    done, ",".join(apps), path, entry["path"]),
+                                syslog.LOG_INFO)
+        self.logger.log("%s %s items (%s bytes) on %s filesystems" % (
+            done, len(plan), removed, len(plan.groups())), syslog.LOG_INFO)
+
+    @measured("quarantine")
+    def quarantine(self, dry_run=False, stream=None):
+        """Quarantine files to a zip archive in the CACHE.
+
+        Disables launchd jobs, then streams all files and directories
+        into a timestamped ZIP64 archive in the Quarantine subfolder
+        of the CACHE, along with a manifest. Once the archive has been
+        written and checked, the originals are deleted, as planned by
+        a RemovalPlan.
+
+        Files removed between App.find() and now are logged as
+        already gone.
+
+        Args:
+            dry_run: Don't change anything; write the plan, with byte
+                counts, to stream instead.
+            stream: File-like object to write a dry run's plan to.
+
+        Raises:
+            Handles expected exceptions by logging.
+        """
+        plan = RemovalPlan(self.apps)
+        if dry_run:
+            plan.run(REMOVE_THREADS, dry_run=True)
+            plan.write(stream)
+            return
+        timestamp = time.strftime("%Y%m%d-%H%M%S")
+        # Let's not bother if the list is empty.
+        if plan:
+            quarantine_dir = os.path.join(CACHE, "Quarantine")
+            if not os.path.exists(quarantine_dir):
+                os.mkdir(quarantine_dir)
+
+            self.unload_and_disable_launchd_jobs(
+                [afile for app in self.apps for afile in app.found])
+
+            zpath = os.path.join(quarantine_dir, "%s-Quarantine.zip" %
+                                 timestamp)
+            archive = QuarantineArchive(zpath, QUARANTINE_THREADS)
+            zpath = archive.path
+            for entry in list(plan.entries):
+                if entry["kind"] == "missing":
+                    continue
+                try:
+                    archive.add(entry["path"], ",".join(entry["apps"]))
+                except (IOError, OSError) as error:
+                    self.logger.log("Failed to quarantine file: %s:%s "
+                                    "Error:  %s" % (",".join(entry["apps"]),
+                                                    entry["path"], error))
+                    plan.discard(entry)
+            archive.close()
+            self.logger.log("Zipped quarantined files to:  %s" % zpath)
+
+            if not archive.verify():
+                self.logger.log("Quarantine archive %s is incomplete. Not "
+                                "removing any files." % zpath)
+                return
+
+            plan.run(REMOVE_THREADS)
+            self.log_removal(plan, "Quarantined", "quarantine")
+
+    def unload_and_disable_launchd_jobs(self, files):
+        """Unload and disable launchd configuration files.
+
+        Unloads launchd jobs with the -w flag to prevent jobs from
+        respawning. The launchctl calls are made concurrently by the
+        controller's CommandRunner, each with a LAUNCHCTL_TIMEOUT.
+
+        Args:
+            files: An iterable of file paths on the system. Method will
+                handle determining which files are launchd config
+                files.
+        """
+        launchd_config_files = sorted({afile for afile in files if
+                                       is_launchd_config(afile)})
+        for afile in launchd_config_files:
+            self.logger.log("Unloading %s" % afile, syslog.LOG_INFO)
+        # Toss out any stderr messages about things not being loaded.
+        # We just want them off; don't care if they're not running to
+        # begin with.
+        results = self.runner.run_all(
+            [[LAUNCHCTL, "unload", "-w", afile] for afile in
+             launchd_config_files], LAUNCHCTL_TIMEOUT)
+        for afile, (_, result) in zip(launchd_config_files, results):
+            if result:
+                self.logger.log("Launchctl response: %s" % result.strip())
+
+    @measured("kill")
+    def kill(self):
+        """Kill all processes found by controlled App(s).
+
+        All processes are sent SIGTERM together, and any still running
+        after KILL_WAIT seconds are sent SIGKILL.
+        """
+        kill_list = sorted({int(pid) for app in self.apps for process in
+                            app.processes.values() for pid in process})
+        killed, failed = self.runner.terminate(kill_list, KILL_WAIT)
+        for process_id in killed:
+            self.logger.log("Killed process ID: %s" % process_id)
+        for process_id in failed:
+            self.logger.log("Failed to kill process ID: %s" % process_id)
+
+
+class CommandRunner(object):
+    """Runs external commands and signals processes.
+
+    Everything SavingThrow does to the rest of the system outside of
+    the filesystem goes through here, so that it can be batched, and
+    so a stand-in can be supplied for testing.
+
+    Attributes:
+        spawned: Count of subprocesses started.
+    """
+
+    def __init__(self, send_signal=os.kill, threads=8):
+        """Initialize a runner.
+
+        Args:
+            send_signal: Function taking a PID and signal number.
+            threads: Number of commands to run at once in run_all.
+        """
+        self.send_signal = send_signal
+        self.threads = threads
+        self.spawned = 0
+
+    def run(self, args, timeout=None):
+        """Run a command, killing it if it takes too long.
+
+        Args:
+            args: List of command arguments.
+            timeout: Optional number of seconds to allow.
+
+        Returns:
+            Tuple of (returncode, combined stdout and stderr). The
+            returncode is None if the command couldn't be started.
+        """
+        try:
+            # Give the command its own process group, so a timeout
+            # can take out anything it started too.
+            process = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT,
+                                       preexec_fn=os.setpgrp)
+        except OSError as error:
+            return None, "%s: %s" % (args[0], error)
+        self.spawned += 1
+        Stats.count("subprocesses")
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, self._kill_quietly, [process])
+            timer.start()
+        try:
+            output = process.communicate()[0]
+        finally:
+            if timer:
+                timer.cancel()
+        if process.returncode < 0 and timeout is not None:
+            output += "(timed out after %s seconds)" % timeout
+        return process.returncode, output
+
+    @staticmethod
+    def _kill_quietly(process):
+        """Kill a subprocess group which may already have finished."""
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def run_all(self, commands, timeout=None):
+        """Run a list of commands concurrently.
+
+        Args:
+            commands: List of argument lists.
+            timeout: Optional number of seconds to allow each command.
+
+        Returns:
+            List of (returncode, output) tuples, in the order of
+            commands.
+        """
+        return map_concurrently(lambda args: self.run(args, timeout),
+                                commands, self.threads)
+
+    def terminate(self, pids, wait):
+        """Send SIGTERM to all pids, then SIGKILL to any left after wait.
+
+        Args:
+            pids: List of integer process IDs.
+            wait: Number of seconds to give processes to exit.
+
+        Returns:
+            Tuple of lists of PIDs: (killed, failed). PIDs which had
+            already exited are in neither.
+        """
+        signalled = []
+        failed = []
+        for pid in pids:
+            try:
+                self.send_signal(pid, signal.SIGTERM)
+                signalled.append(pid)
+            except OSError as error:
+                if error.errno == errno.ESRCH:
+                    # Already gone.
+                    continue
+                failed.append(pid)
+
+        remaining = signalled[:]
+        deadline = time.time() + wait
+        while remaining and time.time() < deadline:
+            time.sleep(0.05)
+            remaining = [pid for pid in remaining if self._is_running(pid)]
+
+        for pid in remaining[:]:
+            try:
+                self.send_signal(pid, signal.SIGKILL)
+            except OSError as error:
+                if error.errno != errno.ESRCH:
+                    failed.append(pid)
+                    remaining.remove(pid)
+        # Give SIGKILL a moment to be delivered.
+        if remaining:
+            time.sleep(0.05)
+            failed.extend(pid for pid in remaining if self._is_running(pid))
+
+        killed = [pid for pid in signalled if pid not in failed]
+        return killed, failed
+
+    def _is_running(self, pid):
+        """Return whether pid is still running."""
+        try:
+            # Reap it if it happens to be our own child.
+            if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                return False
+        except OSError:
+            pass
+        try:
+            self.send_signal(pid, 0)
+        except OSError as error:
+            return error.errno != errno.ESRCH
+        return True
+
+
+class PollingWatcher(object):
+    """Notices changes to folders and files by checking them.
+
+    Folders are compared by mtime, and files by their ContentScanner
+    key, each time changes is called.
+    """
+
+    def __init__(self):
+        """Initialize a watcher watching nothing."""
+        self._directories = {}
+        self._files = {}
+
+    @staticmethod
+    def _mtime(path):
+        """Return the mtime of path, or None if it's missing."""
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def fileno(self):
+        """Return None; there's nothing to wait on but the clock."""
+        return None
+
+    def watch(self, directories, files):
+        """Replace what is watched with directories and files."""
+        self._directories = {directory: self._directories.get(
+            directory, self._mtime(directory)) for directory in directories}
+        self._files = {path: self._files.get(
+            path, ContentScanner.file_key(path)) for path in files}
+
+    def changes(self):
+        """Return the set of watched paths changed since last asked."""
+        changed = set()
+        for directory, mtime in self._directories.items():
+            current = self._mtime(directory)
+            if current != mtime:
+                self._directories[directory] = current
+                changed.add(directory)
+        for path, key in self._files.items():
+            current = ContentScanner.file_key(path)
+            if current != key:
+                self._files[path] = current
+                changed.add(path)
+        return changed
+
+
+class InotifyWatcher(object):
+    """Notices changes to folders and files with Linux's inotify.
+
+    Each folder is watched for changes to itself and its entries;
+    files are covered by watching their folders. A missing folder is
+    covered by watching its nearest existing parent.
+
+    Raises:
+        OSError: On __init__, if inotify isn't available.
+    """
+
+    _MASK = (0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400 |
+             0x800)  # Modify, attrib, writes, moves, creation, deletion.
+    _OVERFLOW = 0x4000
+    _IGNORED = 0x8000
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self):
+        """Initialize an inotify instance."""
+        libc = ctypes.CDLL(ctypes_util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        if not hasattr(libc, "inotify_init"):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self._libc = libc
+        self._fd = libc.inotify_init()
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self._watches = {}
+        self._descriptors = {}
+        self._proxies = {}
+
+    def fileno(self):
+        """Return the descriptor which becomes readable on changes."""
+        return self._fd
+
+    def watch(self, directories, files):
+        """Replace what is watched with directories and files."""
+        wanted = set(directories) | {os.path.dirname(path) for path in
+                                     files}
+        self._proxies = {}
+        watched = set()
+        for directory in wanted:
+            target = directory
+            while not self._add(target):
+                parent = os.path.dirname(target)
+                if parent == target:
+                    break
+                target = parent
+            if target != directory:
+                self._proxies.setdefault(target, set()).add(directory)
+            watched.add(target)
+        for directory in set(self._descriptors) - watched:
+            self._libc.inotify_rm_watch(self._fd,
+                                        self._descriptors.pop(directory))
+
+    def _add(self, directory):
+        """Watch directory; return whether that was possible."""
+        if directory in self._descriptors:
+            return True
+        descriptor = self._libc.inotify_add_watch(
+            self._fd, to_str(directory), self._MASK)
+        if descriptor < 0:
+            return False
+        self._watches[descriptor] = directory
+        self._descriptors[directory] = descriptor
+        return True
+
+    def changes(self):
+        """Return the set of watched paths changed since last asked.
+
+        Returns None if changes were lost, and everything should be
+        treated as changed.
+        """
+        changed = set()
+        try:
+            data = os.read(self._fd, 65536)
+        except OSError as error:
+            if error.errno in (errno.EAGAIN, errno.EINTR):
+                return changed
+            raise
+        offset = 0
+        while offset < len(data):
+            descriptor, mask, _, length = self._EVENT.unpack_from(data,
+                                                                  offset)
+            offset += self._EVENT.size
+            name = data[offset:offset + length].rstrip("\0")
+            offset += length
+            if mask & self._OVERFLOW:
+                return None
+            directory = self._watches.get(descriptor)
+            if directory is None:
+                continue
+            if mask & self._IGNORED:
+                # The folder itself is gone.
+                del self._watches[descriptor]
+                self._descriptors.pop(directory, None)
+            changed.add(directory)
+            changed.update(self._proxies.get(directory, ()))
+            if name:
+                changed.add(os.path.join(directory, name))
+        return changed
+
+
+class Daemon(object):
+    """Keeps findings up to date, and serves them on a Unix socket.
+
+    Compiled rules, the directory index and search results stay in
+    memory. The folders and files each App's search looked at are
+    watched (with inotify where available, otherwise by polling every
+    DAEMON_POLL_INTERVAL seconds), and only Apps whose inputs changed
+    are searched again. The process table is refreshed every
+    DAEMON_PROCESS_INTERVAL seconds, and ADFs are updated every
+    DAEMON_RELOAD_INTERVAL seconds.
+
+    A client sends a report format name (see REPORT_WRITERS) and a
+    newline, and gets back the current report in that format.
+
+    Attributes:
+        controller: FileController holding the Apps.
+        socket_path: Path of the Unix socket to serve on.
+        jobs: Number of Apps to search for at once.
+        watcher: InotifyWatcher, or PollingWatcher.
+    """
+
+    def __init__(self, controller, socket_path, jobs=1):
+        """Initialize a daemon for controller's Apps."""
+        self.controller = controller
+        self.socket_path = socket_path
+        self.jobs = jobs
+        self._dependencies = {}
+        try:
+            self.watcher = InotifyWatcher()
+        except (OSError, AttributeError) as error:
+            Logger().log("Watching for changes by polling (%s)" % error,
+                         syslog.LOG_INFO)
+            self.watcher = PollingWatcher()
+
+    def evaluate(self, apps):
+        """Search for apps, recording what each one looked at."""
+        index = self.controller.index
+        scanner = self.controller.scanner
+
+        def evaluate_app(app):
+            """Search for app, tracking its inputs."""
+            index.start_tracking()
+            scanner.start_tracking()
+            app.find()
+            return index.stop_tracking(), set(scanner.stop_tracking())
+
+        self.controller.plan(apps)
+        self.controller.plan_contents(apps)
+        for app, dependencies in zip(apps, map_concurrently(
+                evaluate_app, apps, self.jobs)):
+            self._dependencies[id(app)] = dependencies
+        self.controller.scanner.digest_cache.save()
+        self._watch()
+
+    def _watch(self):
+        """Watch everything the current Apps depend on."""
+        directories = set()
+        files = set()
+        for app in self.controller.apps:
+            app_directories, app_files = self._dependencies[id(app)]
+            directories.update(app_directories)
+            files.update(app_files)
+        self.watcher.watch(directories, files)
+
+    def update(self, changed):
+        """Search again for the Apps affected by changed paths.
+
+        Args:
+            changed: Set of changed paths, or None if everything may
+                have changed.
+        """
+        if changed is not None and not changed:
+            return
+        index = self.controller.index
+        if changed is None:
+            index.clear()
+            apps = self.controller.apps
+        else:
+            for path in changed:
+                index.invalidate(path)
+            apps = []
+            for app in self.controller.apps:
+                directories, files = self._dependencies[id(app)]
+                if not (changed.isdisjoint(directories) and
+                        changed.isdisjoint(files)):
+                    apps.append(app)
+        if apps:
+            Logger().log("Changes found; searching again for: %s" % ", ".join(
+                app.name for app in apps), syslog.LOG_INFO)
+            self.evaluate(apps)
+
+    def refresh_processes(self):
+        """Look up every App's processes afresh."""
+        self.controller.process_table.refresh()
+        for app in self.controller.apps:
+            app.find_processes()
+
+    def reload(self):
+        """Update the ADFs, and search again if any rules changed."""
+        controller = self.controller
+        loaded = FileController(runner=controller.runner)
+        loaded.index = controller.index
+        loaded.process_table = controller.process_table
+        loaded.scanner = controller.scanner
+        loaded.add_apps_from_urls(ADF_FILE_SOURCES)
+        if ([app.rules for app in loaded.apps] !=
+                [app.rules for app in controller.apps]):
+            Logger().log("ADFs have changed; searching again.",
+                         syslog.LOG_INFO)
+            self._dependencies = {}
+            controller.apps = loaded.apps
+            self.evaluate(controller.apps)
+
+    def report(self, report_format):
+        """Return the current report in report_format."""
+        output = StringIO.StringIO()
+        self.controller.report(REPORT_WRITERS[report_format](output))
+        return output.getvalue()
+
+    def serve(self, server):
+        """Answer one query on server's Unix socket."""
+        connection = server.accept()[0]
+        try:
+            connection.settimeout(DAEMON_QUERY_TIMEOUT)
+            request = connection.recv(64).strip()
+            connection.sendall(self.report(
+                request if request in REPORT_WRITERS else "ea"))
+        except socket.error as error:
+            Logger().log("Unable to answer query: %s" % error,
+                         syslog.LOG_INFO)
+        finally:
+            connection.close()
+
+    def run(self):
+        """Search, then keep the findings up to date until killed."""
+        if query_daemon(self.socket_path, "ea") is not None:
+            Logger().log("A SavingThrow daemon is already listening on %s" %
+                         self.socket_path)
+            return
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.evaluate(self.controller.apps)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            server.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        server.listen(16)
+        # Exit through the finally clause below on SIGTERM.
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+        Logger().log("Serving findings on %s" % self.socket_path,
+                     syslog.LOG_INFO)
+
+        now = time.time()
+        next_poll = now + DAEMON_POLL_INTERVAL
+        next_processes = now + DAEMON_PROCESS_INTERVAL
+        next_reload = now + DAEMON_RELOAD_INTERVAL
+        try:
+            while True:
+                waiting = [server]
+                if self.watcher.fileno() is not None:
+                    waiting.append(self.watcher.fileno())
+                timeout = max(0, min(next_poll, next_processes,
+                                     next_reload) - time.time())
+                try:
+                    readable = select.select(waiting, [], [], timeout)[0]
+                except select.error as error:
+                    if error.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if self.watcher.fileno() in readable:
+                    self.update(self.watcher.changes())
+
+                now = time.time()
+                if now >= next_poll:
+                    if self.watcher.fileno() is None:
+                        self.update(self.watcher.changes())
+                    next_poll = now + DAEMON_POLL_INTERVAL
+                if now >= next_processes:
+                    self.refresh_processes()
+                    next_processes = now + DAEMON_PROCESS_INTERVAL
+                if now >= next_reload:
+                    self.reload()
+                    next_reload = now + DAEMON_RELOAD_INTERVAL
+                if server in readable:
+                    self.serve(server)
+        finally:
+            server.close()
+            os.remove(self.socket_path)
+
+
+def query_daemon(socket_path, report_format):
+    """Ask a running Daemon for its report.
+
+    Args:
+        socket_path: Path of the daemon's Unix socket.
+        report_format: Name of a report format (see REPORT_WRITERS).
+
+    Returns:
+        The report text, or None if no daemon answered.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(DAEMON_QUERY_TIMEOUT)
+    try:
+        client.connect(socket_path)
+        client.sendall(report_format + "\n")
+        chunks = []
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    except socket.error:
+        return None
+    finally:
+        client.close()
+    return "".join(chunks) or None
+
+
+def is_launchd_config(path):
+    """Return whether path is in a launchd config location.
+
+    System-level locations, and the LaunchAgents of any home folder in
+    /Users, count.
+    """
+    directory = os.path.dirname(path.rstrip("/"))
+    if directory in LAUNCHD_CONFIG_LOCATIONS:
+        return True
+    parts = directory.split("/")
+    return (len(parts) == 5 and parts[:2] == ["", "Users"] and
+            parts[3:] == ["Library", "LaunchAgents"])
+
+
+class Rule(object):
+    """Base class for immutable rule objects.
+
+    Rules are built once, when an ADF is loaded, and shared by every
+    search for the rest of the run; nothing may change them. Strings
+    in them are interned, so paths and patterns repeated across
+    definitions are only stored once. Subclasses list their fields in
+    __slots__, and take one constructor argument per field, in order.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, *values):
+        """Set each of the fields to the corresponding value."""
+        if len(values) != len(self.__slots__):
+            raise TypeError("%s takes %s values" % (type(self).__name__,
+                                                    len(self.__slots__)))
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, freeze(value))
+
+    def __setattr__(self, name, value):
+        """Refuse to change a rule."""
+        raise AttributeError("%s is immutable" % type(self).__name__)
+
+    def __delattr__(self, name):
+        """Refuse to change a rule."""
+        raise AttributeError("%s is immutable" % type(self).__name__)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.values() == other.values()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.values())
+
+    def __reduce__(self):
+        """Pickle by value, e.g. for worker processes."""
+        return (type(self), self.values())
+
+    def __repr__(self):
+        return "%s%r" % (type(self).__name__, self.values())
+
+    def values(self):
+        """Return a tuple of the rule's field values, in order."""
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+
+class FileRule(Rule):
+    """A File element: a path or glob, which may use %KEY% replacement.
+
+    Attributes:
+        pattern: The path or glob.
+        description: Description of the rule, for reports.
+    """
+
+    __slots__ = ("pattern", "description")
+
+
+class TestedFileRule(Rule):
+    """A TestedFile element.
+
+    Attributes:
+        description: Description of the rule, for reports.
+        paths: Tuple of the Path folders.
+        path_depths: Tuple of the depth of each Path.
+        excludes: Tuple of the ExcludePath folders.
+        filename_regexen: Tuple of the valid FilenameRegexes.
+        files: Tuple of the File paths or globs.
+        regexen: Tuple of the valid Regexes.
+        content_tested: Whether the TestedFile has any Regexes.
+        hash_tested: Whether the TestedFile has any Hashes.
+        hashes: Tuple of the valid Hashes (lowercase hex SHA-256).
+        replacement_key: ReplacementKey name, or None.
+    """
+
+    __slots__ = ("description", "paths", "path_depths", "excludes",
+                 "filename_regexen", "files", "regexen", "content_tested",
+                 "hash_tested", "hashes", "replacement_key")
+
+
+class ProcessRule(Rule):
+    """A Process element: the exact name of a process.
+
+    Attributes:
+        name: The process name.
+        description: Description of the rule, for reports.
+    """
+
+    __slots__ = ("name", "description")
+
+
+class AppRules(Rule):
+    """All of the rules of an App element.
+
+    Attributes:
+        name: The App's name.
+        tested_files: Tuple of TestedFileRules.
+        files: Tuple of FileRules.
+        processes: Tuple of ProcessRules.
+        digest: SHA-256 of the rules, identifying them between runs.
+    """
+
+    __slots__ = ("name", "tested_files", "files", "processes", "digest")
+
+    @classmethod
+    def from_dict(cls, rules):
+        """Build AppRules from a dict made by parse_app_element."""
+        tested_files = []
+        for num, tested_file in enumerate(rules["tested_files"], 1):
+            tested_files.append(TestedFileRule(
+                "TestedFile %s: %s" % (num, ", ".join(
+                    tested_file["paths"] + tested_file["files"])),
+                *[tested_file[name] for name in
+                  TestedFileRule.__slots__[1:]]))
+        return cls(rules["name"], tested_files,
+                   [FileRule(pattern, "File: %s" % pattern) for pattern in
+                    rules["files"]],
+                   [ProcessRule(name, "Process: %s" % name) for name in
+                    rules["processes"]], rules["digest"])
+
+
+class App(object):
+    """Represents one 'product', as defined in an App
+    Definition File (ADF).
+
+    Searching never changes the rules, so they can be shared and
+    reused. Findings are kept as found paths (interned, like the
+    rules' strings) mapped to the description of the rule which
+    found them, which is shared rather than copied.
+
+    Attributes:
+        rules: AppRules for the product.
+        index: DirectoryIndex used to answer glob searches.
+        process_table: ProcessTable used to look up running processes.
+        scanner: ContentScanner used to search file contents.
+        found: Set of files found on the current filesystem.
+        matched_rules: Dictionary of found file: description of the
+            rule which found it.
+        processes: Dictionary of ProcessName: PIDs for currently
+            running processes.
+        skipped_rules: List of descriptions of the rules which weren't
+            searched for because time ran out (see
+            FileController.find_before).
+        name:
+            String name of product from ADF/AppName.
+    """
+
+    __slots__ = ("rules", "index", "process_table", "scanner", "_env",
+                 "found", "matched_rules", "processes", "skipped_rules",
+                 "name")
+
+    def __init__(self, rules, index=None, process_table=None, scanner=None):
+        """Init instance variables.
+
+        Nothing is searched for until find() is called.
+
+        Args:
+            rules: AppRules for one App element of an App Definition
+                File.
+            index: Optional DirectoryIndex to share with other Apps.
+                If omitted, the App gets one of its own.
+            process_table: Optional ProcessTable to share with other
+                Apps. If omitted, the App gets one of its own.
+            scanner: Optional ContentScanner to share with other Apps.
+                If omitted, the App gets one of its own.
+        """
+        self.rules = rules
+        self.index = index if index is not None else DirectoryIndex()
+        self.process_table = (process_table if process_table is not None
+                              else ProcessTable())
+        self.scanner = scanner if scanner is not None else ContentScanner()
+        self._env = {}
+        self.found = set()
+        self.matched_rules = {}
+        self.processes = {}
+        self.skipped_rules = []
+        self.name = rules.name
 
+    def find(self):
+        """Identify files and processes on the system."""
+        with Stats.measure(self.name):
+            self._find()
 
-__version__ = "1.1.0"
+    def _find(self):
+        """Identify files and processes on the system."""
+        logger = Logger()
+        self.reset()
+        logger.log("Searching for files and processes defined in: %s"
+                   % self.name, syslog.LOG_DEBUG)
+        # First look for regex-confirmed files to prepare for text
+        # replacement.
+        matches, self._env = self.search_tested_files()
+        self.add_matches(matches)
 
+        # Now look for regular files.
+        for rule in self.rules.files:
+            self.add_matches(self.search_file(rule, self._env))
 
-# Add any URLs to nefarious file lists
-# format like this
-# NEFARIOUS_FILE_SOURCES = ["https://blah.com/tacos.adf",
-#                           "https://blah.com/more-tacos.adf"]
+        if self.found:
+            logger.log("Found files for: %s" % self.name)
 
-# Included for historical reasons: see note at top.
-NEFARIOUS_FILE_SOURCES = []
-ADF_FILE_SOURCES = []
+        self.find_processes()
 
-# Include Apple's identified Adware files by default.
-# https://support.apple.com/en-us/ht203987
-HT203987_URL = "https://raw.githubusercontent.com/SavingThrows/AdwareDefinitionFiles/master/Apple-HT203987.adf"  # pylint: disable=line-too-long
-NEFARIOUS_FILE_SOURCES.append(HT203987_URL)
+    def reset(self):
+        """Forget everything found so far."""
+        self._env = {}
+        self.found = set()
+        self.matched_rules = {}
+        self.skipped_rules = []
 
-ADF_FILE_SOURCES.extend(NEFARIOUS_FILE_SOURCES)
+    def add_matches(self, matches):
+        """Add files found by a search to found and matched_rules.
 
-CACHE = "/Library/Application Support/SavingThrow"
+        Files already found keep the rule which found them first.
 
+        Args:
+            matches: Dict of found paths to the rule which found them.
+        """
+        for path, rule in matches.items():
+            path = intern(path)
+            self.matched_rules.setdefault(path, rule)
+            self.found.add(path)
 
-class Logger(object):
-    """Simple logging class with shared verbosity state."""
+    def search_tested_files(self):
+        """Search for the files matching the App's TestedFiles.
 
-    verbose = False
+        Candidate files for every TestedFile are gathered before any
+        are opened, so that the scanner can search each file for all
+        of its patterns in one pass.
 
-    @classmethod
-    def enable_verbose(cls):
-        """Set all Loggers to verbose."""
-        cls.verbose = True
+        Returns:
+            Tuple of (dict of found paths to the rule which found
+            them, dict of ReplacementKey names to the text they
+            matched).
+        """
+        logger = Logger()
+        env = {}
+        candidates = {}
+        content_tests = []
+        for tested_file in self.rules.tested_files:
+            rule = tested_file.description
+            with Stats.measure(self.name, rule):
+                fnames = self.tested_file_candidates(tested_file)
+                if fnames is None:
+                    logger.log("Paths supplied for %s, but no "
+                               "FilenameRegex or Hash provided. Skipping "
+                               "this TestedFile." %
+                               self.name, syslog.LOG_WARNING)
+                    continue
 
-    def log(self, message, log_level=syslog.LOG_ALERT):
-        """Log to the syslog, and if verbose, also to stdout."""
-        syslog.syslog(log_level, message)
-        if self.verbose:
-            print message
+                # Keep only files with one of the Hashes, if any.
+                if tested_file.hash_tested:
+                    hashes = set(tested_file.hashes)
+                    digests = self.scanner.digests(fnames) if hashes else {}
+                    fnames = [fname for fname in fnames if
+                              digests.get(fname) in hashes]
 
-    @classmethod
-    def vlog(cls, message, log_level=syslog.LOG_ALERT):
-        """Log to the syslog and to stdout."""
-        syslog.syslog(log_level, message)
-        print message
+                # Get the regexen to search within a file for, if any.
+                if tested_file.content_tested:
+                    regexen = tested_file.regexen
+                    for fname in fnames:
+                        self.scanner.register(fname, regexen)
+                    content_tests.append((rule, fnames, regexen,
+                                          tested_file.replacement_key))
+                else:
+                    for fname in fnames:
+                        candidates.setdefault(fname, rule)
 
+        for rule, fnames, regexen, replacement_key in content_tests:
+            with Stats.measure(self.name, rule):
+                for fname in fnames:
+                    matches = self.scanner.search(fname, regexen)
+                    for regex in regexen:
+                        if regex in matches:
+                            candidates.setdefault(fname, rule)
+                            if replacement_key and matches[regex]:
+                                env[replacement_key] = matches[regex][0]
 
-class FileController(object):
-    """Manages a group of App objects.
+        # Confirm the TestedFile matches are still there.
+        found = {}
+        for filename, rule in candidates.items():
+            for match in self.index.glob(filename):
+                found.setdefault(match, rule)
+        return found, env
 
-    Atributes:
-        apps: List of App objects to control.
-        logger: Logger for handling output.
-    """
+    def tested_file_candidates(self, tested_file):
+        """Return the files a TestedFile's contents may be tested in.
 
-    def __init__(self):
-        """Initialize a new controller with its attributes."""
-        self.apps = []
-        self.logger = Logger()
+        Those are the files under its Paths matching one of its
+        FilenameRegexes, and the files its Files glob to. A TestedFile
+        with Hashes needs no FilenameRegex: its digests pick out the
+        files, however they've been renamed, so everything under its
+        Paths is a candidate. Hashes and Regexes aren't checked.
 
-    def add_app_from_url(self, source):
-        """Add an App object to controller from a URL.
+        Args:
+            tested_file: One of the App's TestedFileRules.
 
-        Given an URL to an app description file, attempt to
-        download, parse, and generate a set of targeted files and
-        processes, and add to internal apps list.
+        Returns:
+            List of paths, or None if its Paths have files in them but
+            it has neither a FilenameRegex nor a Hash to choose between
+            them.
+        """
+        # Perform a glob and gather the results for all Path elements.
+        paths = set()
+        for path, depth in zip(tested_file.paths, tested_file.path_depths):
+            paths.update(self.index.descendants(path, depth,
+                                                tested_file.excludes))
+
+        fname_regexen = [compile_regex(fname_regex) for fname_regex in
+                         tested_file.filename_regexen]
+        if paths and not fname_regexen and not tested_file.hash_tested:
+            return None
+
+        # fnames collects full paths to files which match the
+        # FilenameRegex and 'File' elements which glob, for later
+        # content searching should it be specified.
+        if fname_regexen:
+            Stats.count("regex_evaluations",
+                        len(paths) * len(fname_regexen))
+            fnames = [fname_search for fname_search in sorted(paths) if
+                      any(fname_regex.search(fname_search) for fname_regex
+                          in fname_regexen)]
+        else:
+            fnames = sorted(paths)
+
+        # Perform a glob and gather the results for all File elements.
+        globs = [self.index.glob(fname) for fname in tested_file.files]
+        fnames.extend([item for glob_list in globs for item in glob_list])
+        return fnames
+
+    def search_file(self, rule, env=None):
+        """Search for the files matching one of the App's Files.
 
         Args:
-            source: String URL to an ADF file.
+            rule: The File's FileRule.
+            env: Optional dict of ReplacementKey names to the text
+                to replace %KEY% in its pattern with.
 
-        Raises:
-            All expected exceptions are handled.
+        Returns:
+            Dict of found paths to the rule which found them.
         """
-        cache_file = os.path.basename(source)
-        # Handle URLs which don't point at a specific file. e.g.
-        # Permalinked gists can be referenced with a directory URL.
-        if not cache_file:
-            # Remove the protocol and swap slashes to periods.
-            # Drop the final slash (period).
-            cache_file = source.split("//")[1].replace("/", ".")[:-1]
-        cache_path = os.path.join(CACHE, cache_file)
+        with Stats.measure(self.name, rule.description):
+            # Perform text replacments
+            filename = rule.pattern
+            if "%" in filename:
+                for key in env or {}:
+                    filename = filename.replace("%%%s%%" % key, env[key])
+            # Find files on the drive.
+            return dict.fromkeys(self.index.glob(filename), rule.description)
 
-        self.logger.log("Attempting to update App list: %s" % source)
-        app_text = ""
-        try:
-            app_text = urllib2.urlopen(source).read()
-        except urllib2.URLError as error:
-            self.logger.log("Update failed: %s. Looking for cached copy" %
-                            error.message)
+    def find_processes(self):
+        """Identify running processes."""
+        self.processes = self.search_processes()
+        if self.processes:
+            logger = Logger()
+            logger.log("Found processes for: %s" % self.name)
 
-        if app_text:
-            # Update our cached copy.
-            try:
-                with open(cache_path, "w") as cache_file:
-                    cache_file.write(app_text)
-            except IOError as error:
-                if error[0] == 13:
-                    print "Please run as root!"
-                    sys.exit(13)
-                else:
-                    raise error
-        else:
-            # Fallback to the cached file.
-            try:
-                with open(cache_path, "r") as cache_file:
-                    app_text = cache_file.read()
-            except IOError as error:
-                self.logger.log("Error: No cached copy of %s or other error %s"
-                                % (source, error.message))
-        if app_text:
-            try:
-                adf_element = ElementTree.fromstring(app_text)
-            except ElementTree.ParseError as err:
-                logger = Logger()
-                logger.log("ADF at %s is invalid XML (Error: %s)" %
-                           (source, err.message))
-                adf_element = None
-
-            if adf_element is not None:
-                self.warn_if_old_version(adf_element)
-                self.apps.extend([App(app) for app in
-                                     adf_element.findall("App")])
-                # See historical note at top.
-                self.apps.extend([App(app) for app in
-                                     adf_element.findall("Adware")])
-
-    def warn_if_old_version(self, adf_element):
-        """Warn the user if the SavingThrow version is older than the ADF.
+    def search_processes(self):
+        """Determine running process PIDs.
 
-        An ADF file may optionally specify a minimum "SavingThrowVersion"
-        which is needed for all features to work. The ADF may still work
-        at reduced capacity.
+        Process names should correspond to those seen in Bash
+        ps/pgrep, and must match exactly.
+
+        Returns:
+            Dict of running process names to their PIDs.
         """
-        min_version_elem = adf_element.find("SavingThrowVersion")
+        with Stats.measure(self.name, "Processes"):
+            processes = {}
+            for process in set(rule.name for rule in self.rules.processes):
+                pids = self.process_table.pids(process)
+                if pids:
+                    processes[process] = pids
+            return processes
+
+
+def compile_adf(app_text, source):
+    """Parse an ADF into a dict of normalized rules.
+
+    Args:
+        app_text: String contents of an ADF.
+        source: String URL the ADF came from, for logging.
+
+    Returns:
+        Dict with keys "min_version" (string or None), "too_old"
+        (whether this SavingThrow is older than min_version) and
+        "apps" (list of rules dicts from parse_app_element), or None
+        if the ADF is not valid XML.
+    """
+    try:
+        adf_element = ElementTree.fromstring(app_text)
+    except ElementTree.ParseError as err:
         logger = Logger()
-        if min_version_elem is not None:
-            min_version = StrictVersion(min_version_elem.text)
-            if min_version > StrictVersion(__version__):
-                app_names = ", ".join([name.findtext("AppName") for name
-                                          in adf_element.findall("App")])
-                adware_names = ", ".join([name.findtext("AdwareName") for name
-                                          in adf_element.findall("Adware")])
-                if adware_names:
-                    app_names += ", %" % adware_names
-                logger.log("%s require(s) SavingThrow version %s" %
-                           (app_names, min_version))
+        logger.log("ADF at %s is invalid XML (Error: %s)" %
+                   (source, err.message))
+        return None
 
+    # Compare versions now, so that loading stored rules doesn't have
+    # to.
+    min_version = to_str(adf_element.findtext("SavingThrowVersion"))
+    too_old = False
+    if min_version:
+        try:
+            too_old = (distutils_version.StrictVersion(min_version) >
+                       distutils_version.StrictVersion(__version__))
+        except ValueError:
+            Logger().log("Invalid SavingThrowVersion: %s in ADF at %s" %
+                         (min_version, source))
 
-    def report_string(self):
-        """Generate a nicely formatted string of findings."""
-        result = ""
-        for app in self.apps:
-            if app.found or app.processes:
-                result += "Name: %s\n" % app.name
-                for num, found in enumerate(app.found, 1):
-                    result += "File %s: %s\n" % (num, found)
-                for num, found in enumerate(app.processes.items(), 1):
-                    pids_string = ", ".join((str(pid) for pid in found[1]))
-                    result += "Process %s: %s PID: %s\n" % (num, found[0],
-                                                            pids_string)
+    # See historical note at top.
+    apps = (adf_element.findall("App") + adf_element.findall("Adware"))
+    return {"min_version": min_version, "too_old": too_old,
+            "apps": [parse_app_element(app) for app in apps]}
 
-        return result
 
-    def report_to_stdout(self):
-        """Report back on identified files to STDOUT."""
-        report_string = self.report_string()
-        if report_string:
-            result = "Files and processes found:\n%s" % report_string
-        else:
-            result = "No files or processes found."
+def parse_app_element(app):
+    """Convert an App (or Adware) element into a dict of rules.
 
-        Logger.vlog(result)
+    Invalid regular expressions are logged and dropped here, once,
+    rather than every time the App is searched for.
 
-    def extension_attribute(self):
-        """Report back on found files in extension attribute format.
+    Args:
+        app: xml.etree.Element for one App or Adware.
 
-        For use with the Casper suite.
+    Returns:
+        Dict with keys "name", "tested_files", "files", "processes"
+        and "digest" (SHA-256 of the rest of the dict, identifying the
+        rules between runs). Each TestedFile is a dict with keys "paths",
+        "path_depths" (the depth of each Path), "excludes",
+        "filename_regexen", "files", "regexen", "content_tested",
+        "hash_tested", "hashes" (lowercase hex SHA-256 digests) and
+        "replacement_key".
+    """
+    # See historical note at top.
+    name = to_str(app.findtext("AppName") or app.findtext("AdwareName"))
 
-        Generates a report as XML and prints to STDOUT. Report is
-        wrapped in <result> tags, with identified files numbered and
-        ordered by App type.
+    def texts(element, tag):
+        """Return the non-empty texts of element's tag children."""
+        return [to_str(child.text) for child in element.findall(tag) if
+                child.text]
+
+    def valid_regexen(element, tag):
+        """Return the texts of element's tag children that compile."""
+        regexen = []
+        for regex in texts(element, tag):
+            try:
+                compile_regex(regex)
+                regexen.append(regex)
+            except re.error as re_error:
+                Logger().log("Invalid regex: %s with error: %s in ADF for: "
+                             "%s" % (regex, re_error.message, name))
+        return regexen
+
+    def path_depth(element):
+        """Return the depth attribute of a Path element.
+
+        Invalid depths are logged, and clamped to 1..PATH_MAX_DEPTH.
         """
-        result = "<result>"
-        report_string = self.report_string()
-        if report_string:
-            result += "True\n%s" % report_string
-        else:
-            result += "False"
+        text = element.get("depth", "1")
+        try:
+            depth = int(text)
+        except ValueError:
+            depth = 1
+        if str(depth) != text.strip() or not 1 <= depth <= PATH_MAX_DEPTH:
+            depth = min(max(depth, 1), PATH_MAX_DEPTH)
+            Logger().log("Invalid Path depth: %s in ADF for: %s. Using %s." %
+                         (text, name, depth))
+        return depth
 
-        result += "</result>"
-        Logger.vlog(result)
+    def valid_hashes(element):
+        """Return the SHA-256 digests of element's Hash children."""
+        hashes = []
+        for digest in texts(element, "Hash"):
+            digest = digest.strip().lower()
+            if re.match(r"^[0-9a-f]{64}$", digest):
+                hashes.append(digest)
+            else:
+                Logger().log("Invalid SHA-256 Hash: %s in ADF for: %s" %
+                             (digest, name))
+        return hashes
 
-    def remove(self):
-        """Delete identified files and directories.
+    tested_files = []
+    for tested_file in app.findall("TestedFile"):
+        paths = [path for path in tested_file.findall("Path") if path.text]
+        tested_files.append({
+            "paths": [to_str(path.text) for path in paths],
+            "path_depths": [path_depth(path) for path in paths],
+            "excludes": texts(tested_file, "ExcludePath"),
+            "filename_regexen": valid_regexen(tested_file, "FilenameRegex"),
+            "files": texts(tested_file, "File"),
+            "regexen": valid_regexen(tested_file, "Regex"),
+            # A TestedFile whose Regexes are all invalid must still not
+            # match everything.
+            "content_tested": tested_file.find("Regex") is not None,
+            # Likewise for Hashes.
+            "hash_tested": tested_file.find("Hash") is not None,
+            "hashes": valid_hashes(tested_file),
+            "replacement_key": to_str(
+                tested_file.findtext("ReplacementKey"))})
 
-        Unloads launchd jobs, then removes all files and directories.
+    rules = {"name": name, "tested_files": tested_files,
+             "files": texts(app, "File"), "processes": texts(app, "Process")}
+    rules["digest"] = hashlib.sha256(json.dumps(rules,
+                                                sort_keys=True)).hexdigest()
+    return rules
 
-        If files are removed between App.find() and now, it will
-        complain about missing files.
 
-        Raises:
-            Handles expected exceptions by logging.
-        """
-        files = [(afile, app.name) for app in self.apps for afile in
-                 app.found]
-        self.unload_and_disable_launchd_jobs([afile[0] for afile in files])
-        for item, name in files:
-            try:
-                if os.path.isdir(item):
-                    shutil.rmtree(item)
-                elif os.path.isfile(item):
-                    os.remove(item)
-                self.logger.log("Removed file: %s:%s" % (name, item))
-            except OSError as error:
-                self.logger.log("Failed to remove file: %s:%s Error: "
-                                "%s" % (name, item, error))
+def init_root_worker(rules, jobs):
+    """Set up a pool worker process to search roots with search_root.
 
-    def quarantine(self):
-        """Quarantine files to a cache folder.
+    Only for forked pool workers: the Logger's buffer and flusher
+    thread are reset (see Logger.after_fork), so calling this in the
+    main process would lose buffered messages.
 
-        Disables launchd jobs, then moves all files and directories
-        to a Quarantine subfolder of the CACHE. Finally, a zip archive
-        is produced, and files are deleted.
+    Args:
+        rules: List of AppRules, one per App.
+        jobs: Number of Apps to search for at once.
+    """
+    Logger.after_fork()
+    _ROOT_WORKER["rules"] = rules
+    _ROOT_WORKER["jobs"] = jobs
 
-        If files are removed between App.find() and now, it will
-        complain about missing files.
 
-        Raises:
-            Handles expected exceptions by logging.
-        """
-        files = [(afile, app.name) for app in self.apps for afile in
-                 app.found]
-        timestamp = time.strftime("%Y%m%d-%H%M%S")
-        # Let's not bother if the list is empty.
-        if files:
-            quarantine_dir = os.path.join(CACHE, "Quarantine")
-            if not os.path.exists(quarantine_dir):
-                os.mkdir(quarantine_dir)
-            backup_dir = os.path.join(quarantine_dir, timestamp)
-            os.mkdir(backup_dir)
+def search_root(root):
+    """Search for every App's files under root.
 
-            self.unload_and_disable_launchd_jobs([afile[0] for afile in files])
+    Runs in a worker process set up by init_root_worker.
 
-            for item, name in files:
-                try:
-                    shutil.move(item, backup_dir)
-                    self.logger.log("Quarantined file: %s:%s"
-                                    % (name, item))
-                except shutil.Error:
-                    # Raised when moving a directory, and it already
-                    # exists.
-                    counter = 1
-                    success = False
-                    while not success:
-                        if counter > 10:
-                            # Just give up.
-                            break
-                        try:
-                            shutil.move(item, backup_dir + "/%s-%s" % (
-                                os.path.basename(item), counter))
-                            success = True
-                        except shutil.Error:
-                            counter += 1
-                except OSError as error:
-                    self.logger.log("Failed to quarantine file: %s:%s "
-                                    "Error:  %s" % (name, item, error))
+    Returns:
+        List of dicts of found paths to the rule which found them,
+        one per App.
+    """
+    controller = FileController(root=root)
+    controller.apps = [App(rules, controller.index, controller.process_table,
+                           controller.scanner) for rules in
+                       _ROOT_WORKER["rules"]]
+    controller.find(_ROOT_WORKER["jobs"])
+    Logger.flush()
+    return [app.matched_rules for app in controller.apps]
 
-            zpath = os.path.join(quarantine_dir, "%s-Quarantine.zip" %
-                                 timestamp)
-            with zipfile.ZipFile(zpath, "w", zipfile.ZIP_DEFLATED) as zipf:
-                os.chdir(backup_dir)
-                for item in files:
-                    try:
-                        zipf.write(os.path.basename(item[0].rstrip("/")))
-                    except OSError:
-                        pass
 
-            self.logger.log("Zipped quarantined files to:  %s" % zpath)
+def rebase(root, path, follow=True):
+    """Return where path is found, for a filesystem under root.
 
-            shutil.rmtree(backup_dir)
+    Symlinks within path are resolved as they would be on that
+    filesystem: absolute targets are taken relative to root, and ".."
+    stops at root. So a path (say, in an untrusted disk image) never
+    leads to files outside root.
 
-    def unload_and_disable_launchd_jobs(self, files):
-        """Unload and disable launchd configuration files.
+    Args:
+        root: Folder holding the filesystem, or None for "/".
+        path: Path as it would be on that filesystem.
+        follow: Whether to resolve path itself, if it is a symlink,
+            as for os.stat. Pass False for os.lstat.
 
-        Unloads launchd jobs with the -w flag to prevent jobs from
-        respawning.
+    Raises:
+        OSError (ELOOP) if resolving path follows more than
+        ROOT_MAX_LINKS symlinks.
+    """
+    if root is None:
+        return path
+    resolved = resolve_in_root(root, path, follow, [0])
+    return os.path.join(root, resolved.lstrip(os.sep))
 
-        Args:
-            files: An iterable of file paths on the system. Method will
-                handle determining which files are launchd config
-                files.
-        """
-        # Find system-level LaunchD config files.
-        conf_locs = {"/Library/LaunchAgents",
-                     "/Library/LaunchDaemons",
-                     "/System/Library/LaunchAgents",
-                     "/System/Library/LaunchDaemons"}
-
-        # Add valid per-user config locations.
-        for user_home in os.listdir("/Users"):
-            candidate_launchd_loc = os.path.join("/Users", user_home,
-                                                 "Library/LaunchAgents")
-            if os.path.exists(candidate_launchd_loc):
-                conf_locs.add(candidate_launchd_loc)
-        launchd_config_files = {file for file in files for conf_loc in
-                                conf_locs if file.find(conf_loc) == 0}
-
-        # Attempt to unload and disable these files.
-        for afile in launchd_config_files:
-            self.logger.log("Unloading %s" % afile)
-            result = ""
-            try:
-                # Toss out any stderr messages about things not being
-                # loaded. We just want them off; don't care if they're
-                # not running to begin with.
-                result = subprocess.check_output(
-                    ["launchctl", "unload", "-w", afile],
-                    stderr=subprocess.STDOUT)
-            except subprocess.CalledProcessError as error:
-                # Job may not be loaded, so just log and move on.
-                result = error.message
-            finally:
-                if result:
-                    self.logger.log("Launchctl response: %s" % result.strip())
 
-    def kill(self):
-        """Kill all processes found by controlled App(s)."""
-        kill_list = [pid for app in self.apps for process in
-                     app.processes.values() for pid in process]
-        for process_id in kill_list:
-            try:
-                subprocess.check_call(["kill", str(process_id)])
-                self.logger.log("Killed process ID: %s" % process_id)
-            except subprocess.CalledProcessError:
-                self.logger.log("Failed to kill process ID: %s" % process_id)
+def resolve_in_root(root, path, follow, links):
+    """Return path, with its symlinks resolved within root.
 
+    Args:
+        root: Folder holding the filesystem.
+        path: Path as it would be on that filesystem.
+        follow: Whether to resolve the last component of path.
+        links: One item list counting the symlinks followed so far.
 
-class App(object):
-    """Represents one 'product', as defined in an App
-    Definition File (ADF).
+    Returns:
+        Absolute path, as it would be on the filesystem, with no
+        symlinks (but perhaps its last component) or "..".
+    """
+    parent, name = os.path.split(path)
+    if not name:
+        return os.sep if parent in (os.sep, "") else resolve_in_root(
+            root, parent, True, links)
+    folder = _ROOT_FOLDERS.get((root, parent))
+    if folder is None:
+        folder = resolve_in_root(root, parent or os.sep, True, links)
+        _ROOT_FOLDERS[(root, parent)] = folder
+    if name == os.curdir:
+        return folder
+    if name == os.pardir:
+        return os.path.dirname(folder)
+    candidate = os.path.join(folder, name)
+    if not follow:
+        return candidate
+    try:
+        target = os.readlink(os.path.join(root, candidate.lstrip(os.sep)))
+    except OSError:
+        # Not a symlink, or not there at all.
+        return candidate
+    links[0] += 1
+    if links[0] > ROOT_MAX_LINKS:
+        raise OSError(errno.ELOOP, os.strerror(errno.ELOOP), path)
+    return resolve_in_root(root, os.path.join(folder, target), True, links)
 
-    Attributes:
-        xml: The ADF as an xml.etree.Element.
-        found: Set of files found on the current filesystem.
-        processes: Dictionary of ProcessName: PIDs for currently
-            running processes.
-        name:
-            String name of product from ADF/AppName.
+
+def freeze(value):
+    """Return value made immutable, for a Rule.
+
+    Lists become tuples, recursively, and strings are interned.
     """
+    if isinstance(value, str):
+        return intern(value)
+    elif isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    else:
+        return value
 
-    def __init__(self, xml):
-        """Init instance variables and find on current filesystem.
 
-        Args:
-            xml: root xml.etree.Element of an App Definition File.
-        """
-        self.xml = xml
-        self._env = {}
-        self.found = set()
-        self.processes = {}
-        # See historical note at top.
-        self.name = (self.xml.findtext("AppName") or
-                     self.xml.findtext("AdwareName"))
+def to_str(value):
+    """Convert unicode in value (recursively) to utf-8 encoded str.
 
-        self.find()
+    ElementTree and json hand back a mix of str and unicode; the rest
+    of SavingThrow works with str.
+    """
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    elif isinstance(value, list):
+        return [to_str(item) for item in value]
+    elif isinstance(value, dict):
+        return {to_str(key): to_str(item) for key, item in value.items()}
+    else:
+        return value
 
-    def find(self):
-        """Identify files and processes on the system."""
-        logger = Logger()
-        candidates = set()
-        process_candidates = set()
-        logger.log("Searching for files and processes defined in: %s"
-                   % self.name)
-        # First look for regex-confirmed files to prepare for text
-        # replacement.
-        for tested_file in self.xml.findall("TestedFile"):
-            # Perform a glob and gather the results for all Path elements.
-            paths = set()
-            for path in tested_file.findall("Path"):
-                for pattern in ("*", ".*"):
-                    paths.update(set(glob.glob(os.path.join(path.text,
-                                                            pattern))))
-
-            # If provided, get and compile the regexes for filename
-            # searching.
-            fname_regexen = [fregex.text for fregex in
-                             tested_file.findall("FilenameRegex")]
-            compiled_fname_regexen = []
-            if paths and fname_regexen:
-                for fname_regex in fname_regexen:
-                    try:
-                        compiled_fname_regex = re.compile(fname_regex)
-                        compiled_fname_regexen.append(compiled_fname_regex)
-                    except re.error as re_error:
-                        logger.log("Invalid regex: %s with error: %s in ADF "
-                                   "for: %s" % (fname_regex, self.name,
-                                                re_error.message))
-                        continue
-            elif paths and not fname_regex:
-                logger.log("Paths supplied for %s, but no Regex provided. "
-                           "Skipping this TestedFile." % self.name)
-                continue
 
-            # fnames collects full paths to files which match the
-            # FilenameRegex and 'File' elements which glob, for later
-            # content searching should it be specified.
-            fnames = []
-            for fname_search in paths:
-                for compiled_fname_regex in compiled_fname_regexen:
-                    if re.search(compiled_fname_regex, fname_search):
-                        fnames.append(fname_search)
-
-            # Perform a glob and gather the results for all File elements.
-            globs = [glob.glob(fname.text) for fname in
-                     tested_file.findall("File")]
-            fnames.extend([item for glob_list in globs for item in glob_list])
-
-            # Get the regex to search within a file for, if it exists.
-            regexen = [regex.text for regex in tested_file.findall("Regex")]
-            compiled_regexen = []
-            if regexen:
-                for regex in regexen:
-                    try:
-                        compiled_regex = re.compile(regex)
-                        compiled_regexen.append(compiled_regex)
-                    except re.error as re_error:
-                        logger.log("Invalid regex: %s with error: %s in ADF "
-                                   "for: %s" % (regex, self.name,
-                                                re_error.message))
-                        continue
-                # Get the replacement key if one is provided.
-                replacement_key = tested_file.findtext("ReplacementKey")
+def compile_regex(pattern):
+    """Return pattern compiled, reusing earlier compilations.
 
-                for fname in fnames:
-                    with open(fname, "r") as afile:
-                        text = afile.read()
+    Unlike re's own cache, this one doesn't get flushed when a large
+    ruleset uses more than a hundred patterns.
+    """
+    if pattern not in _COMPILED_REGEXEN:
+        _COMPILED_REGEXEN[pattern] = re.compile(pattern)
+    return _COMPILED_REGEXEN[pattern]
 
-                    for compiled_regex in compiled_regexen:
-                        if re.search(compiled_regex, text):
-                            candidates.add(fname)
 
-                            if replacement_key:
-                                self._env[replacement_key] = re.search(
-                                    regex, text).group(1)
-            else:
-                candidates.update(set(fnames))
+def map_concurrently(function, items, jobs, timeout=None):
+    """Call function on each of items, using up to jobs threads.
 
-        # Now look for regular files.
-        for std_file in self.xml.findall("File"):
-            # Perform text replacments
-            if "%" in std_file.text:
-                for key in self._env:
-                    std_file.text = std_file.text.replace("%%%s%%" % key,
-                                                          self._env[key])
-            candidates.add(std_file.text)
-
-        # Find files on the drive.
-        matches = {match for filename in candidates for match in
-                   glob.glob(filename)}
-        self.found.update(matches)
-        if matches:
-            logger.log("Found files for: %s" % self.name)
+    Worker threads are daemonic, so work still running when the
+    timeout expires won't hold up exit.
 
-        # Build a set of processes to look for.
-        process_candidates = {process.text for process in
-                              self.xml.findall("Process")}
+    Args:
+        function: Callable taking one argument.
+        items: List of arguments to call function with.
+        jobs: Maximum number of threads to use. With 1 or fewer, and
+            no timeout, work is done in the calling thread.
+        timeout: Optional number of seconds to wait for all work.
 
-        # Find running processes.
-        self._get_running_process_ids(process_candidates)
+    Returns:
+        List of results, in the same order as items. Items which
+        didn't finish in time have the result UNFINISHED.
 
-    def _get_running_process_ids(self, processes):
-        """Determine running process PIDs.
+    Raises:
+        Any exception raised by function is re-raised in the
+        calling thread.
+    """
+    if timeout is None and (jobs <= 1 or len(items) <= 1):
+        return [function(item) for item in items]
 
-        Args:
-            processes: Iterable of process names. These names should
-                correspond to those seen in Bash ps/pgrep.
-        """
-        self.processes = {}
-        for process in processes:
-            safe_process = "^%s$" % re.escape(process)
+    work = Queue.Queue()
+    for index_and_item in enumerate(items):
+        work.put(index_and_item)
+    results = {}
+    done = threading.Condition()
+
+    def worker():
+        """Process items until the queue is empty."""
+        while True:
             try:
-                pids = subprocess.check_output(
-                    ["pgrep", safe_process]).splitlines()
-                self.processes[process] = pids
-            except subprocess.CalledProcessError:
-                # No results
-                pass
+                index, item = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                result = (True, function(item))
+            except BaseException:  # pylint: disable=broad-except
+                result = (False, sys.exc_info())
+            with done:
+                results[index] = result
+                done.notify()
+
+    for _ in xrange(max(1, min(jobs, len(items)))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    deadline = time.time() + timeout if timeout is not None else None
+    with done:
+        while len(results) < len(items):
+            if deadline is None:
+                # A wait with no timeout can't be interrupted.
+                done.wait(60)
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                done.wait(remaining)
+        results = dict(results)
+
+    output = []
+    for index in xrange(len(items)):
+        if index not in results:
+            output.append(UNFINISHED)
+            continue
+        succeeded, result = results[index]
+        if not succeeded:
+            raise result[0], result[1], result[2]
+        output.append(result)
+    return output
+
+
+def get_cache_path(source):
+    """Return the path to the cached copy of an ADF URL."""
+    cache_file = os.path.basename(source)
+    # Handle URLs which don't point at a specific file. e.g.
+    # Permalinked gists can be referenced with a directory URL.
+    if not cache_file:
+        # Remove the protocol and swap slashes to periods.
+        # Drop the final slash (period).
+        cache_file = source.split("//")[1].replace("/", ".")[:-1]
+    return os.path.join(CACHE, cache_file)
+
+
+def read_cache_metadata(cache_path):
+    """Return the metadata dict stored alongside a cached ADF.
+
+    Missing or unreadable metadata results in an empty dict.
+    """
+    try:
+        with open(cache_path + ".meta", "r") as meta_file:
+            metadata = json.load(meta_file)
+    except (IOError, ValueError):
+        metadata = {}
+    return metadata if isinstance(metadata, dict) else {}
+
+
+def read_cached_adf(source, cache_path=None):
+    """Return the cached copy of an ADF URL, or "" if unavailable.
+
+    Args:
+        source: String URL of the ADF.
+        cache_path: Optional path it's cached at. Defaults to
+            get_cache_path(source).
+    """
+    try:
+        with open(cache_path or get_cache_path(source), "r") as cache_file:
+            return cache_file.read()
+    except IOError as error:
+        Logger().log("Error: No cached copy of %s or other error %s"
+                     % (source, error.message))
+        return ""
+
+
+def write_cached_adf(cache_path, app_text):
+    """Store an ADF's text in the cache.
+
+    The text is written to a temporary file and renamed into place,
+    so that anything reading the cache concurrently never sees a
+    partial ADF.
+    """
+    try:
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path))
+        with os.fdopen(handle, "w") as cache_file:
+            cache_file.write(app_text)
+        os.rename(temp_path, cache_path)
+    except (IOError, OSError) as error:
+        if error.errno == 13:
+            print "Please run as root!"
+            sys.exit(13)
+        else:
+            raise error
+
+
+def check_download(source, text):
+    """Return why a downloaded ADF or bundle index is unusable, or None.
+
+    ADFs must be well-formed XML, and bundle index manifests (see
+    is_bundle) JSON.
+    """
+    try:
+        if is_bundle(source):
+            json.loads(text)
+        else:
+            ElementTree.fromstring(text)
+    except (ValueError, ElementTree.ParseError) as error:
+        return str(error)
+    return None
 
-        if self.processes:
-            logger = Logger()
-            logger.log("Found processes for: %s" % self.name)
+
+def is_bundle(source):
+    """Return whether source is a bundle's index manifest URL."""
+    return re.split(r"[?#]", source, 1)[0].endswith(".json")
+
+
+def get_bundle_path(source):
+    """Return the path to the cache folder of a bundle URL."""
+    return os.path.splitext(get_cache_path(source))[0] + ".bundle"
+
+
+def parse_bundle_index(index_text, source):
+    """Parse and check a bundle's index manifest.
+
+    The manifest is a JSON object with the keys "format" (which must
+    be BUNDLE_FORMAT), "archive" (the file name of the bundle's ZIP
+    archive, relative to the manifest) and "adfs": a list of objects
+    with the keys "name" (a file name, relative to the manifest),
+    "version" and "sha256", in the order their Apps are loaded.
+
+    Args:
+        index_text: String contents of the manifest.
+        source: String URL the manifest came from, for logging.
+
+    Returns:
+        The manifest as a dict, or None if it isn't valid.
+    """
+    if not index_text:
+        return None
+    try:
+        index = to_str(json.loads(index_text))
+        if index.get("format") != BUNDLE_FORMAT:
+            raise ValueError("unsupported format %s" % index.get("format"))
+        names = [index["archive"]]
+        for entry in index["adfs"]:
+            names.append(entry["name"])
+            entry["version"] = str(entry.get("version", ""))
+            if not re.match(r"^[0-9a-f]{64}$", entry["sha256"]):
+                raise ValueError("bad SHA-256 for %s" % entry["name"])
+        for name in names:
+            if (not isinstance(name, str) or name.startswith(".") or
+                    name.startswith(BUNDLE_INDEX) or "/" in name):
+                raise ValueError("bad file name %r" % name)
+    except (ValueError, KeyError, TypeError, AttributeError) as error:
+        Logger().log("Bundle index %s is invalid: %s" % (source, error))
+        return None
+    return index
+
+
+def fresh_cached_digests(source):
+    """Return the SHA-256s of the ADFs cached for source, if fresh.
+
+    Args:
+        source: String URL to an ADF file or bundle index manifest.
+
+    Returns:
+        List of the SHA-256 hex digests of the source's ADFs, as
+        they were when last fetched, or None unless CACHE_MAX_AGE is
+        set and the source (for a bundle, its manifest) was fetched
+        less than that many seconds ago.
+    """
+    bundle = is_bundle(source)
+    cache_path = (os.path.join(get_bundle_path(source), BUNDLE_INDEX) if
+                  bundle else get_cache_path(source))
+    metadata = read_cache_metadata(cache_path)
+    if not (CACHE_MAX_AGE and metadata.get("sha256") and
+            time.time() - metadata.get("fetched", 0) < CACHE_MAX_AGE):
+        return None
+    if not bundle:
+        return [str(metadata["sha256"])]
+    index = parse_bundle_index(read_cached_adf(source, cache_path), source)
+    if index is None:
+        return None
+    return [entry["sha256"] for entry in index["adfs"]]
+
+
+def read_cached_bundle(source):
+    """Return the texts of a bundle's cached ADFs, without updating."""
+    folder = get_bundle_path(source)
+    index = parse_bundle_index(read_cached_adf(
+        source, os.path.join(folder, BUNDLE_INDEX)), source)
+    if index is None:
+        return []
+    return [read_cached_adf(source, os.path.join(folder, entry["name"]))
+            for entry in index["adfs"]]
+
+
+def write_cache_metadata(cache_path, metadata):
+    """Store the metadata dict alongside a cached ADF."""
+    try:
+        with open(cache_path + ".meta", "w") as meta_file:
+            json.dump(metadata, meta_file)
+    except IOError as error:
+        Logger().log("Unable to write cache metadata for %s: %s" %
+                     (cache_path, error))
+
+
+def write_stats(path, controller, state):
+    """Write the collected Stats, and cache counters, to path as JSON."""
+    report = Stats.report()
+    report["version"] = __version__
+    report["caches"] = {"directory_index": controller.index.stats(),
+                        "content_scanner": controller.scanner.stats(),
+                        "digest_cache":
+                            controller.scanner.digest_cache.stats(),
+                        "rule_store": controller.rule_store.stats(),
+                        "scan_state": state.stats()}
+    report["skipped_files"] = controller.scanner.skipped
+    try:
+        with open(path, "w") as stats_file:
+            json.dump(report, stats_file, indent=2)
+    except IOError as error:
+        Logger().log("Unable to write stats to %s: %s" % (path, error))
 
 
 def build_argparser():
@@ -588,7 +5098,50 @@ def build_argparser():
                 "Casper script usage.")
     parser.add_argument("jamf-arguments", nargs="*", help=help_msg)
     parser.add_argument("-v", "--verbose", action="store_true",
-                        help="Print to stdout as well as syslog.")
+                        help="Print to stdout as well as syslog, and log "
+                        "everything.")
+    parser.add_argument("--log-level", choices=sorted(
+        LOG_LEVEL_NAMES.values()), help="Log only messages at least this "
+                        "severe.")
+    parser.add_argument("--log-file", metavar="FILE",
+                        help="Append log messages to FILE as well.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of Apps to search for at once.")
+    parser.add_argument("--stats", metavar="FILE",
+                        help="Write timings and I/O counts for each App "
+                        "and rule to FILE as JSON, and log the slowest "
+                        "rules.")
+    parser.add_argument("--full", action="store_true",
+                        help="Search everything, rather than reusing "
+                        "results for unchanged directories and files "
+                        "from the last run.")
+    parser.add_argument("--format", choices=("text", "json", "ndjson"),
+                        help="Report findings in this format, rather "
+                        "than as an extension attribute. 'text' is the "
+                        "same as --stdout.")
+    parser.add_argument("--output", metavar="FILE",
+                        help="Write the report to FILE rather than "
+                        "stdout.")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Keep running, searching again whenever "
+                        "watched files change, and answer report "
+                        "requests from other SavingThrow runs "
+                        "instantly.")
+    parser.add_argument("--root", metavar="PATH", action="append",
+                        help="Search the filesystem in folder PATH (e.g. "
+                        "a mounted disk image or backup) instead of the "
+                        "running system's. May be given more than once; "
+                        "each root is searched by its own process. "
+                        "Report only.")
+    parser.add_argument("--time-budget", metavar="SECONDS", type=float,
+                        help="Finish within SECONDS, searching the "
+                        "cheapest rules first, and report whatever has "
+                        "been found by then, marked as partial, with "
+                        "the rules that were skipped.")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="With --remove or --quarantine, print what "
+                        "would be removed, and its size in bytes, "
+                        "instead of changing anything.")
     mode_parser = parser.add_mutually_exclusive_group()
     mode_parser.add_argument(
         "-s", "--stdout", help="Print standard report.", action="store_true")
@@ -603,6 +5156,7 @@ def build_argparser():
 
 def main():
     """Manage arguments and coordinate our saving throw."""
+    started = time.time()
     # Ensure we have a cache directory.
     if not os.path.exists(CACHE):
         os.mkdir(CACHE)
@@ -612,28 +5166,137 @@ def main():
     # We use the parse_known_args method to avoid having to deal with
     # any empty arguments Casper may tack onto the end.
     args = parser.parse_known_args()[0]
+    if args.root:
+        if args.remove or args.quarantine or args.stats or args.daemon:
+            parser.error("--root can't be used with --remove, --quarantine, "
+                         "--stats or --daemon")
+        for root in args.root:
+            if not os.path.isdir(root):
+                parser.error("--root %s is not a folder" % root)
+    if args.daemon and (args.remove or args.quarantine):
+        parser.error("--daemon can't be used with --remove or --quarantine")
+    if args.time_budget is not None:
+        if args.root or args.daemon:
+            parser.error("--time-budget can't be used with --root or "
+                         "--daemon")
+        if args.time_budget <= 0:
+            parser.error("--time-budget must be more than 0 seconds")
+    if args.dry_run and not (args.remove or args.quarantine):
+        parser.error("--dry-run needs --remove or --quarantine")
 
-    # Configure verbose on logger Borg.
+    # Configure verbose, level and sinks on logger Borg.
     logger = Logger()
     if args.verbose:
         logger.enable_verbose()
+    if args.log_level:
+        logger.set_threshold({name: level for level, name in
+                              LOG_LEVEL_NAMES.items()}[args.log_level])
+    if args.log_file:
+        logger.add_sink(FileSink(args.log_file))
+    if args.stats:
+        Stats.enable()
+
+    # An EA has no arguments, so make it the default report.
+    report_format = args.format or ("text" if args.stdout else "ea")
+    socket_path = os.path.join(CACHE, DAEMON_SOCKET)
+    reporting = not (args.remove or args.quarantine or args.daemon)
+    if reporting and not (args.root or args.full or args.stats):
+        # If a daemon is keeping the findings up to date, just ask it.
+        report = query_daemon(socket_path, report_format)
+        if report is not None:
+            if args.output:
+                with open(args.output, "w") as output:
+                    output.write(report)
+            else:
+                sys.stdout.write(report)
+            return
 
     controller = FileController()
-    for source in ADF_FILE_SOURCES:
-        controller.add_app_from_url(source)
-
-    # Which action should we perform? An EA has no arguments, so make
-    # it the default.
-    if args.remove:
-        controller.remove()
-        controller.kill()
-    elif args.quarantine:
-        controller.quarantine()
-        controller.kill()
-    elif args.stdout:
-        controller.report_to_stdout()
+    if args.time_budget is None:
+        controller.add_apps_from_urls(ADF_FILE_SOURCES)
+    else:
+        controller.add_apps_from_urls(ADF_FILE_SOURCES, min(
+            FETCH_DEADLINE, args.time_budget * TIME_BUDGET_FETCH_SHARE))
+    state = ScanState(reuse=not args.full)
+
+    if args.daemon:
+        Daemon(controller, socket_path, args.jobs).run()
+        return
+
+    writer = None
+    if reporting:
+        output = open(args.output, "w") if args.output else sys.stdout
+        writer = REPORT_WRITERS[report_format](output)
+
+    if args.root:
+        # Searching other filesystems: report only, with no
+        # processes, and no previous results to reuse.
+        writer.start()
+        controller.find_in_roots(args.root, args.jobs, writer)
+        writer.finish()
+        if output is not sys.stdout:
+            output.close()
+        return
+
+    # Stream the report while searching, unless verbose logging would
+    # be mixed into it, or the search is against the clock, which
+    # doesn't finish Apps in order.
+    streaming = writer is not None and not (
+        args.verbose and output is sys.stdout or args.time_budget)
+    if streaming:
+        writer.start()
+    if args.time_budget is None:
+        controller.find(args.jobs, state, writer if streaming else None)
+    else:
+        controller.find_before(
+            started + args.time_budget * (1 - TIME_BUDGET_RESERVE),
+            args.jobs, state)
+    logger.log("Incremental scan: %(reused)s Apps reused, %(rescanned)s "
+               "searched" % state.stats(), syslog.LOG_INFO)
+    logger.log("Directory index: %(directories)s directories listed, "
+               "%(hits)s hits, %(misses)s misses" % controller.index.stats(),
+               syslog.LOG_INFO)
+    logger.log("Compiled rules: %(hits)s ADFs reused, %(misses)s parsed" %
+               controller.rule_store.stats(), syslog.LOG_INFO)
+    logger.log("Content scanner: %(reads)s files read (%(bytes_read)s "
+               "bytes), %(hits)s cached searches, %(skipped)s skipped" %
+               controller.scanner.stats(), syslog.LOG_INFO)
+    logger.log("File digests: %(hits)s cached, %(misses)s computed" %
+               controller.scanner.digest_cache.stats(), syslog.LOG_INFO)
+
+    # Which action should we perform?
+    if args.remove or args.quarantine:
+        action = controller.remove if args.remove else controller.quarantine
+        if args.dry_run:
+            logger.flush()
+            output = open(args.output, "w") if args.output else sys.stdout
+            action(dry_run=True, stream=output)
+            if output is not sys.stdout:
+                output.close()
+        else:
+            action()
+            controller.kill()
     else:
-        controller.extension_attribute()
+        if not streaming:
+            logger.flush()
+            writer.start()
+            for app in controller.apps:
+                writer.write_app(app)
+        writer.finish()
+        if output is not sys.stdout:
+            output.close()
+
+    if args.stats:
+        Stats.log_slowest_rules(STATS_TOP_RULES)
+        write_stats(args.stats, controller, state)
+
+    if args.time_budget is not None:
+        # Work abandoned when time ran out may still be running, and
+        # Python 2 can crash if daemon threads run during shutdown.
+        # Everything has been written, so don't wait for them.
+        Logger.close()
+        if threading.active_count() > 1:
+            os._exit(0)  # pylint: disable=protected-access
 
 
 if __name__ == "__main__":
@@ -0,0 +1,422 @@
+#!/usr/bin/python
+# Copyright (C) 2015 Shea G Craig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+benchmark
+
+Time SavingThrow against synthetic ADFs and filesystem trees.
+
+usage: benchmark.py [-h] [--apps APPS] [--files FILES]
+                    [--tested-files TESTED_FILES] [--regexes REGEXES]
+                    [--processes PROCESSES] [--hit-rate HIT_RATE]
+                    [--adfs ADFS] [-j JOBS] [--startup-runs STARTUP_RUNS]
+                    [-o OUTPUT]
+
+Generates a set of ADFs and a matching filesystem tree under a
+temporary folder, serves the ADFs from a local HTTP server, and times
+each phase of a SavingThrow run: loading ADFs, searching (cold, and
+again incrementally), reporting, removal and quarantine. Startup is
+timed too, by running extension attributes in fresh interpreters.
+Results are written as JSON, so that runs can be compared across
+versions and definition sets.
+
+Nothing outside of the temporary folder is touched, with one
+exception: the process table is read as usual.
+"""
+
+
+import argparse
+import BaseHTTPServer
+import json
+import os
+import random
+import resource
+import shutil
+import SocketServer
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from xml.sax.saxutils import escape
+
+import SavingThrow
+
+
+# Functions wrapped to count how often SavingThrow calls them. These
+# stand in for syscall counts, which can't be had portably.
+COUNTED_CALLS = (
+    (os, "listdir"), (os, "stat"), (os, "lstat"), (os.path, "lexists"),
+    (os.path, "isdir"), (os.path, "exists"), (subprocess, "Popen"))
+
+
+class CallCounter(object):
+    """Counts calls to the functions in COUNTED_CALLS."""
+
+    def __init__(self):
+        """Wrap the counted functions."""
+        self.counts = {}
+        self._originals = []
+        for module, name in COUNTED_CALLS:
+            original = getattr(module, name)
+            self._originals.append((module, name, original))
+            setattr(module, name, self._wrap(module, name, original))
+        if SavingThrow.scandir is not None:
+            original = SavingThrow.scandir
+            self._originals.append((SavingThrow, "scandir", original))
+            SavingThrow.scandir = self._wrap(os, "scandir", original)
+
+    def _wrap(self, module, name, function):
+        """Return function, wrapped to count its calls."""
+        key = "%s.%s" % (module.__name__, name)
+        if isinstance(function, type):
+            # Popen is a class; count instantiations.
+            counter = self
+
+            class Counted(function):  # pylint: disable=too-few-public-methods
+                """Counting subclass."""
+
+                def __init__(self, *args, **kwargs):
+                    counter.counts[key] = counter.counts.get(key, 0) + 1
+                    super(Counted, self).__init__(*args, **kwargs)
+            return Counted
+
+        def counted(*args, **kwargs):
+            """Count, then call through."""
+            self.counts[key] = self.counts.get(key, 0) + 1
+            return function(*args, **kwargs)
+        return counted
+
+    def reset(self):
+        """Zero the counts, and return the previous ones."""
+        counts, self.counts = self.counts, {}
+        return counts
+
+    def restore(self):
+        """Put the original functions back."""
+        for module, name, original in self._originals:
+            setattr(module, name, original)
+
+
+def peak_memory():
+    """Return the peak resident set size of this process, in KiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB; OS X reports bytes.
+    return peak / 1024 if sys.platform == "darwin" else peak
+
+
+def generate_adfs(root, args):
+    """Return a list of synthetic ADF texts for a tree at root.
+
+    Every App gets args.files File elements (half of them globs),
+    args.tested_files TestedFile elements with args.regexes Regexes
+    each (alternating between File and Path/FilenameRegex forms), and
+    args.processes Process elements. The last TestedFile supplies a
+    ReplacementKey which one File element uses.
+    """
+    support = os.path.join(root, "Library", "Application Support")
+    agents = os.path.join(root, "Library", "LaunchAgents")
+    apps = []
+    for app_num in xrange(args.apps):
+        name = "Bench%d" % app_num
+        lines = ["<App>", "<AppName>%s</AppName>" % name]
+        for num in xrange(args.tested_files):
+            lines.append("<TestedFile>")
+            if num % 2:
+                lines.append("<Path>%s</Path>" % escape(agents))
+                lines.append("<FilenameRegex>com\\.%s\\.t%d\\..*\\.plist"
+                             "</FilenameRegex>" % (name.lower(), num))
+            else:
+                lines.append("<File>%s</File>" % escape(os.path.join(
+                    agents, "com.%s.t%d.*.plist" % (name.lower(), num))))
+            for regex_num in xrange(args.regexes):
+                lines.append("<Regex>Support/(%s)/agent%d</Regex>" %
+                             (name, regex_num))
+            if num == args.tested_files - 1:
+                lines.append("<ReplacementKey>BENCH</ReplacementKey>")
+            lines.append("</TestedFile>")
+        for num in xrange(args.files):
+            pattern = "file%d*" % num if num % 2 else "file%d" % num
+            lines.append("<File>%s</File>" % escape(
+                os.path.join(support, name, pattern)))
+        if args.tested_files:
+            lines.append("<File>%s</File>" % escape(
+                os.path.join(support, "%BENCH%", "agent0")))
+        for num in xrange(args.processes):
+            lines.append("<Process>bench%d-%d</Process>" % (app_num, num))
+        lines.append("</App>")
+        apps.append("\n".join(lines))
+
+    per_adf = max(1, (len(apps) + args.adfs - 1) // args.adfs)
+    return ["<AdwareDefinition>\n<Version>1</Version>\n%s\n"
+            "</AdwareDefinition>" % "\n".join(apps[start:start + per_adf])
+            for start in xrange(0, len(apps), per_adf)]
+
+
+def generate_tree(root, args):
+    """Create the filesystem the synthetic ADFs describe.
+
+    args.hit_rate of the Apps are "installed": their files exist and
+    their launch agents point at them. The rest only get decoy launch
+    agents, which match the File globs and FilenameRegexes but fail
+    the content Regexes.
+    """
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    support = os.path.join(root, "Library", "Application Support")
+    agents = os.path.join(root, "Library", "LaunchAgents")
+    os.makedirs(support)
+    os.makedirs(agents)
+    rand = random.Random(args.apps)
+    for app_num in xrange(args.apps):
+        name = "Bench%d" % app_num
+        installed = rand.random() < args.hit_rate
+        if installed:
+            os.mkdir(os.path.join(support, name))
+            for num in xrange(args.files):
+                with open(os.path.join(support, name, "file%d" % num),
+                          "w") as afile:
+                    afile.write("x" * 1024)
+            with open(os.path.join(support, name, "agent0"), "w") as afile:
+                afile.write("payload")
+        for num in xrange(args.tested_files):
+            path = os.path.join(agents, "com.%s.t%d.agent.plist" %
+                                (name.lower(), num))
+            with open(path, "w") as afile:
+                afile.write("<plist>%s</plist>" % (
+                    "/Library/Application Support/%s/agent0" % name if
+                    installed else "nothing to see here" * 20))
+
+    # Make everything look long-settled, as it would be on a machine
+    # between runs.
+    settle([os.path.join(dirpath, name) for dirpath, _, filenames in
+            os.walk(root) for name in [""] + filenames])
+
+
+def settle(paths):
+    """Set the times of paths an hour back.
+
+    ScanState treats anything modified within a second of a scan as
+    changed, so a freshly made fixture would never be reused.
+    """
+    settled = time.time() - 3600
+    for path in paths:
+        os.utime(path, (settled, settled))
+
+
+def serve(adfs):
+    """Serve adfs over HTTP on localhost.
+
+    Returns:
+        Tuple of (server, list of URLs).
+    """
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        """Serve the ADF at /<index>.adf."""
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            """Send an ADF, or a 404."""
+            try:
+                body = adfs[int(self.path.strip("/").split(".")[0])]
+            except (ValueError, IndexError):
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            """Keep quiet."""
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        """Threaded HTTP server."""
+        daemon_threads = True
+
+    server = Server(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base = "http://127.0.0.1:%d" % server.server_address[1]
+    return server, ["%s/%d.adf" % (base, num) for num in xrange(len(adfs))]
+
+
+# Run in a fresh interpreter to time an extension attribute run from
+# startup, and print the timings as JSON.
+STARTUP_SCRIPT = """
+import json, StringIO, sys, time
+start = time.time()
+sys.path.insert(0, %(path)r)
+import SavingThrow
+imported = time.time()
+SavingThrow.CACHE = %(cache)r
+SavingThrow.CACHE_MAX_AGE = %(max_age)r
+SavingThrow.ADF_FILE_SOURCES = %(sources)r
+SavingThrow.syslog.syslog = lambda *args: None
+sys.argv = ["SavingThrow.py"]
+stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+SavingThrow.main()
+sys.stdout = stdout
+print json.dumps({"import_seconds": imported - start,
+                  "seconds": time.time() - start,
+                  "modules": len([name for name, module in
+                                  sys.modules.items() if module])})
+"""
+
+
+def time_startup(sources, runs, max_age):
+    """Time extension attribute runs, each in a fresh interpreter.
+
+    Args:
+        sources: List of ADF URLs.
+        runs: Number of runs.
+        max_age: CACHE_MAX_AGE for the runs. Anything but 0 lets a
+            warm cache skip downloading and compiling ADFs.
+
+    Returns:
+        Dict of the median "import_seconds" (importing SavingThrow),
+        "seconds" (the whole run, including the import) and
+        "modules" (count of modules loaded by the end).
+    """
+    script = STARTUP_SCRIPT % {
+        "path": os.path.dirname(os.path.abspath(SavingThrow.__file__)),
+        "cache": SavingThrow.CACHE, "max_age": max_age, "sources": sources}
+    samples = [json.loads(subprocess.check_output(
+        [sys.executable, "-c", script])) for _ in xrange(runs)]
+    return {key: sorted(sample[key] for sample in samples)[runs // 2] for
+            key in samples[0]}
+
+
+def timed(results, counter, phase, function, *args):
+    """Run function, adding its timings and counts to results."""
+    counter.reset()
+    start = time.time()
+    result = function(*args)
+    results[phase] = {"seconds": round(time.time() - start, 6),
+                      "calls": counter.reset(),
+                      "peak_memory_kib": peak_memory()}
+    return result
+
+
+def build_argparser():
+    """Create our argument parser."""
+    description = ("Time SavingThrow against synthetic ADFs and "
+                   "filesystem trees, and report as JSON.")
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--apps", type=int, default=200,
+                        help="Number of Apps to generate.")
+    parser.add_argument("--files", type=int, default=5,
+                        help="Number of File elements per App.")
+    parser.add_argument("--tested-files", type=int, default=2,
+                        help="Number of TestedFile elements per App.")
+    parser.add_argument("--regexes", type=int, default=2,
+                        help="Number of Regex elements per TestedFile.")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Number of Process elements per App.")
+    parser.add_argument("--hit-rate", type=float, default=0.1,
+                        help="Fraction of Apps to 'install'.")
+    parser.add_argument("--adfs", type=int, default=10,
+                        help="Number of ADFs to spread the Apps over.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of Apps to search for at once.")
+    parser.add_argument("--startup-runs", type=int, default=5,
+                        help="Number of fresh interpreters to time "
+                        "startup with; 0 to skip.")
+    parser.add_argument("-o", "--output",
+                        help="Write results to this file, rather than "
+                        "stdout.")
+    return parser
+
+
+def main():
+    """Generate, run, and report."""
+    args = build_argparser().parse_args()
+    workdir = tempfile.mkdtemp(prefix="SavingThrow-benchmark-")
+    root = os.path.join(workdir, "root")
+    SavingThrow.CACHE = os.path.join(workdir, "cache")
+    os.mkdir(SavingThrow.CACHE)
+    # Time revalidating ADFs with the server; trusting the cache is
+    # timed separately, by the startup runs.
+    SavingThrow.CACHE_MAX_AGE = 0
+
+    adfs = generate_adfs(root, args)
+    server, sources = serve(adfs)
+    results = {"version": SavingThrow.__version__,
+               "parameters": vars(args),
+               "adf_bytes": sum(len(adf) for adf in adfs),
+               "phases": {}}
+    phases = results["phases"]
+    counter = CallCounter()
+    # Syslog is the same cost in every version; leave it out.
+    SavingThrow.syslog.syslog = lambda *args: None
+    try:
+        generate_tree(root, args)
+        # Searches depend on the folders above the tree too. workdir
+        # can be settled; its parent (e.g. /tmp) isn't ours to touch,
+        # so wait until its change (making workdir) is old enough.
+        settle([workdir])
+        time.sleep(max(0, os.stat(os.path.dirname(workdir)).st_mtime + 1.5 -
+                       time.time()))
+        controller = SavingThrow.FileController()
+        timed(phases, counter, "load", controller.add_apps_from_urls,
+              sources)
+        controller = SavingThrow.FileController()
+        timed(phases, counter, "load_cached", controller.add_apps_from_urls,
+              sources)
+        timed(phases, counter, "find", controller.find, args.jobs,
+              SavingThrow.ScanState(reuse=False))
+        report = timed(phases, counter, "report_string",
+                       controller.report_string)
+        results["findings"] = report.count("\nFile ")
+
+        incremental = SavingThrow.FileController()
+        incremental.add_apps_from_urls(sources)
+        state = SavingThrow.ScanState()
+        timed(phases, counter, "find_incremental", incremental.find,
+              args.jobs, state)
+        phases["find_incremental"]["reused"] = state.reused
+        phases["find_incremental"]["apps"] = len(incremental.apps)
+
+        if args.startup_runs > 0:
+            # With the cache warm: revalidating every ADF with the
+            # server, then trusting the cache and its stored rules.
+            results["startup"] = {
+                "revalidate": time_startup(sources, args.startup_runs, 0),
+                "cached": time_startup(sources, args.startup_runs, 3600)}
+
+        timed(phases, counter, "remove", controller.remove)
+
+        generate_tree(root, args)
+        controller = SavingThrow.FileController()
+        controller.add_apps_from_urls(sources)
+        controller.find(args.jobs)
+        timed(phases, counter, "quarantine", controller.quarantine)
+    finally:
+        counter.restore()
+        server.shutdown()
+        shutil.rmtree(workdir)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print output
+
+
+if __name__ == "__main__":
+    main()
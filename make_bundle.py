@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# Copyright (C) 2015 Shea G Craig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+make_bundle
+
+Publish a set of ADFs as a SavingThrow bundle.
+
+usage: make_bundle.py [-h] [--index NAME] [--archive NAME] FOLDER
+                      ADF [ADF ...]
+
+Writes an index manifest listing the name, version and SHA-256 of
+each ADF, a ZIP archive of the ADFs (and the manifest), and a copy of
+each ADF, to FOLDER. Serve FOLDER from a web server, and add the URL
+of the manifest to SavingThrow's ADF sources: clients then check
+every ADF in the bundle with one request, and download only those
+which have changed.
+"""
+
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tempfile
+from xml.etree import ElementTree
+import zipfile
+
+import SavingThrow
+
+
+def adf_version(adf_text):
+    """Return the Version of an ADF, or "" if it has none."""
+    try:
+        return ElementTree.fromstring(adf_text).findtext("Version") or ""
+    except ElementTree.ParseError:
+        return ""
+
+
+def build_argparser():
+    """Create our argument parser."""
+    description = "Publish a set of ADFs as a SavingThrow bundle."
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--index", metavar="NAME", default="index.json",
+                        help="File name of the index manifest; must end "
+                        "in '.json'.")
+    parser.add_argument("--archive", metavar="NAME", default="bundle.zip",
+                        help="File name of the archive.")
+    parser.add_argument("folder", metavar="FOLDER",
+                        help="Folder to publish the bundle to.")
+    parser.add_argument("adfs", metavar="ADF", nargs="+",
+                        help="ADF files, in the order their Apps should "
+                        "be loaded.")
+    return parser
+
+
+def main():
+    """Write the bundle."""
+    parser = build_argparser()
+    args = parser.parse_args()
+    if not args.index.endswith(".json"):
+        parser.error("--index must end in '.json'")
+    names = [os.path.basename(path) for path in args.adfs]
+    if len(set(names)) != len(names):
+        parser.error("ADF file names must be unique")
+    if args.archive in names or args.index in names:
+        parser.error("ADF file names must differ from the index and "
+                     "archive")
+    if not os.path.isdir(args.folder):
+        os.makedirs(args.folder)
+
+    index = {"format": SavingThrow.BUNDLE_FORMAT, "archive": args.archive,
+             "adfs": []}
+    texts = []
+    for name, path in zip(names, args.adfs):
+        with open(path, "r") as adf_file:
+            text = adf_file.read()
+        texts.append(text)
+        index["adfs"].append({"name": name, "version": adf_version(text),
+                              "sha256": hashlib.sha256(text).hexdigest()})
+    index_text = json.dumps(index, indent=2, sort_keys=True) + "\n"
+
+    # Write everything to temporary files and rename them into place,
+    # so that clients never see a manifest that doesn't match the
+    # files it describes. The manifest goes last.
+    outputs = zip(names, texts)
+    handle, archive_path = tempfile.mkstemp(dir=args.folder)
+    with os.fdopen(handle, "wb") as archive_file:
+        with zipfile.ZipFile(archive_file, "w",
+                             zipfile.ZIP_DEFLATED) as archive:
+            for name, text in outputs:
+                archive.writestr(name, text)
+            archive.writestr(args.index, index_text)
+    os.chmod(archive_path, 0644)
+    os.rename(archive_path, os.path.join(args.folder, args.archive))
+    for name, text in outputs + [(args.index, index_text)]:
+        handle, temp_path = tempfile.mkstemp(dir=args.folder)
+        with os.fdopen(handle, "w") as output:
+            output.write(text)
+        os.chmod(temp_path, 0644)
+        os.rename(temp_path, os.path.join(args.folder, name))
+    print >> sys.stderr, "Wrote %s ADFs to %s" % (len(names), args.folder)
+
+
+if __name__ == "__main__":
+    main()
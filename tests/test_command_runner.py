@@ -0,0 +1,110 @@
+"""Tests for unloading launchd jobs and killing processes."""
+
+
+import errno
+import os
+import shutil
+import signal
+import StringIO
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import SavingThrow
+
+
+# Stands in for launchctl: records its arguments, and answers like the
+# real one does for a job which isn't loaded.
+FAKE_LAUNCHCTL = """#!/bin/sh
+echo "$@" >> "%s"
+echo "  Could not find specified service: $3  "
+"""
+
+
+class LaunchctlTest(unittest.TestCase):
+    """launchctl runs once per launchd config file, and never otherwise."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.calls = os.path.join(self.folder, "calls")
+        fake = os.path.join(self.folder, "launchctl")
+        with open(fake, "w") as fake_file:
+            fake_file.write(FAKE_LAUNCHCTL % self.calls)
+        os.chmod(fake, 0o755)
+        self.path = os.environ["PATH"]
+        os.environ["PATH"] = os.pathsep.join((self.folder, self.path))
+        self.sinks = SavingThrow.Logger.sinks
+        self.stream = StringIO.StringIO()
+        SavingThrow.Logger.flush()
+        SavingThrow.Logger.sinks = [SavingThrow.StreamSink(self.stream)]
+        self.controller = SavingThrow.FileController()
+
+    def tearDown(self):
+        SavingThrow.Logger.flush()
+        SavingThrow.Logger.sinks = self.sinks
+        os.environ["PATH"] = self.path
+        shutil.rmtree(self.folder)
+
+    def launchctl_calls(self):
+        """Return the argument lines the fake launchctl was run with."""
+        try:
+            with open(self.calls) as calls_file:
+                return sorted(calls_file.read().splitlines())
+        except IOError:
+            return []
+
+    def test_config_files_are_unloaded(self):
+        self.controller.unload_and_disable_launchd_jobs([
+            "/Library/LaunchAgents/com.evil.agent.plist",
+            "/Users/someone/Library/LaunchAgents/com.evil.user.plist",
+            "/Library/LaunchAgents/com.evil.agent.plist",
+            "/Library/Application Support/Evil/evil.plist"])
+        self.assertEqual(self.launchctl_calls(), [
+            "unload -w /Library/LaunchAgents/com.evil.agent.plist",
+            "unload -w /Users/someone/Library/LaunchAgents/"
+            "com.evil.user.plist"])
+        self.assertEqual(self.controller.runner.spawned, 2)
+        SavingThrow.Logger.flush()
+        log = self.stream.getvalue().splitlines()
+        self.assertIn("Launchctl response: Could not find specified "
+                      "service: /Library/LaunchAgents/com.evil.agent.plist",
+                      log)
+
+    def test_no_config_files_runs_nothing(self):
+        self.controller.unload_and_disable_launchd_jobs([
+            "/Library/LaunchAgentsBackup/com.evil.agent.plist",
+            "/Users/Shared/com.evil.plist"])
+        self.assertEqual(self.launchctl_calls(), [])
+        self.assertEqual(self.controller.runner.spawned, 0)
+
+
+class TerminateTest(unittest.TestCase):
+    """Processes are signalled directly, without running kill."""
+
+    def setUp(self):
+        self.sent = []
+        self.exited = set()
+        self.runner = SavingThrow.CommandRunner(self.send_signal)
+
+    def send_signal(self, pid, signum):
+        """Act as os.kill for fake PIDs; 2 ignores SIGTERM."""
+        if pid in self.exited:
+            raise OSError(errno.ESRCH, "No such process")
+        if signum:
+            self.sent.append((pid, signum))
+            if signum == signal.SIGKILL or pid != 2:
+                self.exited.add(pid)
+
+    def test_term_then_kill(self):
+        killed, failed = self.runner.terminate([1, 2, 3], 0.1)
+        self.assertEqual((killed, failed), ([1, 2, 3], []))
+        self.assertEqual(self.sent, [
+            (1, signal.SIGTERM), (2, signal.SIGTERM), (3, signal.SIGTERM),
+            (2, signal.SIGKILL)])
+        self.assertEqual(self.runner.spawned, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+"""Tests for ContentScanner's chunked searching."""
+
+
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import SavingThrow
+
+
+class ChunkedSearchTest(unittest.TestCase):
+    """Chunked searches match just as a search of the whole file does."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.saved = (SavingThrow.SCAN_CHUNK, SavingThrow.SCAN_OVERLAP)
+        SavingThrow.SCAN_CHUNK = 16
+        SavingThrow.SCAN_OVERLAP = 8
+
+    def tearDown(self):
+        SavingThrow.SCAN_CHUNK, SavingThrow.SCAN_OVERLAP = self.saved
+        shutil.rmtree(self.folder)
+
+    def check(self, text, patterns):
+        """Assert that searching a file of text agrees with re."""
+        path = os.path.join(self.folder, "file")
+        with open(path, "wb") as afile:
+            afile.write(text)
+        results = SavingThrow.ContentScanner().search(path, patterns)
+        for pattern in patterns:
+            match = re.search(pattern, text)
+            expected = match.groups() if match else None
+            self.assertEqual(results.get(pattern), expected,
+                             "%r in %r" % (pattern, text))
+
+    def test_start_anchors_only_match_at_start_of_file(self):
+        for offset in xrange(48):
+            self.check("x" * offset + "START" + "x" * 24,
+                       [r"\ASTART", r"^(ST)ART", r"nothing"])
+            self.check("x" * offset + "START" + "x" * 24, [r"^START"])
+            self.check("x" * offset + "\nSTART" + "x" * 24,
+                       [r"(?m)^START", r"\A\nSTART"])
+
+    def test_end_anchors_only_match_at_end_of_file(self):
+        for offset in xrange(48):
+            for end in ("", "\n", "y" * 24, "\n" + "y" * 24):
+                self.check("x" * offset + "END" + end,
+                           [r"END$", r"(E)ND\Z", r"nothing"])
+                self.check("x" * offset + "END" + end, [r"END$"])
+
+    def test_match_spanning_chunks(self):
+        for offset in xrange(48):
+            self.check("x" * offset + "SPANNING" + "x" * 24,
+                       [r"SPAN(NI)NG", r"nothing"])
+            self.check("x" * offset + "SPANNING" + "x" * 24,
+                       [r"(?<=x)SPANNING"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+"""Tests for the cache of file digests."""
+
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import SavingThrow
+
+
+class DigestCachePruneTest(unittest.TestCase):
+    """Saving the cache drops entries for files which are gone."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "digests.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def make_file(self, name, text):
+        """Write text to a file in the folder; return its path and stat."""
+        path = os.path.join(self.folder, name)
+        with open(path, "w") as afile:
+            afile.write(text)
+        return path, os.stat(path)
+
+    def saved_digests(self):
+        """Return the digests as saved on disk."""
+        with open(self.path) as cache_file:
+            return set(entry[2] for entry in
+                       json.load(cache_file)["digests"].values())
+
+    def test_entries_for_missing_files_are_dropped(self):
+        kept, kept_status = self.make_file("kept", "a")
+        gone, gone_status = self.make_file("gone", "b")
+        cache = SavingThrow.DigestCache(self.path)
+        cache.put(kept_status, "aaaa", kept)
+        cache.put(gone_status, "bbbb", gone)
+        cache.save()
+        self.assertEqual(self.saved_digests(), set(["aaaa", "bbbb"]))
+
+        os.remove(gone)
+        SavingThrow.DigestCache(self.path).save()
+        self.assertEqual(self.saved_digests(), set(["aaaa"]))
+
+    def test_entries_for_changed_files_are_dropped(self):
+        path, status = self.make_file("changed", "a")
+        cache = SavingThrow.DigestCache(self.path)
+        cache.put(status, "aaaa", path)
+        cache.save()
+
+        self.make_file("changed", "longer")
+        SavingThrow.DigestCache(self.path).save()
+        self.assertEqual(self.saved_digests(), set())
+
+    def test_entries_used_this_run_are_kept(self):
+        path, status = self.make_file("moved", "a")
+        cache = SavingThrow.DigestCache(self.path)
+        cache.put(status, "aaaa", path)
+        cache.save()
+
+        # The file is renamed, so its recorded location is gone, but
+        # it was looked up (by inode) this run.
+        os.rename(path, path + ".new")
+        cache = SavingThrow.DigestCache(self.path)
+        self.assertEqual(cache.get(status), "aaaa")
+        cache.save()
+        self.assertEqual(self.saved_digests(), set(["aaaa"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
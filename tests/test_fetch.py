@@ -0,0 +1,124 @@
+"""Tests for downloading ADFs."""
+
+
+import BaseHTTPServer
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import SavingThrow
+
+
+ADF = """<AdwareDefinition><App><AppName>Cached</AppName>
+<File>/nonexistent/cached</File></App></AdwareDefinition>"""
+
+
+class StalledServerTest(unittest.TestCase):
+    """A server which stops sending is abandoned at the deadline."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.settings = (SavingThrow.CACHE, SavingThrow.FETCH_TIMEOUT,
+                         SavingThrow.FETCH_DEADLINE)
+        SavingThrow.CACHE = self.folder
+        SavingThrow.FETCH_TIMEOUT = 30
+        self.release = threading.Event()
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(5)
+        thread = threading.Thread(target=self.stall)
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:%s/cached.xml" % (
+            self.server.getsockname()[1])
+
+    def tearDown(self):
+        self.release.set()
+        self.server.close()
+        (SavingThrow.CACHE, SavingThrow.FETCH_TIMEOUT,
+         SavingThrow.FETCH_DEADLINE) = self.settings
+        shutil.rmtree(self.folder)
+
+    def stall(self):
+        """Send headers and part of the body, then nothing more."""
+        try:
+            connection, _ = self.server.accept()
+        except socket.error:
+            return
+        connection.recv(4096)
+        connection.sendall("HTTP/1.0 200 OK\r\nContent-Length: %s\r\n\r\n%s"
+                           % (len(ADF), ADF[:10]))
+        self.release.wait(60)
+        connection.close()
+
+    def test_deadline_falls_back_to_cache(self):
+        SavingThrow.write_cached_adf(SavingThrow.get_cache_path(self.url),
+                                     ADF)
+        # Set after import, as a user's configuration would be.
+        SavingThrow.FETCH_DEADLINE = 0.5
+        controller = SavingThrow.FileController()
+        start = time.time()
+        controller.add_apps_from_urls([self.url])
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual([app.name for app in controller.apps], ["Cached"])
+
+
+class ADFHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves ADF in full to every GET, ignoring validators."""
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(ADF)))
+        self.end_headers()
+        self.wfile.write(ADF)
+
+    def log_message(self, *args):
+        pass
+
+
+class UnchangedDownloadTest(unittest.TestCase):
+    """A download identical to the cached copy isn't parsed again."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.settings = (SavingThrow.CACHE, SavingThrow.CACHE_MAX_AGE,
+                         SavingThrow.check_download)
+        SavingThrow.CACHE = self.folder
+        SavingThrow.CACHE_MAX_AGE = 0
+        self.checked = []
+        SavingThrow.check_download = self.check_download
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), ADFHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:%s/cached.xml" % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        (SavingThrow.CACHE, SavingThrow.CACHE_MAX_AGE,
+         SavingThrow.check_download) = self.settings
+        shutil.rmtree(self.folder)
+
+    def check_download(self, source, text):
+        """Record the check, and make it as the original would."""
+        self.checked.append(source)
+        return self.settings[2](source, text)
+
+    def test_only_changed_text_is_checked(self):
+        controller = SavingThrow.FileController()
+        self.assertEqual(controller.fetch_adf(self.url), ADF)
+        self.assertEqual(self.checked, [self.url])
+        self.assertEqual(controller.fetch_adf(self.url), ADF)
+        self.assertEqual(self.checked, [self.url])
+
+
+if __name__ == "__main__":
+    unittest.main()
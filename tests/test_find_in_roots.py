@@ -0,0 +1,50 @@
+"""Tests for searching --root folders."""
+
+
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import SavingThrow
+
+
+class SingleRootTest(unittest.TestCase):
+    """One root is searched in this process, leaving its Logger alone."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = SavingThrow.CACHE
+        SavingThrow.CACHE = os.path.join(self.folder, "cache")
+        os.makedirs(SavingThrow.CACHE)
+        self.root = os.path.join(self.folder, "root")
+        os.makedirs(self.root)
+        self.sinks = SavingThrow.Logger.sinks
+        self.stream = StringIO.StringIO()
+        SavingThrow.Logger.flush()
+        SavingThrow.Logger.sinks = [SavingThrow.StreamSink(self.stream)]
+
+    def tearDown(self):
+        SavingThrow.Logger.flush()
+        SavingThrow.Logger.sinks = self.sinks
+        SavingThrow.CACHE = self.cache
+        shutil.rmtree(self.folder)
+
+    def test_buffered_messages_and_flusher_survive(self):
+        SavingThrow.Logger.log("logged before the search")
+        flusher = SavingThrow.Logger._flusher
+        wakeup = SavingThrow.Logger._wakeup
+        controller = SavingThrow.FileController()
+        self.assertEqual(controller.find_in_roots([self.root]), [[]])
+        self.assertIs(SavingThrow.Logger._flusher, flusher)
+        self.assertIs(SavingThrow.Logger._wakeup, wakeup)
+        SavingThrow.Logger.flush()
+        self.assertIn("logged before the search", self.stream.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+"""Tests for TestedFile Hash rules."""
+
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import SavingThrow
+
+
+ADF = """<AdwareDefinition><App><AppName>Renamed</AppName>
+<TestedFile><Path>%s</Path><Hash>%s</Hash></TestedFile>
+</App></AdwareDefinition>"""
+
+
+class HashRuleTest(unittest.TestCase):
+    """Hashes find payloads whatever they're called."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = SavingThrow.CACHE
+        SavingThrow.CACHE = os.path.join(self.folder, "cache")
+        os.makedirs(SavingThrow.CACHE)
+        self.bin = os.path.join(self.folder, "bin")
+        os.makedirs(os.path.join(self.bin, "sub"))
+
+    def tearDown(self):
+        SavingThrow.CACHE = self.cache
+        shutil.rmtree(self.folder)
+
+    def write(self, name, text):
+        """Write text to a file under bin; return its path."""
+        path = os.path.join(self.bin, name)
+        with open(path, "w") as afile:
+            afile.write(text)
+        return path
+
+    def test_path_without_filename_regex(self):
+        payload = self.write("innocent-looking-name", "payload")
+        self.write("ok", "fine")
+        self.write("sub/also-fine", "fine")
+        controller = SavingThrow.FileController()
+        controller.add_apps_from_text(
+            ADF % (self.bin, hashlib.sha256("payload").hexdigest()), "test")
+        controller.find()
+        self.assertEqual(sorted(controller.apps[0].found), [payload])
+
+
+if __name__ == "__main__":
+    unittest.main()
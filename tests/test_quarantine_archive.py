@@ -0,0 +1,52 @@
+"""Tests for quarantine archives."""
+
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import SavingThrow
+
+
+class QuarantineArchiveTest(unittest.TestCase):
+    """Archives are never overwritten by a later run."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def archive(self, name, text):
+        """Quarantine a file holding text; return the archive's path."""
+        payload = os.path.join(self.folder, name)
+        with open(payload, "w") as afile:
+            afile.write(text)
+        archive = SavingThrow.QuarantineArchive(
+            os.path.join(self.folder, "20260101-000000-Quarantine.zip"))
+        archive.add(payload, "App")
+        archive.close()
+        self.assertTrue(archive.verify())
+        return archive.path
+
+    def test_same_name_gets_a_counter(self):
+        first = self.archive("first", "a")
+        second = self.archive("second", "b")
+        third = self.archive("third", "c")
+        self.assertEqual(
+            [os.path.basename(path) for path in (first, second, third)],
+            ["20260101-000000-Quarantine.zip",
+             "20260101-000000-Quarantine-1.zip",
+             "20260101-000000-Quarantine-2.zip"])
+        with zipfile.ZipFile(first) as zipf:
+            self.assertIn("first", [os.path.basename(name) for name in
+                                    zipf.namelist()])
+
+
+if __name__ == "__main__":
+    unittest.main()
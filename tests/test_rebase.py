@@ -0,0 +1,70 @@
+"""Tests for resolving paths within a --root."""
+
+
+import errno
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import SavingThrow
+
+
+class RebaseTest(unittest.TestCase):
+    """Symlinks inside a root never lead outside it."""
+
+    def setUp(self):
+        self.folder = os.path.realpath(tempfile.mkdtemp())
+        self.root = os.path.join(self.folder, "root")
+        self.host = os.path.join(self.folder, "host")
+        os.makedirs(os.path.join(self.root, "opt", "px"))
+        os.makedirs(os.path.join(self.root, "Library"))
+        os.makedirs(self.host)
+        SavingThrow._ROOT_FOLDERS.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def link(self, target, path):
+        """Make a symlink at path, in the root, to target."""
+        os.symlink(target, os.path.join(self.root, path.lstrip("/")))
+
+    def test_plain_paths_are_joined(self):
+        self.assertEqual(SavingThrow.rebase(self.root, "/opt/px/a"),
+                         os.path.join(self.root, "opt/px/a"))
+        self.assertEqual(SavingThrow.rebase(None, "/opt/px/a"), "/opt/px/a")
+
+    def test_absolute_links_stay_in_root(self):
+        self.link(self.host, "/Library/LaunchAgents")
+        self.link("/opt/px", "/Library/px")
+        self.assertEqual(
+            SavingThrow.rebase(self.root, "/Library/LaunchAgents/a.plist"),
+            os.path.join(self.root, self.host.lstrip("/"), "a.plist"))
+        self.assertEqual(SavingThrow.rebase(self.root, "/Library/px/a"),
+                         os.path.join(self.root, "opt/px/a"))
+
+    def test_parent_links_stop_at_root(self):
+        self.link("../../../../../../.." + self.host, "/Library/up")
+        self.assertEqual(SavingThrow.rebase(self.root, "/Library/up/a"),
+                         os.path.join(self.root, self.host.lstrip("/"), "a"))
+
+    def test_last_component_followed_only_when_asked(self):
+        self.link("/opt/px", "/Library/px")
+        self.assertEqual(SavingThrow.rebase(self.root, "/Library/px", False),
+                         os.path.join(self.root, "Library/px"))
+        self.assertEqual(SavingThrow.rebase(self.root, "/Library/px"),
+                         os.path.join(self.root, "opt/px"))
+
+    def test_loops_raise(self):
+        self.link("loop2", "/Library/loop1")
+        self.link("loop1", "/Library/loop2")
+        with self.assertRaises(OSError) as context:
+            SavingThrow.rebase(self.root, "/Library/loop1/a")
+        self.assertEqual(context.exception.errno, errno.ELOOP)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+"""Tests for building Apps straight from the rule store."""
+
+
+import BaseHTTPServer
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import SavingThrow
+
+
+ADF = """<AdwareDefinition><App><AppName>Stored</AppName>
+<File>/nonexistent/stored</File></App></AdwareDefinition>"""
+
+
+class ADFHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves ADF to every GET, counting the requests."""
+
+    requests = 0
+
+    def do_GET(self):
+        ADFHandler.requests += 1
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(ADF)))
+        self.send_header("ETag", '"stored"')
+        self.end_headers()
+        self.wfile.write(ADF)
+
+    def log_message(self, *args):
+        pass
+
+
+class StoredRulesTest(unittest.TestCase):
+    """With the default settings, a warm cache skips the network."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = SavingThrow.CACHE
+        SavingThrow.CACHE = self.folder
+        ADFHandler.requests = 0
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), ADFHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:%s/stored.xml" % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        SavingThrow.CACHE = self.cache
+        shutil.rmtree(self.folder)
+
+    def test_second_run_uses_stored_rules(self):
+        controller = SavingThrow.FileController()
+        controller.add_apps_from_urls([self.url])
+        self.assertEqual([app.name for app in controller.apps], ["Stored"])
+        self.assertEqual(ADFHandler.requests, 1)
+
+        def fetch_source(source):
+            self.fail("%s was fetched" % source)
+
+        controller = SavingThrow.FileController()
+        controller.fetch_source = fetch_source
+        controller.add_apps_from_urls([self.url])
+        self.assertEqual([app.name for app in controller.apps], ["Stored"])
+        self.assertEqual(ADFHandler.requests, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()